@@ -0,0 +1,83 @@
+"""Классификатор платформ на потоке сообщений из групповых чатов.
+
+Сравнивает прежнюю проверку (подстроки доменов в ссылке) с classify_url
+и считает ложные срабатывания прежней проверки (dropbox.com содержит x.com).
+
+    python benchmarks/bench_classifier.py [число сообщений]
+"""
+import random
+import sys
+
+from common import import_main, timed
+
+main, _ = import_main()
+
+LEGACY_DOMAINS = [
+    "tiktok.com", "vm.tiktok.com", "vt.tiktok.com", "m.tiktok.com",
+    "youtube.com", "youtu.be", "instagram.com", "facebook.com",
+    "twitter.com", "x.com", "vk.com", "m.vkvideo.ru", "reddit.com", "pinterest.com", "pin.it",
+    "dailymotion.com", "vimeo.com", "soundcloud.com",
+]
+
+SUPPORTED = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ", "https://youtu.be/dQw4w9WgXcQ?si=abc",
+    "https://vm.tiktok.com/ZMabcdef/", "https://www.tiktok.com/@user/video/7106594312292453675",
+    "https://www.instagram.com/reel/Cabc_12-x/", "https://x.com/user/status/1234567890123",
+    "https://vk.com/video-12345_456239017", "https://www.reddit.com/r/videos/comments/abc12/t/",
+    "https://pin.it/1a2b3c", "https://vimeo.com/76979871", "https://soundcloud.com/artist/track",
+]
+UNSUPPORTED = [
+    "https://www.dropbox.com/s/abc/file.mp4", "https://netflix.com/title/1", "https://mail.google.com/",
+    "https://github.com/user/repo", "https://habr.com/ru/articles/1/", "https://example.com/vk.com/video1_2",
+    "https://docs.python.org/3/", "https://linkbox.com/x", "https://maps.yandex.ru/?ll=1,2",
+]
+WORDS = ("привет", "как дела", "смотри", "лол", "завтра в 10", "ок", "а это видели?", "ну да", "👍", "согласен")
+
+
+def make_corpus(count: int, seed: int = 1):
+    """Сообщения как в живой группе: в основном текст без ссылок, часть — со ссылками"""
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12)))
+        roll = rnd.random()
+        if roll < 0.15:
+            text += " " + rnd.choice(SUPPORTED)
+        elif roll < 0.30:
+            text += " " + rnd.choice(UNSUPPORTED)
+        corpus.append(text)
+    return corpus
+
+
+def legacy_filter(corpus):
+    hits = 0
+    for text in corpus:
+        url = main.find_first_url(text)
+        if url:
+            url_low = url.lower()
+            hits += any(domain in url_low for domain in LEGACY_DOMAINS)
+    return hits
+
+
+def classifier_filter(corpus):
+    hits = 0
+    for text in corpus:
+        if "://" not in text:
+            continue
+        hits += any(main.classify_url(url) is not None for url in main.find_all_urls(text))
+    return hits
+
+
+def main_bench(count: int):
+    corpus = make_corpus(count)
+    legacy_hits, new_hits = legacy_filter(corpus), classifier_filter(corpus)
+    legacy = timed(legacy_filter, corpus)
+    new = timed(classifier_filter, corpus)
+    print(f"сообщений: {count}")
+    print(f"подстроки:     {legacy:.3f} с  ({count / legacy:,.0f} сообщ/с), совпадений {legacy_hits}")
+    print(f"classify_url:  {new:.3f} с  ({count / new:,.0f} сообщ/с), совпадений {new_hits}")
+    print(f"ложных срабатываний подстрок: {legacy_hits - new_hits}")
+
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
@@ -0,0 +1,117 @@
+"""Операций в секунду с базой настроек: до и после общего соединения.
+
+«До» — прежний UserSettings: sqlite3.connect() и close() на каждый вызов, журнал по умолчанию,
+фиксация каждой записи с fsync. «После» — UserSettings поверх Database: одно соединение
+в WAL с synchronous=NORMAL в отдельном потоке БД (без кэша в памяти и с ним).
+
+    python benchmarks/bench_db.py [число пользователей] [число операций]
+"""
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from common import import_main
+
+main, workdir = import_main()
+
+DEFAULTS = main.UserSettings.DEFAULT_SETTINGS
+
+
+class LegacySettings:
+    """Прежний доступ: новое соединение на каждый вызов"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE IF NOT EXISTS user_settings (user_id INTEGER PRIMARY KEY, settings TEXT NOT NULL, "
+                     "last_updated DATETIME DEFAULT CURRENT_TIMESTAMP)")
+        conn.commit()
+        conn.close()
+
+    def populate(self, users: int):
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany("INSERT OR REPLACE INTO user_settings (user_id, settings) VALUES (?, ?)",
+                         ((uid, json.dumps(DEFAULTS)) for uid in range(1, users + 1)))
+        conn.commit()
+        conn.close()
+
+    def get_settings(self, user_id):
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute("SELECT settings FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+        conn.close()
+        return {**DEFAULTS, **json.loads(row[0])} if row else dict(DEFAULTS)
+
+    def update_setting(self, user_id, key, value):
+        settings = self.get_settings(user_id)
+        settings[key] = value
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE user_settings SET settings = ?, last_updated = CURRENT_TIMESTAMP WHERE user_id = ?",
+                     (json.dumps(settings), user_id))
+        conn.commit()
+        conn.close()
+        return True
+
+
+def ops_per_sec(count: int, seconds: float) -> str:
+    return f"{count / seconds:>12,.0f} оп/с"
+
+
+async def run_async(func, ids, concurrency: int = 50) -> float:
+    """Запросы идут параллельно, как от разных пользователей в обработчиках"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one(uid):
+        async with semaphore:
+            await func(uid)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_one(uid) for uid in ids))
+    return time.perf_counter() - started
+
+
+def bench(users: int, operations: int):
+    rnd = random.Random(1)
+    read_ids = [rnd.randint(1, users) for _ in range(operations)]
+    write_ids = [rnd.randint(1, users) for _ in range(max(1, operations // 10))]
+
+    legacy = LegacySettings(os.path.join(workdir, "legacy.db"))
+    legacy.populate(users)
+    started = time.perf_counter()
+    for uid in read_ids:
+        legacy.get_settings(uid)
+    legacy_read = time.perf_counter() - started
+    started = time.perf_counter()
+    for uid in write_ids:
+        legacy.update_setting(uid, "preferred_quality", "720p")
+    legacy_write = time.perf_counter() - started
+
+    async def _current():
+        settings = main.UserSettings(os.path.join(workdir, "current.db"), cache_size=0)
+        for uid in range(1, users + 1):
+            await settings.get_settings(uid)
+        read = await run_async(settings.get_settings, read_ids)
+        write = await run_async(lambda uid: settings.update_setting(uid, "preferred_quality", "720p"), write_ids)
+        settings.cache_size = users
+        for uid in range(1, users + 1):
+            await settings.get_settings(uid)
+        cached = await run_async(settings.get_settings, read_ids)
+        return read, write, cached
+
+    read, write, cached = asyncio.run(_current())
+    main.Database.close_all()
+
+    print(f"пользователей: {users}, чтений: {len(read_ids)}, записей: {len(write_ids)}")
+    print(f"чтение, соединение на вызов:   {ops_per_sec(len(read_ids), legacy_read)}")
+    print(f"чтение, общее соединение WAL:  {ops_per_sec(len(read_ids), read)}")
+    print(f"чтение, с кэшем в памяти:      {ops_per_sec(len(read_ids), cached)}")
+    print(f"запись, соединение на вызов:   {ops_per_sec(len(write_ids), legacy_write)}")
+    print(f"запись, общее соединение WAL:  {ops_per_sec(len(write_ids), write)}")
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000,
+          int(sys.argv[2]) if len(sys.argv) > 2 else 20_000)
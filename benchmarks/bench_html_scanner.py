@@ -0,0 +1,172 @@
+"""Разбор страниц TikTok/Instagram: время и пиковая память на страницу.
+
+Прежний способ читает всё тело (resp.text()) и прогоняет регулярки по всему документу;
+HtmlStreamScanner читает кусками и останавливается, как только лучшей находки уже не будет
+(для TikTok — на JSON-LD, иначе дочитывает до лимита в поисках источника приоритетнее).
+Страницы-фикстуры генерируются детерминированно и по структуре повторяют реальные.
+
+    python benchmarks/bench_html_scanner.py
+"""
+import asyncio
+import json
+import re
+
+from common import import_main, peak_memory, timed
+
+main, _ = import_main()
+
+FILLER = '<div class="x-item"><span>' + "lorem ipsum dolor sit amet " * 8 + "</span></div>\n"
+
+
+def _filler(size: int) -> str:
+    return FILLER * (size // len(FILLER) + 1)
+
+
+def _script(payload: dict) -> str:
+    return f'<script type="application/json" data-sjs>{json.dumps(payload)}</script>\n'
+
+
+def tiktok_sigi_page() -> bytes:
+    """SIGI_STATE в начале страницы размером около 3 МБ"""
+    sigi = {"ItemModule": {"7106594312292453675": {"id": "7106594312292453675", "author": "someone"}}}
+    head = '<html><head><meta charset="utf-8"></head><body>' + _filler(200_000)
+    tail = _filler(3_000_000) + "</body></html>"
+    return (head + f'<script id="SIGI_STATE" type="application/json">{json.dumps(sigi)}</script>' + tail).encode()
+
+
+def tiktok_og_page() -> bytes:
+    """Только og:url в head и огромный бандл скриптов после него"""
+    head = ('<html><head><meta property="og:url" '
+            'content="https://www.tiktok.com/@someone/video/7106594312292453675?lang=ru">')
+    return (head + "</head><body>" + _filler(1_500_000) + "</body></html>").encode()
+
+
+def instagram_page() -> bytes:
+    """Много служебных JSON-скриптов, нужный — после первого мегабайта, всего около 5 МБ"""
+    parts = ['<html><head><meta property="og:video" content="https://cdn.example/og.mp4"></head><body>']
+    for i in range(200):
+        parts.append(_script({"require": [["ServerJS", "handle", None, [{"i": i, "data": "x" * 400}]]]}))
+        parts.append(_filler(5_000))
+    parts.append(_script({"items": [{"video_versions": [
+        {"width": 720, "height": 1280, "url": "https://cdn.example/720.mp4"},
+        {"width": 1080, "height": 1920, "url": "https://cdn.example/1080.mp4"},
+    ]}]}))
+    for i in range(200):
+        parts.append(_script({"require": [["Bootloader", "load", None, [{"i": i, "data": "y" * 400}]]]}))
+        parts.append(_filler(15_000))
+    parts.append("</body></html>")
+    return "".join(parts).encode()
+
+
+# ---- прежний разбор по всему документу ----
+LEGACY_INSTAGRAM_PATTERNS = [
+    r'window\.__additionalDataLoaded\([^,]+,\s*({.+?})\);',
+    r'<script type="application/json"[^>]*>(.+?)</script>',
+    r'window\.__initialDataLoaded\([^,]+,\s*({.+?})\);',
+    r'window\.__sharedData\s*=\s*({.+?});',
+    r'window\._sharedData\s*=\s*({.+?});',
+    r'window\.__graphql__\s*=\s*({.+?});',
+]
+
+
+def legacy_instagram(body: bytes):
+    html = body.decode()
+    for pattern in LEGACY_INSTAGRAM_PATTERNS:
+        for match in re.findall(pattern, html, re.DOTALL):
+            try:
+                data = json.loads(match)
+            except json.JSONDecodeError:
+                continue
+            url = main.find_best_video_url(data, "instagram", "best")
+            if url:
+                return url
+    return None
+
+
+def legacy_tiktok(body: bytes):
+    html = body.decode()
+    for m in re.finditer(r'<script[^>]*type=["\']application/ld\+json["\'][^>]*>(.*?)</script>',
+                         html, re.DOTALL | re.IGNORECASE):
+        url = main.tiktok_url_from_jsonld(m.group(1))
+        if url:
+            return url
+    m = re.search(r'<script[^>]*id=["\']SIGI_STATE["\'][^>]*>(.*?)</script>', html, re.DOTALL | re.IGNORECASE)
+    if m:
+        url = main.tiktok_url_from_sigi(m.group(1))
+        if url:
+            return url
+    m = re.search(r'<meta[^>]+property=["\']og:url["\'][^>]+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
+    if m and "/video/" in m.group(1):
+        return main.strip_tracking_params(m.group(1))
+    m = re.search(r'itemId["\']?\s*[:=]\s*["\']?(\d{6,})["\']?', html)
+    if m:
+        return f"https://www.tiktok.com/video/{m.group(1)}"
+    return None
+
+
+# ---- потоковый разбор ----
+class FakeContent:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.consumed = 0
+
+    async def iter_chunked(self, size: int):
+        for start in range(0, len(self.body), size):
+            chunk = self.body[start:start + size]
+            self.consumed += len(chunk)
+            yield chunk
+
+
+class FakeResponse:
+    charset = "utf-8"
+    url = "https://example.invalid/page"
+    last = None  # последний созданный ответ — по нему видно, сколько байт прочитано
+
+    def __init__(self, body: bytes):
+        self.content = FakeContent(body)
+        FakeResponse.last = self
+
+
+def stream_tiktok(body: bytes):
+    return asyncio.run(main.scan_tiktok_video_url(FakeResponse(body)))
+
+
+def stream_instagram(body: bytes):
+    async def _scan():
+        scanner = main.HtmlStreamScanner(main.INSTAGRAM_SCAN_TARGETS, max_bytes=main.INSTAGRAM_SCAN_MAX_BYTES)
+        async for name, blob in scanner.iter_matches(FakeResponse(body)):
+            if name == "og_video":
+                continue
+            try:
+                url = main.find_best_video_url(json.loads(blob), "instagram", "best")
+            except json.JSONDecodeError:
+                continue
+            if url:
+                return url
+        return None
+    return asyncio.run(_scan())
+
+
+CASES = [
+    ("tiktok SIGI_STATE", tiktok_sigi_page, legacy_tiktok, stream_tiktok),
+    ("tiktok og:url", tiktok_og_page, legacy_tiktok, stream_tiktok),
+    ("instagram JSON", instagram_page, legacy_instagram, stream_instagram),
+]
+
+
+def run():
+    print(f"{'страница':<20}{'размер':>10}  {'способ':<10}{'прочитано':>11}{'время, мс':>12}{'пик памяти':>14}"
+          f"  результат")
+    for name, make_page, legacy, stream in CASES:
+        body = make_page()
+        for label, func in (("прежний", legacy), ("потоковый", stream)):
+            seconds = timed(func, body)
+            peak = peak_memory(func, body)
+            result = func(body)
+            read = FakeResponse.last.content.consumed if func is stream else len(body)
+            print(f"{name:<20}{main.format_size(len(body)):>10}  {label:<10}{main.format_size(read):>11}"
+                  f"{seconds * 1000:>12.1f}{main.format_size(peak):>14}  {result}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,147 @@
+"""Задержка запросов истории и кэша на миллионах строк: прежняя схема против текущей.
+
+История: прежняя схема — только составной первичный ключ, страницы через ORDER BY timestamp
+и OFFSET; текущая — схема HistoryManager после всех миграций и постраничный вывод по ключу id
+(HistoryManager._page). Кэш: выборка кандидатов на вытеснение и очистка по last_access
+без индекса и с idx_cache_last_access.
+
+    python benchmarks/bench_schema.py [строк истории] [строк кэша]
+"""
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+from common import import_main
+
+main, workdir = import_main()
+
+USERS = 20_000
+PAGE = 5
+PAGES = (1, 10, 50)  # глубина листания активного пользователя
+SAMPLES = 200
+
+
+def history_rows(count: int, seed: int = 1):
+    """Распределение как в жизни: немногие пользователи скачивают очень много"""
+    rnd = random.Random(seed)
+    started = 1_600_000_000
+    for n in range(count):
+        user_id = int(USERS * rnd.random() ** 3) + 1
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(started + n * 15))
+        yield user_id, f"youtube:{n:011d}", "video" if n % 4 else "audio", stamp
+
+
+def latency(run, args_list) -> str:
+    timings = []
+    for args in args_list:
+        started = time.perf_counter()
+        run(*args)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    return f"p50 {statistics.median(timings):8.3f} мс   p95 {p95:8.3f} мс"
+
+
+def build_legacy_history(path: str, rows: int) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE history (user_id INTEGER NOT NULL, url TEXT NOT NULL, file_type TEXT NOT NULL, "
+                 "timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (user_id, url, file_type))")
+    with conn:
+        conn.executemany("INSERT INTO history VALUES (?, ?, ?, ?)", history_rows(rows))
+    return conn
+
+
+def build_current_history(path: str, rows: int):
+    manager = main.HistoryManager(path)
+    def _fill(conn):
+        with conn:
+            conn.executemany(
+                "INSERT INTO history (user_id, url, file_type, platform, timestamp) VALUES (?, ?, ?, 'YouTube', ?)",
+                history_rows(rows)
+            )
+    manager.db.run_sync(_fill)
+    return manager
+
+
+def page_ids(manager, user_id: int, pages: int) -> list:
+    """id-границы страниц, до которых пользователь долистал бы кнопками"""
+    before, bounds = None, []
+    for _ in range(pages):
+        bounds.append(before)
+        rows, has_older, _ = manager.db.run_sync(manager._page, user_id, before, None, None, PAGE)
+        if not has_older:
+            break
+        before = rows[-1][0]
+    return bounds
+
+
+def bench_history(rows: int):
+    rnd = random.Random(2)
+    users = [int(USERS * rnd.random() ** 3) + 1 for _ in range(SAMPLES)]
+    heavy_user = 1
+
+    started = time.perf_counter()
+    legacy = build_legacy_history(os.path.join(workdir, "history_legacy.db"), rows)
+    print(f"история: {rows:,} строк, прежняя схема заполнена за {time.perf_counter() - started:.1f} с")
+    started = time.perf_counter()
+    current = build_current_history(os.path.join(workdir, "history_current.db"), rows)
+    print(f"история: {rows:,} строк, текущая схема заполнена за {time.perf_counter() - started:.1f} с")
+
+    def legacy_page(user_id, page):
+        return legacy.execute(
+            "SELECT url, file_type, timestamp FROM history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+            (user_id, PAGE, (page - 1) * PAGE)
+        ).fetchall()
+
+    def current_page(user_id, before_id):
+        return current.db.run_sync(current._page, user_id, before_id, None, None, PAGE)
+
+    print(f"  первая страница, прежняя:  {latency(legacy_page, [(u, 1) for u in users])}")
+    print(f"  первая страница, текущая:  {latency(current_page, [(u, None) for u in users])}")
+    bounds = page_ids(current, heavy_user, max(PAGES))
+    for page in PAGES:
+        if page > len(bounds):
+            break
+        print(f"  страница {page:>3} активного пользователя, прежняя: "
+              f"{latency(legacy_page, [(heavy_user, page)] * 20)}")
+        print(f"  страница {page:>3} активного пользователя, текущая: "
+              f"{latency(current_page, [(heavy_user, bounds[page - 1])] * 20)}")
+    legacy.close()
+
+
+def bench_cache(rows: int):
+    rnd = random.Random(3)
+    path = os.path.join(workdir, "cache_bench.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE cache (url TEXT NOT NULL, file_type TEXT NOT NULL, size INTEGER NOT NULL, "
+                 "last_access REAL NOT NULL, hit_count INTEGER NOT NULL, PRIMARY KEY (url, file_type))")
+    with conn:
+        conn.executemany("INSERT INTO cache VALUES (?, ?, ?, ?, ?)", (
+            (f"youtube:{n:011d}", "video", rnd.randint(1, 500) * 1024 * 1024,
+             1_600_000_000 + rnd.random() * 1e7, rnd.randint(0, 50))
+            for n in range(rows)
+        ))
+    cutoffs = [(1_600_000_000 + rnd.random() * 1e5,) for _ in range(50)]
+
+    def evict():
+        return conn.execute("SELECT url, file_type FROM cache ORDER BY last_access LIMIT 64").fetchall()
+
+    def expired(cutoff):
+        return conn.execute("SELECT url, file_type FROM cache WHERE last_access < ? LIMIT 500", (cutoff,)).fetchall()
+
+    print(f"кэш: {rows:,} строк")
+    for label in ("без индекса", "с индексом"):
+        if label == "с индексом":
+            conn.execute("CREATE INDEX idx_cache_last_access ON cache (last_access)")
+        print(f"  вытеснение LRU, {label}: {latency(evict, [()] * 20)}")
+        print(f"  устаревшие,     {label}: {latency(expired, cutoffs)}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    bench_history(int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000)
+    bench_cache(int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000)
+    main.Database.close_all()
@@ -0,0 +1,41 @@
+"""Общая подготовка бенчмарков: импорт main.py во временной папке"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_main():
+    """Импортировать main.py с токеном-заглушкой; возвращает (модуль, рабочая папка).
+    Базы, которые модуль создаёт при импорте, попадают в новую временную папку"""
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    sys.path.insert(0, ROOT)
+    workdir = tempfile.mkdtemp(prefix="downloader-bench-")
+    os.chdir(workdir)
+    import logging
+    logging.disable(logging.INFO)
+    import main
+    return main, workdir
+
+
+def timed(func, *args, repeat: int = 5):
+    """Лучшее время из repeat запусков, сек"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def peak_memory(func, *args) -> int:
+    """Пиковый объём памяти Python за один вызов, байт"""
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
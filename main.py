@@ -18,28 +18,45 @@ import os
 import re
 import json
 import asyncio
+import codecs
+import hashlib
 import tempfile
 import logging
 import shutil
 import time
 import sqlite3
+import threading
 import uuid
 import subprocess
+import sys
 import aiohttp
-from datetime import datetime, timedelta
-from functools import partial
-from typing import Dict, Optional, List, Tuple, Any
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import lru_cache, partial
+from html import escape as html_escape, unescape as html_unescape
+from typing import Callable, Dict, Optional, List, Tuple, Any
 from urllib.parse import urlparse, urlunparse
 import requests
 from dotenv import load_dotenv
 from yt_dlp import YoutubeDL
 from yt_dlp.utils import DownloadError, UnsupportedError
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command, BaseFilter
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.enums import ChatAction
-from aiogram.types import FSInputFile
+from aiogram.methods import (
+    SendAnimation, SendAudio, SendChatAction, SendDocument, SendMediaGroup, SendPhoto, SendVideo, SendVoice
+)
+from aiogram.types import FSInputFile, InputMediaAudio, InputMediaVideo
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 
 # ---- config ----
@@ -51,12 +68,60 @@ if not BOT_TOKEN:
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
+ADMIN_ID = 6143311340  # Замените на ваш ID администратора
+# Спекулятивная подготовка ссылки, пока пользователь выбирает формат
+SPECULATIVE_PREFETCH = os.getenv("SPECULATIVE_PREFETCH", "0") == "1"
+PREFETCH_MAX_BYTES = int(os.getenv("PREFETCH_MAX_MB", "50")) * 1024 * 1024  # Файлы меньше скачиваются заранее
+# Путь к SQLite для сохранения кэша нормализации между перезапусками (пусто — только в памяти)
+NORMALIZE_CACHE_DB = os.getenv("NORMALIZE_CACHE_DB", "")
+# Отложенная запись истории и индекса кэша: интервал сброса (мс) и размер пачки
+WRITE_BEHIND_INTERVAL = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "500")) / 1000
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "200"))
+# Файловый кэш: предельный объём, TTL простоя, политика вытеснения ("lru" или "lfu") и период обхода
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_GB", "10")) * 1024 * 1024 * 1024
+CACHE_TTL = int(os.getenv("CACHE_TTL_HOURS", "6")) * 3600
+CACHE_EVICTION_POLICY = os.getenv("CACHE_EVICTION", "lru").lower()
+CACHE_SWEEP_INTERVAL = int(os.getenv("CACHE_SWEEP_SECONDS", "600"))
+# Холодный уровень кэша: каталог или s3://bucket/prefix (пусто — выключен), endpoint S3-совместимого хранилища, объём
+COLD_TIER = os.getenv("COLD_TIER", "")
+COLD_TIER_ENDPOINT = os.getenv("COLD_TIER_ENDPOINT", "")
+COLD_MAX_BYTES = int(os.getenv("COLD_MAX_GB", "100")) * 1024 * 1024 * 1024
+# Популярность: с какой оценки частоты запись закрепляется в кэше и какую долю объёма могут занять закреплённые
+CACHE_PIN_THRESHOLD = int(os.getenv("CACHE_PIN_THRESHOLD", "30"))
+CACHE_PIN_MAX_SHARE = float(os.getenv("CACHE_PIN_MAX_SHARE", "0.5"))
+# Рассылки: общий лимит сообщений в секунду (Telegram допускает ~30) и число одновременных отправок
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "28"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+# Правки статусных сообщений: общий лимит в секунду и минимальный интервал в личном чате / группе
+EDIT_GLOBAL_RATE = float(os.getenv("EDIT_GLOBAL_RATE", "20"))
+EDIT_CHAT_INTERVAL = float(os.getenv("EDIT_CHAT_INTERVAL", "1.0"))
+EDIT_GROUP_INTERVAL = float(os.getenv("EDIT_GROUP_INTERVAL", "3.0"))
+# Исходящие запросы: общий лимит в секунду, лимит на личный чат и на группу (в минуту), допустимый всплеск
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20"))
+OUTBOUND_BURST = float(os.getenv("OUTBOUND_BURST", "3"))
+# Режим приёма обновлений: polling или webhook (на том же aiohttp-сервере, что и /health)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEB_PORT = int(os.getenv("PORT", "10000"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # внешний адрес; пусто — вебхук устанавливается извне
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Общий для всех экземпляров секрет: по умолчанию выводится из токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONCURRENT = int(os.getenv("WEBHOOK_MAX_CONCURRENT", "64"))  # обновлений в обработке одновременно
+TELEGRAM_API_SERVER = os.getenv("TELEGRAM_API_SERVER", "")  # свой Bot API сервер или локальная заглушка
+
 # ---- bot & dispatcher ----
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)) if TELEGRAM_API_SERVER else None
+)
 dp = Dispatcher()
 
 # ---- state ----
-PENDING_LINKS: Dict[int, str] = {}
+PENDING_LINKS: Dict[int, Tuple[str, float]] = {}  # id сообщения с клавиатурой -> (ссылка, время)
+PENDING_LINKS_EXPIRY = 1800  # Время жизни ссылки, ожидающей выбора формата (30 минут)
+PENDING_BATCHES: Dict[int, Tuple[List[str], float]] = {}  # id сообщения с клавиатурой -> (ссылки пакета, время)
 ACTIVE_DOWNLOADS: Dict[int, Dict[str, Any]] = {}  # Хранит информацию о текущих загрузках
 
 # ---- regex ----
@@ -103,7 +168,7 @@ REDDIT_RE = re.compile(
 
 # регулярные выражения для Pinterest (обновлено!)
 PINTEREST_RE = re.compile(
-    r"(?:https?://)?(?:pinterest\.(?:com|ru|ca|de|fr|jp|uk|it|es|nl|se|pl|br|mx|co\.uk)|pin\.it)/[\w/-]+",
+    r"(?:https?://)?(?:pinterest\.(?:com|ru|ca|de|fr|jp|uk|it|es|nl|se|pl|com\.br|mx|co\.uk)|pin\.it)/[\w/-]+",
     re.IGNORECASE
 )
 
@@ -133,13 +198,13 @@ DIRECT_FILE_RE = re.compile(
     re.IGNORECASE
 )
 
-# короткие/редирект домены (добавлен pin.it)
-SHORTENER_DOMAINS = (
+# короткие/редирект домены (добавлен pin.it); сравниваются с хостом ссылки по суффиксу
+SHORTENER_DOMAINS = frozenset((
     "t.co", "t.me", "bit.ly", "tinyurl.com", "lnkd.in", "goo.gl", "rb.gy",
     "vm.tiktok.com", "vt.tiktok.com", "m.tiktok.com", "www.tiktok.com", "tiktok.com",
     "x.com", "twitter.com", "vk.com", "m.vkvideo.ru", "reddit.com", "pinterest.com", "pin.it",
     "dailymotion.com", "vimeo.com", "soundcloud.com"
-)
+))
 
 # YouTube patterns
 YOUTUBE_VIDEO_RE = re.compile(
@@ -147,6 +212,49 @@ YOUTUBE_VIDEO_RE = re.compile(
     re.IGNORECASE
 )
 
+# ---- batch mode ----
+BATCH_MAX_LINKS = 20      # Максимум ссылок из одного сообщения
+BATCH_PARALLELISM = 3     # Одновременных загрузок внутри пакета
+MEDIA_GROUP_LIMIT = 10    # Ограничение Telegram на размер альбома
+
+# ---- canonical content ids ----
+# (платформа, регулярка с группой id) — по ним разные формы одной ссылки сводятся к ключу "платформа:id"
+CONTENT_ID_PATTERNS: List[Tuple[str, re.Pattern]] = [
+    ("youtube", re.compile(
+        r"(?:youtu\.be/|youtube\.com/(?:watch\?(?:[^#\s]*&)?v=|shorts/|embed/|v/|live/))([\w-]{11})",
+        re.IGNORECASE)),
+    ("tiktok", re.compile(r"tiktok\.com/(?:@[\w\.]*/video/|video/|v/|embed/)(\d+)", re.IGNORECASE)),
+    ("instagram", re.compile(r"instagram\.com/(?:[^/]+/)?(?:p|reels?|tv)/([\w-]+)", re.IGNORECASE)),
+    ("twitter", re.compile(r"(?:twitter\.com|x\.com)/[^/]+/status/(\d+)", re.IGNORECASE)),
+    ("facebook", re.compile(r"facebook\.com/(?:[^/]+/videos/|video\.php\?v=|watch/?\?v=)(\d+)", re.IGNORECASE)),
+    ("vk", re.compile(r"(?:vk\.com|vkvideo\.ru)/(?:[^?#\s]*[?&]z=)?(?:video|clip)(-?\d+_\d+)", re.IGNORECASE)),
+    ("reddit", re.compile(r"reddit\.com/(?:r/[^/]+/)?comments/(\w+)", re.IGNORECASE)),
+    ("pinterest", re.compile(r"pinterest\.[\w.]+/pin/(\d+)", re.IGNORECASE)),
+    ("dailymotion", re.compile(r"dailymotion\.com/(?:embed/)?video/([a-z0-9]+)", re.IGNORECASE)),
+    ("vimeo", re.compile(r"vimeo\.com/(?:[^?#\s]*/)?(\d+)(?:[/?#]|$)", re.IGNORECASE)),
+    ("soundcloud", re.compile(r"soundcloud\.com/([^/?#\s]+/(?:sets/)?[^/?#\s]+)", re.IGNORECASE)),
+]
+
+# Каноническая ссылка для ключа — её показываем в истории
+CANONICAL_URL_TEMPLATES = {
+    "youtube": "https://www.youtube.com/watch?v={id}",
+    "tiktok": "https://www.tiktok.com/@/video/{id}",  # без @ TikTokIE ссылку не принимает
+    "instagram": "https://www.instagram.com/p/{id}/",
+    "twitter": "https://x.com/i/status/{id}",
+    "facebook": "https://www.facebook.com/watch/?v={id}",
+    "vk": "https://vk.com/video{id}",
+    "reddit": "https://www.reddit.com/comments/{id}/",
+    "pinterest": "https://www.pinterest.com/pin/{id}/",
+    "dailymotion": "https://www.dailymotion.com/video/{id}",
+    "vimeo": "https://vimeo.com/{id}",
+    "soundcloud": "https://soundcloud.com/{id}",
+}
+
+# ---- normalization ----
+REDIRECT_TIMEOUT = aiohttp.ClientTimeout(total=6)   # один шаг редиректа (HEAD/GET)
+PAGE_TIMEOUT = aiohttp.ClientTimeout(total=8)       # загрузка HTML страницы для разбора
+NORMALIZE_TOTAL_TIMEOUT = 15                        # общий бюджет нормализации одной ссылки, сек
+
 # ---- yt-dlp base opts ----
 YTDL_BASE_OPTS = {"nocheckcertificate": True, "quiet": True, "no_warnings": True}
 
@@ -379,13 +487,6 @@ class GroupFilter(BaseFilter):
     """
     def __init__(self, bot_username: str):
         self.bot_username = bot_username.lower()
-        # Поддерживаемые домены
-        self.supported_domains = [
-            "tiktok.com", "vm.tiktok.com", "vt.tiktok.com", "m.tiktok.com",
-            "youtube.com", "youtu.be", "instagram.com", "facebook.com",
-            "twitter.com", "x.com", "vk.com", "m.vkvideo.ru", "reddit.com", "pinterest.com", "pin.it",
-            "dailymotion.com", "vimeo.com", "soundcloud.com"
-        ]
 
     def find_first_url(self, text: str) -> Optional[str]:
         if not text:
@@ -394,42 +495,302 @@ class GroupFilter(BaseFilter):
         return m.group(0) if m else None
 
     def is_supported_url(self, url: str) -> bool:
-        if not url:
-            return False
-        url_low = url.lower()
-        return any(domain in url_low for domain in self.supported_domains)
+        return classify_url(url) is not None
 
     async def __call__(self, message: types.Message) -> bool:
         # Личные сообщения всегда обрабатываем
         if message.chat.type == "private":
-            logger.debug(f"Принято личное сообщение от {message.from_user.id}")
+            logger.debug("Принято личное сообщение от %s", message.from_user.id)
             return True
 
         # В групповых чатах проверяем:
         # 1. Является ли сообщение командой бота
         # 2. Содержит ли сообщение ссылку на поддерживаемую платформу
+        text = message.text
+        if not text:
+            return False
 
         # Проверяем, является ли сообщение командой бота
-        if message.text and message.text.startswith("/"):
-            command_parts = message.text.split()
+        if text[0] == "/":
+            command_parts = text.split()
             if command_parts:
                 # Удаляем / и возможное упоминание бота
                 command = command_parts[0][1:].split("@")[0]
                 # Список поддерживаемых команд
-                supported_commands = ["start", "help", "history", "addnews"]
+                supported_commands = ["start", "help", "history", "addnews", "stats"]
                 if command in supported_commands:
-                    logger.debug(f"Найдена поддерживаемая команда в группе от {message.from_user.id}: /{command}")
+                    logger.debug("Найдена поддерживаемая команда в группе от %s: /%s", message.from_user.id, command)
                     return True
 
-        # Проверяем наличие ссылок на поддерживаемые платформы
-        url = self.find_first_url(message.text or "")
-        if url and self.is_supported_url(url):
-            logger.debug(f"Найдена поддерживаемая ссылка в группе от {message.from_user.id}")
-            return True
+        # Дешёвая проверка до регулярок: без "://" в тексте ссылки быть не может
+        if "://" not in text:
+            return False
 
-        logger.debug(f"Игнорируется сообщение в группе от {message.from_user.id} (не команда и не ссылка)")
+        # Проверяем наличие ссылок на поддерживаемые платформы (в сообщении их может быть несколько)
+        for url in find_all_urls(text):
+            if self.is_supported_url(url):
+                logger.debug("Найдена поддерживаемая ссылка в группе от %s", message.from_user.id)
+                return True
         return False
 
+# ===== НЕДАВНИЕ ССЫЛКИ В ЧАТАХ =====
+class RecentChatLinks:
+    """Ссылки, недавно обработанные в чатах: (chat_id, ключ контента) -> (id сообщения, время).
+    Запоминается только сообщение с отправленным файлом, поэтому повтор той же ссылки в окне
+    отвечает ссылкой на готовый результат вместо новой загрузки."""
+    def __init__(self, window: int = 600, max_entries: int = 20000):
+        self.window = window
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[int, float]]" = OrderedDict()
+        self.duplicates = 0
+
+    def lookup(self, chat_id: int, key: str) -> Optional[int]:
+        entry = self._entries.get((chat_id, key))
+        if entry is None:
+            return None
+        message_id, seen_at = entry
+        if time.time() - seen_at > self.window:
+            del self._entries[(chat_id, key)]
+            return None
+        return message_id
+
+    def remember(self, chat_id: int, key: str, message_id: int):
+        self._entries[(chat_id, key)] = (message_id, time.time())
+        self._entries.move_to_end((chat_id, key))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+recent_links = RecentChatLinks(window=int(os.getenv("CHAT_DEDUP_WINDOW", "600")))
+
+# ===== ХРАНИЛИЩЕ SQLITE =====
+class Database:
+    """Одно долгоживущее соединение на файл базы (WAL, synchronous=NORMAL).
+    Запросы выполняются в отдельном потоке БД, чтобы не блокировать event loop."""
+    _instances: Dict[str, "Database"] = {}
+
+    @classmethod
+    def open(cls, path: str) -> "Database":
+        """Общий экземпляр на путь к файлу"""
+        db = cls._instances.get(path)
+        if db is None:
+            db = cls._instances[path] = cls(path)
+        return db
+
+    @classmethod
+    def opened(cls) -> List["Database"]:
+        return list(cls._instances.values())
+
+    @classmethod
+    def close_all(cls):
+        for db in list(cls._instances.values()):
+            db.close()
+        cls._instances.clear()
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db-{os.path.basename(path)}")
+        self._conn: Optional[sqlite3.Connection] = None
+        self.ops = 0
+        self.busy_time = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Соединение создаётся и используется только в потоке БД
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            # Удаление строки при INSERT OR REPLACE должно вызывать триггеры (индексы FTS)
+            conn.execute("PRAGMA recursive_triggers=ON")
+            self._conn = conn
+        return self._conn
+
+    def _call(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(self._connection(), *args)
+        finally:
+            self.ops += 1
+            self.busy_time += time.perf_counter() - started
+
+    async def run(self, fn, *args):
+        """Выполнить fn(conn, *args) в потоке БД"""
+        return await asyncio.wrap_future(self._executor.submit(self._call, fn, *args))
+
+    def run_sync(self, fn, *args):
+        """Синхронный вызов — только для инициализации вне event loop"""
+        return self._executor.submit(self._call, fn, *args).result()
+
+    def submit(self, fn, *args):
+        """Запрос без ожидания результата (фоновая запись)"""
+        return self._executor.submit(self._call, fn, *args)
+
+    def migrate(self, conn: sqlite3.Connection, migrations: list):
+        """Применить недостающие миграции схемы (вызывается в потоке БД).
+        Номер версии хранится в PRAGMA user_version; миграция — кортеж SQL-запросов
+        или функция от соединения, каждая выполняется в своей транзакции вместе с повышением версии."""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            conn.execute("BEGIN")
+            try:
+                if callable(migration):
+                    migration(conn)
+                else:
+                    for sql in migration:
+                        conn.execute(sql)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"{os.path.basename(self.path)}: схема обновлена до версии {number}")
+
+    async def execute(self, sql: str, params=()) -> int:
+        """Изменяющий запрос с фиксацией транзакции, возвращает число строк"""
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self.run(_execute)
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params=()) -> list:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self):
+        def _close(conn):
+            conn.close()
+            self._conn = None
+        if self._conn is not None:
+            self.run_sync(_close)
+        self._executor.shutdown(wait=True)
+
+class WriteBehindQueue:
+    """Отложенная запись: изменения копятся в памяти и фиксируются одной транзакцией
+    раз в interval секунд или по достижении max_rows строк."""
+    ATTEMPTS = 3  # попыток записать пачку, если база занята
+
+    def __init__(self, db: Database, interval: float = 0.5, max_rows: int = 200):
+        self.db = db
+        self.interval = interval
+        self.max_rows = max_rows
+        self._items: List[Tuple[str, tuple, Optional[Callable[[], None]]]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._late_flushes: set = set()
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.rows_failed = 0
+        self.retries = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def enqueue(self, sql: str, params: tuple, on_flushed: Optional[Callable[[], None]] = None):
+        """Поставить запрос в очередь; on_flushed вызывается после попытки записи"""
+        self._items.append((sql, params, on_flushed))
+        if self._closing:
+            # Фоновая задача уже остановлена — дописываем сразу
+            task = asyncio.create_task(self.flush())
+            self._late_flushes.add(task)
+            task.add_done_callback(self._late_flushes.discard)
+            return
+        if len(self._items) >= self.max_rows:
+            self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Записать всё накопленное одной транзакцией"""
+        if not self._items:
+            return
+        batch, self._items = self._items, []
+        started = time.perf_counter()
+        try:
+            for attempt in range(1, self.ATTEMPTS + 1):
+                try:
+                    failed = await self.db.run(self._write_batch, batch)
+                    break
+                except sqlite3.OperationalError as e:
+                    # База занята дольше busy_timeout — пачка откатилась целиком, повторяем её
+                    if attempt == self.ATTEMPTS:
+                        raise
+                    self.retries += 1
+                    logger.warning(f"Отложенная запись в {self.db.path}: {e}, повтор {attempt}")
+                    await asyncio.sleep(self.interval * attempt)
+            self.rows_flushed += len(batch) - failed
+            self.rows_failed += failed
+        except Exception as e:
+            self.rows_failed += len(batch)
+            logger.error(f"Ошибка отложенной записи в {self.db.path} ({len(batch)} строк): {e}")
+        finally:
+            self.last_flush_latency = time.perf_counter() - started
+            self.total_flush_latency += self.last_flush_latency
+            self.flushes += 1
+            for _, _, on_flushed in batch:
+                if on_flushed is not None:
+                    on_flushed()
+
+    @staticmethod
+    def _write_batch(conn, batch) -> int:
+        """Пачка одной транзакцией; строка с ошибкой откатывается до своей точки сохранения,
+        остальные записываются. Возвращает число отброшенных строк"""
+        failed = 0
+        conn.execute("BEGIN")
+        try:
+            for sql, params, _ in batch:
+                conn.execute("SAVEPOINT row")
+                try:
+                    conn.execute(sql, params)
+                except sqlite3.Error as e:
+                    if isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e)):
+                        raise
+                    conn.execute("ROLLBACK TO row")
+                    failed += 1
+                    logger.error(f"Отложенная запись: строка отброшена ({e}): {sql}")
+                conn.execute("RELEASE row")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return failed
+
+    async def close(self):
+        """Остановить фоновую задачу и дописать остаток"""
+        # Не отменяем задачу: прерванный сброс потерял бы уже снятую из очереди пачку
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._late_flushes:
+            await asyncio.gather(*self._late_flushes, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self._items),
+            "flushes": self.flushes,
+            "rows": self.rows_flushed,
+            "failed": self.rows_failed,
+            "retries": self.retries,
+            "last_latency": self.last_flush_latency,
+            "avg_latency": self.total_flush_latency / self.flushes if self.flushes else 0.0,
+        }
+
 # ===== МЕНЕДЖЕР НАСТРОЕК ПОЛЬЗОВАТЕЛЕЙ =====
 class UserSettings:
     DEFAULT_SETTINGS = {
@@ -441,90 +802,191 @@ class UserSettings:
         "language": "ru",
         "notification_level": "important"  # "all", "important", "none"
     }
+    # Порядок полей компактной записи (кортеж) и столбцов таблицы
+    FIELDS = tuple(DEFAULT_SETTINGS)
+    DEFAULT_RECORD = tuple(DEFAULT_SETTINGS.values())
 
-    def __init__(self, db_path="user_settings.db"):
+    def __init__(self, db_path="user_settings.db", cache_size=10000):
         self.db_path = db_path
-        self._init_db()
+        self.db = Database.open(db_path)
+        # LRU декодированных записей: user_id -> кортеж значений в порядке FIELDS
+        self._cache: "OrderedDict[int, tuple]" = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.db.run_sync(self._init_db)
+
+    MIGRATIONS = [
+        (
+            """
+            CREATE TABLE IF NOT EXISTS user_prefs (
+                user_id INTEGER PRIMARY KEY,
+                default_format TEXT NOT NULL,
+                max_concurrent_downloads INTEGER NOT NULL,
+                preferred_quality TEXT NOT NULL,
+                auto_retry INTEGER NOT NULL,
+                trim_enabled INTEGER NOT NULL,
+                language TEXT NOT NULL,
+                notification_level TEXT NOT NULL,
+                last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+        ),
+        (
+            # Пользователи, заблокировавшие бота: рассылки их пропускают
+            """
+            CREATE TABLE IF NOT EXISTS blocked_users (
+                user_id INTEGER PRIMARY KEY,
+                blocked_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+        ),
+        # Выборка получателей рассылки по языку постранично по user_id
+        ("CREATE INDEX IF NOT EXISTS idx_user_prefs_language ON user_prefs (language, user_id)",),
+    ]
 
-    def _init_db(self):
+    def _init_db(self, conn):
         """Инициализация базы данных для настроек пользователей"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_settings (
-            user_id INTEGER PRIMARY KEY,
-            settings TEXT NOT NULL,
-            last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        conn.commit()
-        conn.close()
-
-    def get_settings(self, user_id):
-        """Получает настройки пользователя, создает запись если не существует"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT settings FROM user_settings WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
+        self.db.migrate(conn, self.MIGRATIONS)
+        self._migrate_json_settings(conn)
+
+    def _migrate_json_settings(self, conn):
+        """Однократный перенос настроек из старой таблицы с JSON в столбцы"""
+        legacy = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'user_settings'"
+        ).fetchone()
+        if not legacy or conn.execute("SELECT 1 FROM user_prefs LIMIT 1").fetchone():
+            return
+        rows = []
+        for user_id, raw in conn.execute("SELECT user_id, settings FROM user_settings"):
             try:
-                user_settings = json.loads(result[0])
-                conn.close()
-                return {**self.DEFAULT_SETTINGS, **user_settings}
-            except Exception as e:
-                logger.error(f"Error parsing user settings: {e}")
+                stored = json.loads(raw)
+            except Exception:
+                stored = {}
+            rows.append((user_id, *self._record({**self.DEFAULT_SETTINGS, **stored})))
+        with conn:
+            conn.executemany(self._upsert_sql(), rows)
+        logger.info(f"Настройки {len(rows)} пользователей перенесены в user_prefs")
+
+    def _record(self, settings: Dict[str, Any]) -> tuple:
+        return tuple(settings.get(field, default) for field, default in self.DEFAULT_SETTINGS.items())
+
+    def _upsert_sql(self) -> str:
+        columns = ", ".join(self.FIELDS)
+        marks = ", ".join("?" for _ in range(len(self.FIELDS) + 1))
+        return f"INSERT OR REPLACE INTO user_prefs (user_id, {columns}) VALUES ({marks})"
+
+    def _remember(self, user_id: int, record: tuple):
+        self._cache[user_id] = record
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """Сбросить запись пользователя в памяти (например, после правки базы извне)"""
+        self._cache.pop(user_id, None)
+
+    def invalidate_all(self):
+        self._cache.clear()
+
+    async def get_settings(self, user_id):
+        """Получает настройки пользователя, создает запись если не существует"""
+        record = self._cache.get(user_id)
+        if record is not None:
+            self._cache.move_to_end(user_id)
+            self.hits += 1
         else:
-            # Создаем новую запись с настройками по умолчанию
-            try:
-                cursor.execute(
-                    "INSERT INTO user_settings (user_id, settings) VALUES (?, ?)",
-                    (user_id, json.dumps(self.DEFAULT_SETTINGS))
-                )
-                conn.commit()
-            except Exception as e:
-                logger.error(f"Error creating user settings: {e}")
-            finally:
-                conn.close()
-        return self.DEFAULT_SETTINGS.copy()
+            self.misses += 1
+            record = await self.db.run(self._load_record, user_id)
+            self._remember(user_id, record)
+        return dict(zip(self.FIELDS, record))
+
+    def _load_record(self, conn, user_id) -> tuple:
+        columns = ", ".join(self.FIELDS)
+        row = conn.execute(f"SELECT {columns} FROM user_prefs WHERE user_id = ?", (user_id,)).fetchone()
+        if row:
+            return tuple(
+                bool(value) if isinstance(default, bool) else value
+                for value, default in zip(row, self.DEFAULT_RECORD)
+            )
+        # Создаем новую запись с настройками по умолчанию
+        try:
+            with conn:
+                conn.execute(self._upsert_sql(), (user_id, *self.DEFAULT_RECORD))
+        except Exception as e:
+            logger.error(f"Error creating user settings: {e}")
+        return self.DEFAULT_RECORD
 
-    def update_setting(self, user_id, key, value):
-        """Обновляет одну настройку пользователя"""
+    async def update_setting(self, user_id, key, value):
+        """Обновляет одну настройку пользователя (запись сразу в базу и в память)"""
         if key not in self.DEFAULT_SETTINGS:
             return False
-        settings = self.get_settings(user_id)
-        settings[key] = value
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         try:
-            cursor.execute(
-                "INSERT OR REPLACE INTO user_settings (user_id, settings) VALUES (?, ?)",
-                (user_id, json.dumps(settings))
-            )
-            conn.commit()
-            return True
+            record = await self.db.run(self._update_setting, user_id, key, value)
         except Exception as e:
             logger.error(f"Error updating user setting: {e}")
+            self.invalidate(user_id)
             return False
-        finally:
-            conn.close()
-            
-    def get_all_user_ids(self) -> List[int]:
-        """Получает список всех пользователей, которые использовали бота"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT DISTINCT user_id FROM user_settings")
-            result = cursor.fetchall()
-            return [row[0] for row in result]
-        except Exception as e:
-            logger.error(f"Error getting all user IDs: {e}")
-            return []
-        finally:
-            conn.close()
+        # В память — именно то, что записано (с учётом параллельных правок других полей)
+        self._remember(user_id, record)
+        return True
+
+    def _update_setting(self, conn, user_id, key, value) -> tuple:
+        # Чтение и запись в одном вызове потока БД — без гонок между обработчиками:
+        # меняется только один столбец, остальные поля остаются такими, какие они в базе
+        self._load_record(conn, user_id)
+        with conn:
+            conn.execute(
+                f"UPDATE user_prefs SET {key} = ?, last_updated = CURRENT_TIMESTAMP WHERE user_id = ?",
+                (value, user_id)
+            )
+        return self._load_record(conn, user_id)
+
+    async def mark_blocked(self, user_id: int):
+        """Пользователь заблокировал бота — исключить из рассылок"""
+        await self.db.execute("INSERT OR IGNORE INTO blocked_users (user_id) VALUES (?)", (user_id,))
+
+    async def unmark_blocked(self, user_id: int):
+        await self.db.execute("DELETE FROM blocked_users WHERE user_id = ?", (user_id,))
+
+    @staticmethod
+    def _recipients_filter(language: Optional[str]) -> Tuple[str, tuple]:
+        sql = "user_id > ? AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = user_prefs.user_id)"
+        if language:
+            return sql + " AND language = ?", (language,)
+        return sql, ()
+
+    async def iter_user_ids(self, after_id: int = 0, language: Optional[str] = None, chunk_size: int = 500):
+        """Пользователи бота (кроме заблокировавших его) пачками по возрастанию id.
+        Страницы выбираются по ключу user_id, в памяти только текущая пачка."""
+        where, extra = self._recipients_filter(language)
+        sql = f"SELECT user_id FROM user_prefs WHERE {where} ORDER BY user_id LIMIT ?"
+        while True:
+            rows = await self.db.fetchall(sql, (after_id, *extra, chunk_size))
+            if not rows:
+                return
+            chunk = [row[0] for row in rows]
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after_id = chunk[-1]
+
+    async def count_user_ids(self, after_id: int = 0, language: Optional[str] = None) -> int:
+        where, extra = self._recipients_filter(language)
+        row = await self.db.fetchone(f"SELECT COUNT(*) FROM user_prefs WHERE {where}", (after_id, *extra))
+        return row[0]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
 
 # Инициализация менеджера настроек
-user_settings = UserSettings()
+user_settings = UserSettings(cache_size=int(os.getenv("SETTINGS_CACHE_SIZE", "10000")))
 
 # ===== НОВЫЕ КЛАССЫ ДЛЯ УПРАВЛЕНИЯ ЗАГРУЗКАМИ =====
 class DownloadManager:
@@ -535,6 +997,10 @@ class DownloadManager:
         self.lock = asyncio.Lock()
         self.processing = 0
         self.task_counter = 0
+        # (ключ контента, режим) -> future активной загрузки; повторные запросы ждут её
+        self.inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.audio_derived = 0  # сколько аудио извлечено из кэшированного видео
+        self._batches: set = set()  # задачи пакетных загрузок (ссылки держим до завершения)
         asyncio.create_task(self._process_queue())
 
     async def _process_queue(self):
@@ -587,13 +1053,39 @@ class DownloadManager:
 
     async def _handle_download(self, callback_query: types.CallbackQuery, url: str, mode: str, user_id: int, task_id: int):
         """Обработка отдельной загрузки (исправленная версия)"""
+        flight_key = None
         try:
+            key = content_key(url)
+            cache_manager.record_request(key)
             # Проверяем кэш перед началом загрузки
-            cached_file = cache_manager.get_cached_file(url, mode)
+            cached_file = await cache_manager.get_cached_file(key, mode)
             if cached_file:
-                await self._send_cached_file(callback_query, cached_file, mode)
+                await self._send_cached_file(callback_query, cached_file, mode, url)
                 return
 
+            # Этот же контент уже качается — ждём и отдаём результат из кэша
+            inflight = self.inflight.get((key, mode))
+            if inflight is not None:
+                await asyncio.shield(inflight)
+                cached_file = await cache_manager.get_cached_file(content_key(url), mode)
+                if cached_file:
+                    await self._send_cached_file(callback_query, cached_file, mode, url)
+                    return
+            if (key, mode) not in self.inflight:
+                flight_key = (key, mode)
+                self.inflight[flight_key] = asyncio.get_running_loop().create_future()
+
+            # Аудио из уже скачанного видео того же контента — без обращения к сети
+            if mode == "audio":
+                audio_dir = tempfile.mkdtemp(prefix="tgdl_audio_")
+                try:
+                    derived = await self._derive_audio_from_cache(key, audio_dir)
+                    if derived:
+                        await self._send_cached_file(callback_query, derived, mode, url)
+                        return
+                finally:
+                    shutil.rmtree(audio_dir, ignore_errors=True)
+
             # Если нет в кэше, начинаем загрузку
             target_chat_id = callback_query.message.chat.id
             status_msg = await bot.send_message(
@@ -618,63 +1110,45 @@ class DownloadManager:
             # Проверяем свободное место на диске
             if not has_enough_disk_space(tempdir, required_mb=500):
                 try:
-                    await bot.edit_message_text(
-                        chat_id=target_chat_id,
-                        message_id=status_msg.message_id,
-                        text="⚠️ На сервере недостаточно места для загрузки. Попробуйте позже."
+                    await status_editor.edit(
+                        target_chat_id, status_msg.message_id,
+                        "⚠️ На сервере недостаточно места для загрузки. Попробуйте позже.",
+                        final=True
                     )
                 except Exception:
                     # fallback
                     await callback_query.message.answer("⚠️ На сервере недостаточно места для загрузки. Попробуйте позже.")
                 return
 
-            # Проверяем, не слишком ли большой файл (ограничение 1 ГБ)
+            # Проверяем, не слишком ли большой файл (лимит платформы, по умолчанию 1 ГБ)
+            platform = classify_url(url)
+            max_filesize = platform.max_filesize if platform is not None else 1024 * 1024 * 1024
             try:
-                head = requests.head(url, timeout=10)
-                if 'content-length' in head.headers:
-                    content_length = int(head.headers['content-length'])
-                    if content_length > 1024 * 1024 * 1024:  # 1 ГБ
-                        await bot.edit_message_text(
-                            chat_id=target_chat_id,
-                            message_id=status_msg.message_id,
-                            text=f"❌ Файл слишком большой ({content_length/(1024*1024):.1f} MB). "
-                                f"Максимальный размер: 1 ГБ."
-                        )
-                        ACTIVE_DOWNLOADS[task_id]["status"] = "failed"
-                        return
+                # Оценка из спекулятивной подготовки, иначе HEAD по ссылке
+                content_length = prefetch_manager.estimated_size(url, mode)
+                if content_length is None:
+                    async with get_http_session().head(url, timeout=REDIRECT_TIMEOUT) as head:
+                        if head.content_length is not None:
+                            content_length = head.content_length
+                if content_length and content_length > max_filesize:
+                    await status_editor.edit(
+                        target_chat_id, status_msg.message_id,
+                        f"❌ Файл слишком большой ({format_size(content_length)}). "
+                        f"Максимальный размер: {format_size(max_filesize)}.",
+                        final=True
+                    )
+                    ACTIVE_DOWNLOADS[task_id]["status"] = "failed"
+                    return
             except Exception as e:
                 logger.warning(f"Не удалось определить размер файла: {e}")
 
             # Выполняем скачивание (единую логику для direct / instagram / yt-dlp)
             try:
-                if DIRECT_FILE_RE.search(url):
-                    # прямая ссылка на файл
-                    try:
-                        await bot.edit_message_text(
-                            chat_id=target_chat_id,
-                            message_id=status_msg.message_id,
-                            text="📥 Обнаружена прямая ссылка на файл. Начинаю загрузку..."
-                        )
-                    except Exception:
-                        pass
-                    # _download_direct_file у вас определён как async
-                    filepath = await self._download_direct_file(url, tempdir)
-                elif "instagram.com" in url.lower():
-                    try:
-                        await bot.edit_message_text(
-                            chat_id=target_chat_id,
-                            message_id=status_msg.message_id,
-                            text="📥 Скачиваю видео с Instagram..."
-                        )
-                    except Exception:
-                        pass
-                    # скачиваем в потоковом исполнении, т.к. download_instagram_video блокирующая
-                    async with aiohttp.ClientSession() as session:
-                        filepath = await download_instagram_video_async(url, tempdir, mode, session=session)
-                else:
-                    # Используем yt-dlp для всех остальных платформ (с прогресс-хуком)
-                    func = partial(ytdl_download, url, tempdir, mode, progress_hook)
-                    filepath = await asyncio.wait_for(loop.run_in_executor(None, func), timeout=420)
+                filepath = await self._download_to(
+                    url, tempdir, mode, progress_hook,
+                    chat_id=target_chat_id, status_msg_id=status_msg.message_id,
+                    quality=(await user_settings.get_settings(user_id))["preferred_quality"]
+                )
 
                 # Проверяем, что файл получен
                 if not filepath or not os.path.exists(filepath):
@@ -684,15 +1158,21 @@ class DownloadManager:
                 ACTIVE_DOWNLOADS[task_id]["filepath"] = filepath
                 ACTIVE_DOWNLOADS[task_id]["status"] = "saving"
 
+                # Ключ мог уточниться по ответу yt-dlp
+                key = content_key(url)
+
                 # Сохраняем в кэш (не критично — если упадёт, просто логируем)
                 try:
-                    cache_manager.add_to_cache(url, filepath, mode)
+                    await cache_manager.add_to_cache(key, filepath, mode)
                 except Exception as e:
                     logger.warning(f"Не удалось добавить в кэш: {e}")
 
                 # Добавляем в историю (не критично)
                 try:
-                    history_manager.add_to_history(user_id, url, mode)
+                    await history_manager.add_to_history(
+                        user_id, canonical_url(key, url), mode,
+                        title=os.path.splitext(os.path.basename(filepath))[0]
+                    )
                 except Exception as e:
                     logger.warning(f"Не удалось добавить в историю: {e}")
 
@@ -722,70 +1202,300 @@ class DownloadManager:
                 pass
 
         finally:
-            # Удаляем задачу из активных
-            async with self.lock:
-                if user_id in self.active_tasks:
-                    if task_id in self.active_tasks[user_id]:
-                        self.active_tasks[user_id].remove(task_id)
-                    if not self.active_tasks[user_id]:
-                        del self.active_tasks[user_id]
-                # Защита от отрицательных значений
-                if self.processing > 0:
-                    self.processing -= 1
-                # Удаляем информацию о загрузке
-                if task_id in ACTIVE_DOWNLOADS:
-                    del ACTIVE_DOWNLOADS[task_id]
-
-
-    async def _download_direct_file(self, url: str, tempdir: str) -> str:
-        """Скачивание прямой ссылки на файл"""
-        filename = os.path.basename(urlparse(url).path) or "downloaded_file"
-        if not any(filename.endswith(ext) for ext in [".mp4", ".mp3", ".mkv", ".webm", ".avi", ".mov", ".wmv", ".flv", ".m4a", ".wav", ".aac", ".ogg"]):
-            filename += ".mp4"  # Добавляем расширение по умолчанию
-        
-        filepath = os.path.join(tempdir, filename)
-        
-        # Скачиваем файл
-        with requests.get(url, stream=True, timeout=300) as r:
-            r.raise_for_status()
-            with open(filepath, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        
-        return filepath
+            if flight_key is not None:
+                self.inflight.pop(flight_key).set_result(None)
+            await self._release_task(user_id, task_id)
+
+    async def _derive_audio_from_cache(self, key: str, out_dir: str) -> Optional[str]:
+        """Получить mp3 из закэшированного видео того же контента и закэшировать как аудио.
+        Если кэш файл не принял, возвращается сам mp3 в out_dir (папку удаляет вызывающий)."""
+        video_path = await cache_manager.get_cached_file(key, "video")
+        if not video_path:
+            return None
+        video_name = cache_manager.file_name(key, "video") or os.path.basename(video_path)
+        audio_path = os.path.join(out_dir, os.path.splitext(video_name)[0] + ".mp3")
+        if not await extract_audio_track(video_path, audio_path):
+            if os.path.exists(audio_path):
+                os.remove(audio_path)
+            return None
+        self.audio_derived += 1
+        logger.info(f"Аудио получено из кэшированного видео: {key}")
+        if await cache_manager.add_to_cache(key, audio_path, "audio"):
+            return await cache_manager.get_cached_file(key, "audio", touch=False) or audio_path
+        return audio_path
+
+    async def _release_task(self, user_id: int, task_id: int):
+        """Удаляет задачу из активных"""
+        async with self.lock:
+            if user_id in self.active_tasks:
+                if task_id in self.active_tasks[user_id]:
+                    self.active_tasks[user_id].remove(task_id)
+                if not self.active_tasks[user_id]:
+                    del self.active_tasks[user_id]
+            # Защита от отрицательных значений
+            if self.processing > 0:
+                self.processing -= 1
+            # Удаляем информацию о загрузке
+            if task_id in ACTIVE_DOWNLOADS:
+                del ACTIVE_DOWNLOADS[task_id]
+
+    async def _download_to(self, url: str, tempdir: str, mode: str, progress_hook=None,
+                           chat_id: Optional[int] = None, status_msg_id: Optional[int] = None,
+                           quality: str = "best") -> Optional[str]:
+        """Скачивание одной ссылки в tempdir через цепочку стратегий платформы.
+        Если передан status_msg_id — сообщение статуса обновляется по ходу."""
+        async def _status(text: str):
+            if status_msg_id is None:
+                return
+            status_editor.submit(chat_id, status_msg_id, text)
+
+        ctx = ExtractContext(url, tempdir, mode, quality, progress_hook, _status)
+        return await extractor_registry.run(ctx)
 
     async def add_download(self, callback_query: types.CallbackQuery, url: str, mode: str):
         """Добавить загрузку в очередь"""
         await self.queue.put((callback_query, url, mode))
         return True
 
-    async def _send_cached_file(self, callback_query: types.CallbackQuery, file_path: str, mode: str):
+    async def add_batch(self, callback_query: types.CallbackQuery, urls: List[str], mode: str):
+        """Добавить пакет ссылок одной задачей"""
+        task = asyncio.create_task(self._handle_batch(callback_query, urls, mode))
+        self._batches.add(task)
+        task.add_done_callback(self._batch_finished)
+        return True
+
+    def _batch_finished(self, task: asyncio.Task):
+        self._batches.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Пакетная загрузка прервана: {task.exception()}")
+
+    async def _handle_batch(self, callback_query: types.CallbackQuery, urls: List[str], mode: str):
+        """Пакетная загрузка: ограниченный параллелизм, один общий статус и отправка альбомами"""
+        user_id = callback_query.from_user.id
+        target_chat_id = callback_query.message.chat.id
+
+        # Весь пакет считается одной загрузкой в лимите пользователя
+        async with self.lock:
+            if len(self.active_tasks.get(user_id, ())) >= self.max_concurrent:
+                await callback_query.message.answer(
+                    "Вы достигли лимита одновременных загрузок (3). "
+                    "Пожалуйста, дождитесь завершения текущих загрузок."
+                )
+                return
+            self.task_counter += 1
+            task_id = self.task_counter
+            self.active_tasks.setdefault(user_id, []).append(task_id)
+            self.processing += 1
+
+        ACTIVE_DOWNLOADS[task_id] = {
+            "callback_query": callback_query,
+            "url": urls[0],
+            "urls": urls,
+            "mode": mode,
+            "user_id": user_id,
+            "status": "processing",
+            "start_time": time.time()
+        }
+
+        total = len(urls)
+        done = 0
+        failed: List[str] = []
+        batch_dir = None
+        try:
+            status_msg = await bot.send_message(
+                target_chat_id,
+                f"📦 Пакетная загрузка: 0/{total}\n(Загрузка #{task_id})"
+            )
+            ACTIVE_DOWNLOADS[task_id]["status_msg_id"] = status_msg.message_id
+            ACTIVE_DOWNLOADS[task_id]["status"] = "downloading"
+            batch_dir = tempfile.mkdtemp(prefix="tgdl_batch_")
+            quality = (await user_settings.get_settings(user_id))["preferred_quality"]
+            semaphore = asyncio.Semaphore(BATCH_PARALLELISM)
+
+            def _progress():
+                text = f"📦 Пакетная загрузка: {done}/{total}"
+                if failed:
+                    text += f", ошибок: {len(failed)}"
+                status_editor.submit(target_chat_id, status_msg.message_id, f"{text}\n(Загрузка #{task_id})")
+
+            async def _fetch(index: int, url: str) -> Optional[str]:
+                nonlocal done
+                async with semaphore:
+                    flight_key = None
+                    try:
+                        key = content_key(url)
+                        cache_manager.record_request(key)
+                        path = await cache_manager.get_cached_file(key, mode)
+                        # Этот же контент уже качается другой загрузкой — ждём её результат в кэше
+                        inflight = None if path else self.inflight.get((key, mode))
+                        if inflight is not None:
+                            await asyncio.shield(inflight)
+                            path = await cache_manager.get_cached_file(key, mode)
+                        if not path and (key, mode) not in self.inflight:
+                            flight_key = (key, mode)
+                            self.inflight[flight_key] = asyncio.get_running_loop().create_future()
+                        item_dir = os.path.join(batch_dir, str(index))
+                        if not path and mode == "audio":
+                            os.makedirs(item_dir, exist_ok=True)
+                            path = await self._derive_audio_from_cache(key, item_dir)
+                        if not path:
+                            os.makedirs(item_dir, exist_ok=True)
+                            path = await self._download_to(url, item_dir, mode, quality=quality)
+                            if not path or not os.path.exists(path):
+                                raise FileNotFoundError("Файл не найден после загрузки.")
+                            try:
+                                await cache_manager.add_to_cache(key, path, mode)
+                            except Exception as e:
+                                logger.warning(f"Не удалось добавить в кэш: {e}")
+                        try:
+                            name = cache_manager.file_name(key, mode) or os.path.basename(path)
+                            await history_manager.add_to_history(
+                                user_id, canonical_url(key, url), mode, title=os.path.splitext(name)[0]
+                            )
+                        except Exception as e:
+                            logger.warning(f"Не удалось добавить в историю: {e}")
+                        return path
+                    except Exception as e:
+                        logger.warning(f"Пакетная загрузка #{task_id}: ошибка для {url}: {e}")
+                        failed.append(url)
+                        return None
+                    finally:
+                        if flight_key is not None:
+                            self.inflight.pop(flight_key).set_result(None)
+                        done += 1
+                        _progress()
+
+            paths = await asyncio.gather(*(_fetch(i, u) for i, u in enumerate(urls)))
+            ready = [(u, p) for u, p in zip(urls, paths) if p]
+
+            ACTIVE_DOWNLOADS[task_id]["status"] = "sending"
+            if ready:
+                await self._send_batch(target_chat_id, ready, mode)
+
+            report = f"✅ Пакет готов: отправлено {len(ready)} из {total}."
+            if failed:
+                report += "\n❌ Не удалось скачать:\n" + "\n".join(f"• {u}" for u in failed)
+            await status_editor.edit(
+                target_chat_id, status_msg.message_id,
+                report,
+                final=True,
+                disable_web_page_preview=True
+            )
+            ACTIVE_DOWNLOADS[task_id]["status"] = "done"
+        except Exception as e:
+            logger.exception("Ошибка пакетной загрузки")
+            try:
+                await callback_query.message.answer(f"Ошибка пакетной загрузки: {str(e)}")
+            except Exception:
+                pass
+        finally:
+            try:
+                if batch_dir and os.path.isdir(batch_dir):
+                    shutil.rmtree(batch_dir)
+            except Exception:
+                pass
+            await self._release_task(user_id, task_id)
+
+    async def _send_batch(self, chat_id: int, items: List[Tuple[str, str]], mode: str):
+        """Отправка результатов пакета альбомами по MEDIA_GROUP_LIMIT файлов"""
+        small: List[Tuple[str, str]] = []
+        for url, path in items:
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+            if size_mb <= 48:
+                small.append((url, path))
+                continue
+            # Большие файлы в альбом не попадают — отдаём ссылкой
+            link = await upload_to_multiple_services(path)
+            if link:
+                text = f"Файл превышает лимит Telegram ({size_mb:.1f} MB).\nСсылка: {link}\n🔗 Оригинальная ссылка: {url}"
+            else:
+                text = f"Не удалось загрузить файл ({size_mb:.1f} MB) ни на один сервис.\n🔗 Оригинальная ссылка: {url}"
+            await bot.send_message(chat_id, text, disable_web_page_preview=True)
+
+        action = ChatAction.UPLOAD_DOCUMENT if mode == "audio" else ChatAction.UPLOAD_VIDEO
+        media_cls = InputMediaAudio if mode == "audio" else InputMediaVideo
+        for start in range(0, len(small), MEDIA_GROUP_LIMIT):
+            chunk = small[start:start + MEDIA_GROUP_LIMIT]
+            await bot.send_chat_action(chat_id, action=action)
+            if len(chunk) == 1:
+                # Альбом из одного элемента Telegram не принимает
+                url, path = chunk[0]
+                caption = f"📌 Источник: {detect_source(url)}\n🔗 {url}"
+                if mode == "audio":
+                    await bot.send_audio(chat_id, FSInputFile(path), caption=caption)
+                else:
+                    await bot.send_video(chat_id, FSInputFile(path), caption=caption)
+                continue
+            media = [
+                media_cls(media=FSInputFile(path), caption=f"📌 Источник: {detect_source(url)}\n🔗 {url}")
+                for url, path in chunk
+            ]
+            await bot.send_media_group(chat_id, media=media)
+
+    @staticmethod
+    def _sent_file_id(sent: types.Message) -> Optional[str]:
+        media = sent.video or sent.audio or sent.document
+        return media.file_id if media else None
+
+    async def resend(self, callback_query: types.CallbackQuery, url: str, mode: str,
+                     file_id: Optional[str] = None, title: Optional[str] = None):
+        """Повторная отправка из истории: кэш, затем file_id Telegram, и только потом новая загрузка"""
+        # Запрос учитывается здесь, только если до новой загрузки (она учтёт его сама) не дойдёт
+        cached_file = await cache_manager.get_cached_file(content_key(url), mode)
+        if cached_file:
+            cache_manager.record_request(content_key(url))
+            await self._send_cached_file(callback_query, cached_file, mode, url)
+            return
+        if file_id:
+            target_chat_id = callback_query.message.chat.id
+            try:
+                if mode == "audio":
+                    await bot.send_audio(target_chat_id, file_id, caption=title)
+                else:
+                    await bot.send_video(target_chat_id, file_id, caption=title)
+                cache_manager.record_request(content_key(url))
+                await history_manager.add_to_history(callback_query.from_user.id, url, mode, title, file_id)
+                return
+            except TelegramBadRequest as e:
+                logger.warning(f"file_id из истории недействителен, загружаю заново: {e}")
+        await self.add_download(callback_query, url, mode)
+
+    async def _send_cached_file(self, callback_query: types.CallbackQuery, file_path: str, mode: str, url: str):
         """Отправка файла из кэша"""
         try:
             target_chat_id = callback_query.message.chat.id
             await callback_query.message.answer("Найдено в кэше, отправляю...")
+            # В хранилище файл назван по хэшу — подписываем исходным именем
+            file_name = cache_manager.file_name(content_key(url), mode) or os.path.basename(file_path)
             if mode == "audio":
                 await bot.send_chat_action(target_chat_id, action=ChatAction.UPLOAD_DOCUMENT)
-                audio = FSInputFile(file_path)
-                await bot.send_audio(
+                audio = FSInputFile(file_path, filename=file_name)
+                sent = await bot.send_audio(
                     target_chat_id,
                     audio,
-                    caption=f"{os.path.basename(file_path)}"
+                    caption=file_name
                 )
             else:
                 await bot.send_chat_action(target_chat_id, action=ChatAction.UPLOAD_VIDEO)
-                video = FSInputFile(file_path)
-                await bot.send_video(
+                video = FSInputFile(file_path, filename=file_name)
+                sent = await bot.send_video(
                     target_chat_id,
                     video,
-                    caption=f"{os.path.basename(file_path)}"
+                    caption=file_name
                 )
+            recent_links.remember(target_chat_id, content_key(url), sent.message_id)
+            # Отдача из кэша — тоже загрузка для пользователя: в историю вместе с file_id
+            key = content_key(url)
+            await history_manager.add_to_history(
+                callback_query.from_user.id, canonical_url(key, url), mode,
+                title=os.path.splitext(file_name)[0], file_id=self._sent_file_id(sent)
+            )
         except Exception as e:
             logger.error(f"Ошибка при отправке кэшированного файла: {e}")
             # Если кэшированный файл поврежден, удаляем его из кэша
-            cache_manager.remove_from_cache(file_path)
+            await cache_manager.remove_from_cache(file_path)
             # И пробуем загрузить заново
-            await self.add_download(callback_query, callback_query.message.text, mode)
+            await self.add_download(callback_query, url, mode)
 
     async def _send_file(self, callback_query: types.CallbackQuery, url: str, filepath: str, mode: str, status_msg_id: int):
         """Отправка файла после загрузки с указанием источника и ссылки"""
@@ -799,71 +1509,41 @@ class DownloadManager:
             retry_kb = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="🔄 Повторить загрузку", callback_data=f"retry:{mode}:{retry_id}")]
             ])
-            await bot.edit_message_text(
-                chat_id=target_chat_id,
-                message_id=status_msg_id,
-                text="Отправляю файл..."
-            )
+            status_editor.submit(target_chat_id, status_msg_id, "Отправляю файл...")
             stat = os.stat(filepath)
             size_mb = stat.st_size / (1024 * 1024)
             # Определяем источник видео
-            source = "Неизвестно"
-            url_low = url.lower()
-            if "youtube.com" in url_low or "youtu.be" in url_low:
-                source = "YouTube"
-            elif "tiktok.com" in url_low:
-                source = "TikTok"
-            elif "instagram.com" in url_low:
-                source = "Instagram"
-            elif "facebook.com" in url_low:
-                source = "Facebook"
-            elif "twitter.com" in url_low or "x.com" in url_low:
-                source = "Twitter/X"
-            elif "vk.com" in url_low or "m.vkvideo.ru" in url_low:
-                source = "VK"
-            elif "reddit.com" in url_low:
-                source = "Reddit"
-            elif "pinterest.com" in url_low or "pin.it" in url_low:
-                source = "Pinterest"
-            elif "dailymotion.com" in url_low:
-                source = "Dailymotion"
-            elif "vimeo.com" in url_low:
-                source = "Vimeo"
-            elif "soundcloud.com" in url_low:
-                source = "SoundCloud"
-            elif DIRECT_FILE_RE.search(url):
-                source = "Прямая ссылка"
+            source = detect_source(url)
 
             if size_mb > 48:
-                await bot.edit_message_text(
-                    chat_id=target_chat_id,
-                    message_id=status_msg_id,
-                    text=f"Файл большой ({size_mb:.1f} MB). Загружаю на облачный сервис..."
+                status_editor.submit(
+                    target_chat_id, status_msg_id,
+                    f"Файл большой ({size_mb:.1f} MB). Загружаю на облачный сервис..."
                 )
                 link = await upload_to_multiple_services(filepath)
                 if link:
-                    await bot.edit_message_text(
-                        chat_id=target_chat_id,
-                        message_id=status_msg_id,
-                        text=(
+                    await status_editor.edit(
+                        target_chat_id, status_msg_id,
+                        (
                             f"Файл превышает лимит Telegram ({size_mb:.1f} MB).\n"
                             f"Ссылка: {link}\n"
                             f"📌 Источник: {source}\n"
                             f"🔗 Оригинальная ссылка: {url}"
                         ),
+                        final=True,
                         reply_markup=retry_kb,
                         disable_web_page_preview=True
                     )
                 else:
-                    await bot.edit_message_text(
-                        chat_id=target_chat_id,
-                        message_id=status_msg_id,
-                        text=(
+                    await status_editor.edit(
+                        target_chat_id, status_msg_id,
+                        (
                             f"Не удалось загрузить файл ни на один сервис.\n"
                             f"Попробуйте позже или используйте другой источник.\n"
                             f"📌 Источник: {source}\n"
                             f"🔗 Оригинальная ссылка: {url}"
                         ),
+                        final=True,
                         reply_markup=retry_kb,
                         disable_web_page_preview=True
                     )
@@ -872,7 +1552,7 @@ class DownloadManager:
                 if mode == "audio":
                     await bot.send_chat_action(target_chat_id, action=ChatAction.UPLOAD_DOCUMENT)
                     audio = FSInputFile(filepath)
-                    await bot.send_audio(
+                    sent = await bot.send_audio(
                         target_chat_id,
                         audio,
                         caption=caption
@@ -880,29 +1560,31 @@ class DownloadManager:
                 else:
                     await bot.send_chat_action(target_chat_id, action=ChatAction.UPLOAD_VIDEO)
                     video = FSInputFile(filepath)
-                    await bot.send_video(
+                    sent = await bot.send_video(
                         target_chat_id,
                         video,
                         caption=caption
                     )
-                await bot.edit_message_text(
-                    chat_id=target_chat_id,
-                    message_id=status_msg_id,
-                    text=(
+                recent_links.remember(target_chat_id, content_key(url), sent.message_id)
+                file_id = self._sent_file_id(sent)
+                if file_id:
+                    history_manager.set_file_id(
+                        callback_query.from_user.id, canonical_url(content_key(url), url), mode, file_id
+                    )
+                await status_editor.edit(
+                    target_chat_id, status_msg_id,
+                    (
                         f"✅ Готово — отправлено ({size_mb:.1f} MB).\n"
                         f"📌 Источник: {source}\n"
                         f"🔗 Оригинальная ссылка: {url}"
                     ),
+                    final=True,
                     reply_markup=retry_kb,
                     disable_web_page_preview=True
                 )
         except Exception as e:
             logger.exception("Ошибка при отправке файла")
-            await bot.edit_message_text(
-                chat_id=target_chat_id,
-                message_id=status_msg_id,
-                text=f"Ошибка при отправке: {str(e)}"
-            )
+            await status_editor.edit(target_chat_id, status_msg_id, f"Ошибка при отправке: {str(e)}", final=True)
 
     async def _handle_download_error(self, callback_query: types.CallbackQuery, error: Exception, url: str, status_msg_id: int):
         """Улучшенная обработка ошибок загрузки"""
@@ -914,7 +1596,7 @@ class DownloadManager:
         logger.warning(f"Ошибка типа {error_type} для пользователя {user_id}: {str(error)}")
 
         # Формируем сообщение
-        lang = user_settings.get_settings(user_id)["language"]
+        lang = (await user_settings.get_settings(user_id))["language"]
         error_message = error_manager.format_error_message(error_type, lang, url)
 
         # Создаем клавиатуру с действиями
@@ -926,10 +1608,10 @@ class DownloadManager:
 
         # Отправляем сообщение
         try:
-            await bot.edit_message_text(
-                chat_id=target_chat_id,
-                message_id=status_msg_id,
-                text=error_message,
+            await status_editor.edit(
+                target_chat_id, status_msg_id,
+                error_message,
+                final=True,
                 reply_markup=action_kb,
                 parse_mode="HTML"
             )
@@ -937,89 +1619,481 @@ class DownloadManager:
             logger.error(f"Не удалось отправить сообщение об ошибке: {e}")
             # Попробуем отправить без разметки
             try:
-                await bot.edit_message_text(
-                    chat_id=target_chat_id,
-                    message_id=status_msg_id,
-                    text=f"Ошибка при загрузке: {str(error)[:1000]}",
+                await status_editor.edit(
+                    target_chat_id, status_msg_id,
+                    f"Ошибка при загрузке: {str(error)[:1000]}",
+                    final=True,
                     reply_markup=action_kb
                 )
             except Exception as e2:
                 logger.error(f"Критическая ошибка при отправке сообщения: {e2}")
 
+# ===== ЧАСТОТА ЗАПРОСОВ КОНТЕНТА =====
+class FrequencySketch:
+    """Count-min sketch частот запросов со старением в духе TinyLFU: после sample_size
+    инкрементов все счётчики делятся пополам, и старая популярность постепенно забывается."""
+    def __init__(self, width: int = 16384, depth: int = 4, sample_size: Optional[int] = None):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+        self.sample_size = sample_size or width * 10
+        self.additions = 0
+        self.resets = 0
+
+    def _indexes(self, key: str) -> List[int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=4 * self.depth).digest()
+        return [int.from_bytes(digest[4 * i:4 * i + 4], "little") % self.width for i in range(self.depth)]
+
+    def estimate(self, key: str) -> int:
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+    def increment(self, key: str) -> int:
+        """Учесть запрос; возвращает новую оценку частоты"""
+        indexes = self._indexes(key)
+        current = min(row[i] for row, i in zip(self.rows, indexes))
+        # Консервативное обновление: растут только минимальные счётчики
+        for row, i in zip(self.rows, indexes):
+            if row[i] == current:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._age()
+            return (current + 1) // 2
+        return current + 1
+
+    def _age(self):
+        for row in self.rows:
+            for i, value in enumerate(row):
+                if value:
+                    row[i] = value >> 1
+        self.additions //= 2
+        self.resets += 1
+
+# ===== ХОЛОДНЫЙ УРОВЕНЬ КЭША =====
+class BlobBackend(ABC):
+    """Хранилище холодного уровня кэша: объекты по ключу <sha256><расширение>"""
+    name = "base"
+
+    @abstractmethod
+    async def put(self, key: str, src_path: str):
+        ...
+
+    @abstractmethod
+    async def get(self, key: str, dst_path: str):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+class LocalDirBackend(BlobBackend):
+    """Холодный уровень в локальном каталоге (второй диск, сетевой том или стенд для проверки)"""
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    @staticmethod
+    def _copy(src: str, dst: str):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        partial_path = f"{dst}.{uuid.uuid4().hex[:8]}.part"
+        shutil.copyfile(src, partial_path)
+        os.replace(partial_path, dst)
+
+    async def put(self, key: str, src_path: str):
+        await asyncio.to_thread(self._copy, src_path, self._path(key))
+
+    async def get(self, key: str, dst_path: str):
+        await asyncio.to_thread(self._copy, self._path(key), dst_path)
+
+    async def delete(self, key: str):
+        path = self._path(key)
+        if os.path.exists(path):
+            await asyncio.to_thread(os.remove, path)
+
+class S3Backend(BlobBackend):
+    """Холодный уровень в S3-совместимом хранилище (нужен boto3)"""
+    name = "s3"
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("для холодного уровня в S3 нужен пакет boto3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None)
+
+    async def put(self, key: str, src_path: str):
+        await asyncio.to_thread(self.client.upload_file, src_path, self.bucket, self.prefix + key)
+
+    async def get(self, key: str, dst_path: str):
+        await asyncio.to_thread(self.client.download_file, self.bucket, self.prefix + key, dst_path)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.client.delete_object, Bucket=self.bucket, Key=self.prefix + key)
+
+def make_cold_backend(spec: str) -> Optional[BlobBackend]:
+    """COLD_TIER: пусто — выключен, s3://bucket/prefix — S3, иначе путь к каталогу (можно с префиксом local:)"""
+    if not spec:
+        return None
+    try:
+        if spec.startswith("s3://"):
+            bucket, _, prefix = spec[len("s3://"):].partition("/")
+            return S3Backend(bucket, prefix, COLD_TIER_ENDPOINT)
+        return LocalDirBackend(spec[len("local:"):] if spec.startswith("local:") else spec)
+    except Exception as e:
+        logger.error(f"Холодный уровень кэша отключён: {e}")
+        return None
+
 # ===== МЕНЕДЖЕР КЭША =====
+def _cache_accounting_columns(conn):
+    """Поля учёта для вытеснения и ссылки на blob (часть баз уже получила их до миграций)"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(cache)")}
+    for name, ddl in (("size", "INTEGER NOT NULL DEFAULT 0"),
+                      ("last_access", "REAL NOT NULL DEFAULT 0"),
+                      ("hit_count", "INTEGER NOT NULL DEFAULT 0"),
+                      ("blob_hash", "TEXT"),
+                      ("file_name", "TEXT")):
+        if name not in columns:
+            conn.execute(f"ALTER TABLE cache ADD COLUMN {name} {ddl}")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL
+    )
+    """)
+
+CACHE_MIGRATIONS = [
+    (
+        """
+        CREATE TABLE IF NOT EXISTS cache (
+            url TEXT PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ),
+    _cache_accounting_columns,
+    # Ключ (url, тип): видео и аудио одного контента больше не вытесняют друг друга
+    (
+        """
+        CREATE TABLE cache_v3 (
+            url TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            size INTEGER NOT NULL DEFAULT 0,
+            last_access REAL NOT NULL DEFAULT 0,
+            hit_count INTEGER NOT NULL DEFAULT 0,
+            blob_hash TEXT,
+            file_name TEXT,
+            PRIMARY KEY (url, file_type)
+        )
+        """,
+        """
+        INSERT INTO cache_v3 (url, file_type, file_path, timestamp, size, last_access, hit_count, blob_hash, file_name)
+        SELECT url, file_type, file_path, timestamp, size, last_access, hit_count, blob_hash, file_name FROM cache
+        """,
+        "DROP TABLE cache",
+        "ALTER TABLE cache_v3 RENAME TO cache",
+        # Порядок вытеснения LRU и LFU, поиск записей по blob
+        "CREATE INDEX idx_cache_last_access ON cache (last_access)",
+        "CREATE INDEX idx_cache_value ON cache ((hit_count + 1.0) / MAX(size, 1), last_access)",
+        "CREATE INDEX idx_cache_blob ON cache (blob_hash)",
+    ),
+    # Холодный уровень: вытесненные записи и объекты во внешнем хранилище
+    (
+        """
+        CREATE TABLE cold_blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            ext TEXT NOT NULL,
+            last_access REAL NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE cold_entries (
+            url TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            blob_hash TEXT NOT NULL,
+            file_name TEXT,
+            PRIMARY KEY (url, file_type)
+        )
+        """,
+    ),
+    # Закреплённые популярные записи не вытесняются
+    (
+        "ALTER TABLE cache ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX idx_cache_pinned ON cache (pinned, last_access)",
+    ),
+]
+
 class CacheManager:
-    def __init__(self, cache_dir="downloads", db_path="cache.db"):
+    """Файловый кэш с индексом в SQLite. Файлы хранятся по хэшу содержимого
+    (downloads/ab/cd/<sha256>.ext), несколько ключей могут ссылаться на один blob.
+    Индекс хранит размер, время последнего обращения и число попаданий; общий объём
+    ведётся в памяти, а вытеснение идёт сразу при добавлении (LRU или LFU с учётом
+    размера) и по TTL простоя. Если задан холодный уровень, вытесненное переносится
+    туда и при следующем запросе возвращается в локальный кэш.
+    Частота запросов по ключу контента оценивается count-min sketch: новый файл при
+    заполненном кэше принимается, только если он популярнее вытесняемых (TinyLFU),
+    а самые популярные записи закрепляются и не вытесняются."""
+    def __init__(self, cache_dir="downloads", db_path="cache.db", max_bytes=CACHE_MAX_BYTES,
+                 ttl=CACHE_TTL, policy=CACHE_EVICTION_POLICY,
+                 cold: Optional[BlobBackend] = None, cold_max_bytes=COLD_MAX_BYTES):
         self.cache_dir = cache_dir
         self.db_path = db_path
+        self.max_bytes = max_bytes
+        # После вытеснения оставляем запас в 10%, чтобы не вытеснять на каждой вставке
+        self.target_bytes = int(max_bytes * 0.9)
+        self.ttl = ttl
+        self.policy = policy
+        self.db = Database.open(db_path)
+        self.writes = WriteBehindQueue(self.db, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_ROWS)
+        # Зеркало индекса в памяти (база пишется отложенно):
+        # (url, тип) -> (хэш, имя файла); хэш -> [путь, размер, число ссылок]
+        self._entries: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        self._blobs: Dict[str, list] = {}
+        self.total_bytes = 0
+        self._evict_lock = asyncio.Lock()
+        self.evicted = {"size": 0, "ttl": 0}
+        self.evicted_bytes = 0
+        self.dedup_hits = 0
+        # Холодный уровень: (url, тип) -> (хэш, имя файла); хэш -> [размер, расширение, последнее обращение]
+        self.cold = cold
+        self.cold_max_bytes = cold_max_bytes
+        self._cold_entries: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        self._cold_blobs: Dict[str, list] = {}
+        self.cold_bytes = 0
+        self._demotions: Dict[str, asyncio.Task] = {}
+        self._promotions: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.tier_hits = {"hot": 0, "cold": 0, "miss": 0}
+        # Популярность: оценки частот, закреплённые ключи и кандидаты в топ (ключ -> оценка)
+        self.sketch = FrequencySketch()
+        self.pin_threshold = CACHE_PIN_THRESHOLD
+        self._pinned: set = set()
+        self.pinned_bytes = 0  # объём записей закреплённых ключей, меняется вместе с индексом
+        self._top: Dict[str, int] = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.demoted = 0
+        self.promoted = 0
         os.makedirs(cache_dir, exist_ok=True)
-        self._init_db()
+        self.db.run_sync(self._init_db)
+        self.db.run_sync(self._load_index)
+        # До первых вставок, чтобы обход не задел только что скопированные файлы
+        self._cleanup_orphaned_files()
         # Запускаем фоновую задачу для автоочистки
         asyncio.create_task(self._auto_cleanup_task())
 
-    def _init_db(self):
+    def _init_db(self, conn):
         """Инициализация SQLite базы данных для кэша"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS cache (
-            url TEXT PRIMARY KEY,
-            file_path TEXT NOT NULL,
-            file_type TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
+        self.db.migrate(conn, CACHE_MIGRATIONS)
+        self._adopt_legacy_files(conn)
+
+    def _adopt_legacy_files(self, conn):
+        """Перенос файлов старого формата (downloads/<имя>) в хранилище по хэшу"""
+        legacy = conn.execute("SELECT url, file_type, file_path FROM cache WHERE blob_hash IS NULL").fetchall()
+        now = time.time()
+        for url, file_type, file_path in legacy:
+            try:
+                digest, size = self._hash_file(file_path)
+                blob_path = self._blob_path(digest, file_path)
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                if os.path.exists(blob_path):
+                    os.remove(file_path)
+                else:
+                    os.replace(file_path, blob_path)
+            except OSError:
+                conn.execute("DELETE FROM cache WHERE url = ? AND file_type = ?", (url, file_type))
+                continue
+            conn.execute(
+                "INSERT OR IGNORE INTO blobs (hash, path, size, refcount) VALUES (?, ?, ?, 0)",
+                (digest, blob_path, size)
+            )
+            conn.execute(
+                "UPDATE cache SET file_path = ?, blob_hash = ?, file_name = ?, size = ?, "
+                "last_access = MAX(last_access, ?) WHERE url = ? AND file_type = ?",
+                (blob_path, digest, os.path.basename(file_path), size, now, url, file_type)
+            )
         conn.commit()
-        conn.close()
-
-    def get_cached_file(self, url: str, file_type: str) -> Optional[str]:
-        """Получить путь к кэшированному файлу"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT file_path FROM cache WHERE url = ? AND file_type = ?", (url, file_type))
-        result = cursor.fetchone()
-        conn.close()
-        if result and os.path.exists(result[0]):
-            return result[0]
-        return None
 
-    def add_to_cache(self, url: str, file_path: str, file_type: str) -> bool:
+    def _load_index(self, conn):
+        """Загрузка индекса в память; число ссылок пересчитывается по записям"""
+        for blob_hash, path, size in conn.execute("SELECT hash, path, size FROM blobs"):
+            self._blobs[blob_hash] = [path, size, 0]
+        for url, blob_hash, file_type, file_name in conn.execute(
+                "SELECT url, blob_hash, file_type, file_name FROM cache"):
+            blob = self._blobs.get(blob_hash)
+            if blob is None:
+                continue
+            blob[2] += 1
+            self._entries[(url, file_type)] = (blob_hash, file_name or os.path.basename(blob[0]))
+        with conn:
+            for blob_hash, (path, size, refs) in list(self._blobs.items()):
+                if refs == 0:
+                    conn.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+                    del self._blobs[blob_hash]
+                    continue
+                conn.execute("UPDATE blobs SET refcount = ? WHERE hash = ?", (refs, blob_hash))
+                self.total_bytes += size
+        self._pinned = {row[0] for row in conn.execute("SELECT DISTINCT url FROM cache WHERE pinned = 1")}
+        self.pinned_bytes = sum(self._key_bytes(key) for key in self._pinned)
+        for blob_hash, size, ext, last_access in conn.execute("SELECT hash, size, ext, last_access FROM cold_blobs"):
+            self._cold_blobs[blob_hash] = [size, ext, last_access]
+            self.cold_bytes += size
+        for url, file_type, blob_hash, file_name in conn.execute(
+                "SELECT url, file_type, blob_hash, file_name FROM cold_entries"):
+            if blob_hash in self._cold_blobs:
+                self._cold_entries[(url, file_type)] = (blob_hash, file_name)
+
+    @staticmethod
+    def _hash_file(file_path: str) -> Tuple[str, int]:
+        with open(file_path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        return digest, os.path.getsize(file_path)
+
+    def _blob_path(self, digest: str, original_path: str) -> str:
+        ext = os.path.splitext(original_path)[1].lower()
+        return os.path.join(self.cache_dir, digest[:2], digest[2:4], digest + ext)
+
+    def _store_blob(self, file_path: str) -> Tuple[str, str, int, bool]:
+        """Хэширует файл и кладёт его в хранилище; возвращает (хэш, путь, размер, новый ли blob)"""
+        digest, size = self._hash_file(file_path)
+        blob = self._blobs.get(digest)
+        if blob is not None and os.path.exists(blob[0]):
+            return digest, blob[0], size, False
+        blob_path = self._blob_path(digest, file_path)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        # Уникальное временное имя: одинаковый файл могут добавлять параллельно
+        partial_path = f"{blob_path}.{uuid.uuid4().hex[:8]}.part"
+        shutil.copy2(file_path, partial_path)
+        os.replace(partial_path, blob_path)
+        return digest, blob_path, size, True
+
+    async def get_cached_file(self, url: str, file_type: str, touch: bool = True) -> Optional[str]:
+        """Получить путь к кэшированному файлу; touch=False — проверка без учёта попадания.
+        Запись из холодного уровня сначала возвращается в локальный кэш (только при touch).
+        Частоту запросов не меняет — её учитывает record_request один раз на запрос пользователя."""
+        entry = self._entries.get((url, file_type))
+        path = self._blobs[entry[0]][0] if entry is not None else None
+        if path is None or not os.path.exists(path):
+            if not touch:
+                return None
+            if (url, file_type) in self._cold_entries:
+                path = await self._promote((url, file_type))
+                if path:
+                    self.tier_hits["cold"] += 1
+                    return path
+            self.tier_hits["miss"] += 1
+            return None
+        if touch:
+            self.tier_hits["hot"] += 1
+            self.writes.enqueue(
+                "UPDATE cache SET last_access = ?, hit_count = hit_count + 1 WHERE url = ? AND file_type = ?",
+                (time.time(), url, file_type)
+            )
+        return path
+
+    def file_name(self, url: str, file_type: str) -> Optional[str]:
+        """Исходное имя файла для подписи (в хранилище файлы названы по хэшу)"""
+        entry = self._entries.get((url, file_type)) or self._cold_entries.get((url, file_type))
+        return entry[1] if entry else None
+
+    async def add_to_cache(self, url: str, file_path: str, file_type: str) -> bool:
         """Добавить файл в кэш"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         try:
             # Убедимся, что файл существует перед добавлением в кэш
             if not os.path.exists(file_path):
                 return False
-            # Создаем копию файла в директории кэша
-            filename = os.path.basename(file_path)
-            cache_path = os.path.join(self.cache_dir, filename)
-            # Если файл уже в кэше, просто обновляем запись
-            if os.path.abspath(file_path) == os.path.abspath(cache_path):
-                pass
+            if not await self._admit(url, os.path.getsize(file_path)):
+                self.rejected += 1
+                logger.info(f"Кэш: {os.path.basename(file_path)} не принят — вытесняемые записи популярнее")
+                return False
+            self.admitted += 1
+            digest, blob_path, size, created = await asyncio.to_thread(self._store_blob, file_path)
+            if not created:
+                self.dedup_hits += 1
+            self._forget_cold_entry((url, file_type))
+            previous = self._entries.get((url, file_type))
+            if previous is not None and previous[0] == digest:
+                # Тот же blob — меняется только запись
+                self._set_entry((url, file_type), (digest, os.path.basename(file_path)))
             else:
-                # Если файл уже существует в кэше, удаляем старую версию
-                if os.path.exists(cache_path):
-                    os.remove(cache_path)
-                shutil.copy2(file_path, cache_path)
-            cursor.execute(
-                "INSERT OR REPLACE INTO cache (url, file_path, file_type) VALUES (?, ?, ?)",
-                (url, cache_path, file_type)
+                self._ref_blob(digest, blob_path, size)
+                self._set_entry((url, file_type), (digest, os.path.basename(file_path)))
+                if previous is not None:
+                    self._unref_blob(previous[0])
+            self.writes.enqueue(
+                "INSERT OR REPLACE INTO cache (url, file_path, file_type, size, last_access, hit_count, blob_hash, file_name, pinned) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                (url, blob_path, file_type, size, time.time(), digest, os.path.basename(file_path), int(url in self._pinned))
             )
-            conn.commit()
-            return True
         except Exception as e:
             logger.error(f"Ошибка добавления в кэш: {e}")
             return False
-        finally:
-            conn.close()
+        if self.total_bytes > self.max_bytes:
+            await self.evict_to(self.target_bytes)
+        return True
+
+    def _ref_blob(self, digest: str, path: str, size: int):
+        blob = self._blobs.get(digest)
+        if blob is None:
+            blob = self._blobs[digest] = [path, size, 0]
+            self.total_bytes += size
+        blob[2] += 1
+        self.writes.enqueue(
+            "INSERT OR REPLACE INTO blobs (hash, path, size, refcount) VALUES (?, ?, ?, ?)",
+            (digest, blob[0], blob[1], blob[2])
+        )
+
+    def _unref_blob(self, digest: str, demote: bool = False) -> int:
+        """Снять ссылку с blob; при нуле ссылок файл удаляется (или переносится в холодный уровень
+        при demote). Возвращает освобождённые байты"""
+        blob = self._blobs.get(digest)
+        if blob is None:
+            return 0
+        blob[2] -= 1
+        if blob[2] > 0:
+            self.writes.enqueue("UPDATE blobs SET refcount = ? WHERE hash = ?", (blob[2], digest))
+            return 0
+        del self._blobs[digest]
+        self.total_bytes -= blob[1]
+        self.writes.enqueue("DELETE FROM blobs WHERE hash = ?", (digest,))
+        if self.cold is not None and demote and digest not in self._demotions:
+            # Файл удалится после копирования в холодный уровень
+            self._demotions[digest] = asyncio.create_task(self._demote_blob(digest, blob[0], blob[1]))
+            return blob[1]
+        if digest in self._demotions:
+            # Файл ещё копируется прежним переносом — он и удалит его по завершении,
+            # если blob к тому времени снова не понадобится локально
+            return blob[1]
+        try:
+            if os.path.exists(blob[0]):
+                os.remove(blob[0])
+        except Exception as e:
+            logger.error(f"Не удалось удалить файл кэша {blob[0]}: {e}")
+        return blob[1]
 
-    def remove_from_cache(self, file_path: str) -> bool:
-        """Удалить файл из кэша"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    async def remove_from_cache(self, file_path: str) -> bool:
+        """Удалить файл из кэша вместе со всеми ссылающимися на него записями"""
         try:
-            cursor.execute("DELETE FROM cache WHERE file_path = ?", (file_path,))
-            conn.commit()
+            for index_key, (blob_hash, _) in list(self._entries.items()):
+                if self._blobs.get(blob_hash, [None])[0] == file_path:
+                    self._pop_entry(index_key)
+                    # Запись другого типа того же контента остаётся закреплённой
+                    if not any((index_key[0], file_type) in self._entries for file_type in ("video", "audio")):
+                        self._unpin(index_key[0])
+                    self.writes.enqueue("DELETE FROM cache WHERE url = ? AND file_type = ?", index_key)
+                    self._unref_blob(blob_hash)
             # Удаляем физический файл, если он существует
             if os.path.exists(file_path):
                 os.remove(file_path)
@@ -1027,173 +2101,1404 @@ class CacheManager:
         except Exception as e:
             logger.error(f"Ошибка удаления из кэша: {e}")
             return False
-        finally:
-            conn.close()
 
-    def cleanup_old_files_by_hours(self, hours=6) -> int:
-        """Удаление файлов старше указанного количества часов (было дней)"""
-        cutoff = datetime.now() - timedelta(hours=hours)
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM cache WHERE timestamp < ?", (cutoff,))
-        deleted = cursor.rowcount
-        conn.commit()
-        conn.close()
-        # Также проверяем физические файлы
-        if deleted > 0:
-            self._cleanup_orphaned_files()
-        return deleted
+    def _eviction_order(self) -> str:
+        if self.policy == "lfu":
+            # Ценность байта: редкие и крупные файлы уходят первыми
+            return "(hit_count + 1.0) / MAX(size, 1) ASC, last_access ASC"
+        return "last_access ASC"
+
+    async def evict_to(self, target_bytes: int) -> int:
+        """Вытеснять записи по политике, пока общий объём не станет не больше target_bytes"""
+        async with self._evict_lock:
+            await self.writes.flush()
+            evicted = 0
+            while self.total_bytes > target_bytes:
+                rows = await self.db.fetchall(
+                    f"SELECT url, file_type FROM cache WHERE pinned = 0 ORDER BY {self._eviction_order()} LIMIT 64"
+                )
+                if not rows:
+                    break
+                for url, file_type in rows:
+                    if self.total_bytes <= target_bytes:
+                        break
+                    self._drop((url, file_type), "size")
+                    evicted += 1
+                await self.writes.flush()
+            return evicted
+
+    async def expire_idle(self, batch: int = 500) -> int:
+        """Удалить записи, к которым не обращались дольше TTL"""
+        async with self._evict_lock:
+            await self.writes.flush()
+            cutoff = time.time() - self.ttl
+            expired = 0
+            while True:
+                rows = await self.db.fetchall(
+                    "SELECT url, file_type FROM cache WHERE last_access < ? AND pinned = 0 LIMIT ?", (cutoff, batch)
+                )
+                if not rows:
+                    break
+                for url, file_type in rows:
+                    self._drop((url, file_type), "ttl")
+                expired += len(rows)
+                await self.writes.flush()
+            return expired
+
+    def _drop(self, index_key: Tuple[str, str], reason: str):
+        """Удалить запись; файл удаляется, когда на blob не остаётся ссылок"""
+        entry = self._pop_entry(index_key)
+        self.writes.enqueue("DELETE FROM cache WHERE url = ? AND file_type = ?", index_key)
+        self.evicted[reason] += 1
+        if entry is not None:
+            if self.cold is not None:
+                self._cold_entries[index_key] = entry
+                self.writes.enqueue(
+                    "INSERT OR REPLACE INTO cold_entries (url, file_type, blob_hash, file_name) VALUES (?, ?, ?, ?)",
+                    (*index_key, *entry)
+                )
+            freed = self._unref_blob(entry[0], demote=True)
+            self.evicted_bytes += freed
+            if freed:
+                logger.info(f"Вытеснено из кэша ({reason}): {entry[1]} ({freed/(1024*1024):.2f} MB)")
+
+    # ---- популярность ----
+    TOP_TRACKED = 200
+
+    def record_request(self, key: str):
+        """Учесть запрос контента: частота, список популярного и закрепление"""
+        estimate = self.sketch.increment(key)
+        if key in self._top or len(self._top) < self.TOP_TRACKED:
+            self._top[key] = estimate
+        else:
+            coldest = min(self._top, key=self._top.get)
+            if estimate > self._top[coldest]:
+                del self._top[coldest]
+                self._top[key] = estimate
+        if estimate >= self.pin_threshold and key not in self._pinned:
+            self._pin(key)
+
+    def _entry_bytes(self, entry: Optional[Tuple[str, str]]) -> int:
+        blob = self._blobs.get(entry[0]) if entry is not None else None
+        return blob[1] if blob is not None else 0
+
+    def _key_bytes(self, key: str) -> int:
+        """Объём записей ключа (видео и аудио) в локальном кэше"""
+        return sum(self._entry_bytes(self._entries.get((key, file_type))) for file_type in ("video", "audio"))
+
+    def _set_entry(self, index_key: Tuple[str, str], entry: Tuple[str, str]):
+        """Записать элемент индекса (blob уже учтён) и обновить объём закреплённого"""
+        previous = self._entries.get(index_key)
+        self._entries[index_key] = entry
+        if index_key[0] in self._pinned:
+            self.pinned_bytes += self._entry_bytes(entry) - self._entry_bytes(previous)
+
+    def _pop_entry(self, index_key: Tuple[str, str]) -> Optional[Tuple[str, str]]:
+        """Убрать элемент индекса (до снятия ссылки с blob) и обновить объём закреплённого"""
+        entry = self._entries.pop(index_key, None)
+        if entry is not None and index_key[0] in self._pinned:
+            self.pinned_bytes -= self._entry_bytes(entry)
+        return entry
+
+    def _pin(self, key: str):
+        if not any((key, file_type) in self._entries for file_type in ("video", "audio")):
+            return
+        size = self._key_bytes(key)
+        if self.pinned_bytes + size > self.max_bytes * CACHE_PIN_MAX_SHARE:
+            return
+        self._pinned.add(key)
+        self.pinned_bytes += size
+        self.writes.enqueue("UPDATE cache SET pinned = 1 WHERE url = ?", (key,))
+        logger.info(f"Кэш: закреплена популярная запись {key}")
+
+    def _unpin_cooled(self):
+        """Снять закрепление с записей, чья частота после старения упала вдвое ниже порога"""
+        for key in list(self._pinned):
+            if self.sketch.estimate(key) < self.pin_threshold // 2:
+                self._unpin(key)
+
+    def _unpin(self, key: str):
+        if key in self._pinned:
+            self._pinned.discard(key)
+            self.pinned_bytes -= self._key_bytes(key)
+            self.writes.enqueue("UPDATE cache SET pinned = 0 WHERE url = ?", (key,))
+
+    async def _admit(self, key: str, size: int) -> bool:
+        """TinyLFU-допуск: при нехватке места новый файл принимается, только если он
+        запрашивается не реже каждой записи, которую пришлось бы ради него вытеснить"""
+        if self.total_bytes + size <= self.max_bytes:
+            return True
+        needed = self.total_bytes + size - self.target_bytes
+        await self.writes.flush()
+        rows = await self.db.fetchall(
+            f"SELECT url, size FROM cache WHERE pinned = 0 ORDER BY {self._eviction_order()} LIMIT 256"
+        )
+        candidate = self.sketch.estimate(key)
+        freed = 0
+        for url, victim_size in rows:
+            if url == key:
+                continue
+            # При равной частоте предпочитаем новый файл, иначе свежий контент не попадёт в полный кэш
+            if self.sketch.estimate(url) > candidate:
+                return False
+            freed += victim_size
+            if freed >= needed:
+                return True
+        return False
 
-    def _cleanup_orphaned_files(self):
-        """Удаление файлов, которые есть на диске, но отсутствуют в базе"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT file_path FROM cache")
-        cached_files = set(row[0] for row in cursor.fetchall())
-        conn.close()
-        # Проверяем каждый файл в папке кэша
-        for filename in os.listdir(self.cache_dir):
-            file_path = os.path.join(self.cache_dir, filename)
-            if os.path.isfile(file_path) and file_path not in cached_files:
+    def hot_report(self, limit: int = 10) -> List[Tuple[str, int, bool, bool]]:
+        """Самый популярный контент: (ключ, оценка частоты, есть ли в кэше, закреплён ли)"""
+        ranked = sorted(((key, self.sketch.estimate(key)) for key in self._top), key=lambda item: -item[1])
+        return [
+            (key, estimate,
+             any((key, file_type) in self._entries or (key, file_type) in self._cold_entries for file_type in ("video", "audio")),
+             key in self._pinned)
+            for key, estimate in ranked[:limit] if estimate > 0
+        ]
+
+    # ---- холодный уровень ----
+    def _forget_cold_entry(self, index_key: Tuple[str, str]):
+        if self._cold_entries.pop(index_key, None) is not None:
+            self.writes.enqueue("DELETE FROM cold_entries WHERE url = ? AND file_type = ?", index_key)
+
+    async def _demote_blob(self, digest: str, path: str, size: int):
+        """Скопировать вытесненный blob в холодный уровень и удалить локальный файл"""
+        try:
+            ext = os.path.splitext(path)[1]
+            if digest not in self._cold_blobs:
+                await self.cold.put(digest + ext, path)
+                self._cold_blobs[digest] = [size, ext, time.time()]
+                self.cold_bytes += size
+                self.writes.enqueue(
+                    "INSERT OR REPLACE INTO cold_blobs (hash, size, ext, last_access) VALUES (?, ?, ?, ?)",
+                    (digest, size, ext, time.time())
+                )
+                self.demoted += 1
+                if self.cold_bytes > self.cold_max_bytes:
+                    await self._evict_cold()
+        except Exception as e:
+            logger.error(f"Не удалось перенести {path} в холодный уровень ({self.cold.name}): {e}")
+            for index_key, (blob_hash, _) in list(self._cold_entries.items()):
+                if blob_hash == digest:
+                    self._forget_cold_entry(index_key)
+        finally:
+            self._demotions.pop(digest, None)
+            # За время копирования blob мог снова понадобиться локально
+            if digest not in self._blobs:
                 try:
-                    os.remove(file_path)
-                    logger.info(f"Удален орфанный файл кэша: {file_path}")
+                    if os.path.exists(path):
+                        os.remove(path)
                 except Exception as e:
-                    logger.error(f"Не удалось удалить орфанный файл {file_path}: {e}")
+                    logger.error(f"Не удалось удалить файл кэша {path}: {e}")
 
-    def get_cache_size(self) -> int:
-        """Получить общий размер кэша в байтах"""
-        total_size = 0
-        for filename in os.listdir(self.cache_dir):
-            file_path = os.path.join(self.cache_dir, filename)
-            if os.path.isfile(file_path):
-                total_size += os.path.getsize(file_path)
-        return total_size
-
-    def cleanup_by_size(self, target_size: int) -> int:
-        """Очистка кэша до указанного размера, удаляя самые старые файлы"""
-        # Получаем список файлов с сортировкой по дате
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT url, file_path, timestamp FROM cache ORDER BY timestamp ASC")
-        files = cursor.fetchall()
-        conn.close()
-        current_size = self.get_cache_size()
-        if current_size <= target_size:
-            return 0
-        # Удаляем файлы, начиная с самых старых
-        deleted_count = 0
-        for url, file_path, timestamp in files:
-            if current_size <= target_size:
+    async def _evict_cold(self):
+        """Удалить из холодного уровня самые давно запрошенные объекты сверх лимита"""
+        target = int(self.cold_max_bytes * 0.9)
+        for digest, (size, ext, _) in sorted(self._cold_blobs.items(), key=lambda item: item[1][2]):
+            if self.cold_bytes <= target:
                 break
+            del self._cold_blobs[digest]
+            self.cold_bytes -= size
+            self.writes.enqueue("DELETE FROM cold_blobs WHERE hash = ?", (digest,))
+            for index_key, (blob_hash, _) in list(self._cold_entries.items()):
+                if blob_hash == digest:
+                    self._forget_cold_entry(index_key)
             try:
-                size = os.path.getsize(file_path)
-                os.remove(file_path)
-                # Удаляем запись из базы
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM cache WHERE url = ?", (url,))
-                conn.commit()
-                conn.close()
-                current_size -= size
-                deleted_count += 1
-                logger.info(f"Очищен кэш: {file_path} ({size/(1024*1024):.2f} MB)")
+                await self.cold.delete(digest + ext)
             except Exception as e:
-                logger.error(f"Не удалось удалить файл кэша {file_path}: {e}")
-        return deleted_count
+                logger.error(f"Не удалось удалить {digest}{ext} из холодного уровня: {e}")
+
+    async def _promote(self, index_key: Tuple[str, str]) -> Optional[str]:
+        """Вернуть запись из холодного уровня в локальный кэш (одна загрузка на ключ)"""
+        pending = self._promotions.get(index_key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._promotions[index_key] = future
+        path = None
+        try:
+            path = await self._fetch_from_cold(index_key)
+        except Exception as e:
+            logger.error(f"Не удалось вернуть {index_key[0]} из холодного уровня: {e}")
+        finally:
+            self._promotions.pop(index_key, None)
+            future.set_result(path)
+        return path
+
+    async def _fetch_from_cold(self, index_key: Tuple[str, str]) -> Optional[str]:
+        entry = self._cold_entries.get(index_key)
+        if entry is None:
+            return None
+        digest, file_name = entry
+        demotion = self._demotions.get(digest)
+        if demotion is not None:
+            await demotion
+        cold_blob = self._cold_blobs.get(digest)
+        hot_blob = self._blobs.get(digest)
+        if hot_blob is not None:
+            path, size = hot_blob[0], hot_blob[1]
+        elif cold_blob is not None:
+            size, ext = cold_blob[0], cold_blob[1]
+            path = os.path.join(self.cache_dir, digest[:2], digest[2:4], digest + ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            partial_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+            await self.cold.get(digest + ext, partial_path)
+            os.replace(partial_path, path)
+        else:
+            self._forget_cold_entry(index_key)
+            return None
+        if cold_blob is not None:
+            cold_blob[2] = time.time()
+            self.writes.enqueue("UPDATE cold_blobs SET last_access = ? WHERE hash = ?", (cold_blob[2], digest))
+        self._forget_cold_entry(index_key)
+        self._ref_blob(digest, path, size)
+        self._set_entry(index_key, (digest, file_name))
+        self.writes.enqueue(
+            "INSERT OR REPLACE INTO cache (url, file_path, file_type, size, last_access, hit_count, blob_hash, file_name, pinned) "
+            "VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?)",
+            (index_key[0], path, index_key[1], size, time.time(), digest, file_name, int(index_key[0] in self._pinned))
+        )
+        self.promoted += 1
+        if self.total_bytes > self.max_bytes:
+            asyncio.create_task(self.evict_to(self.target_bytes))
+        return path
+
+    def _cleanup_orphaned_files(self):
+        """Удаление файлов, которые есть на диске, но отсутствуют в базе (один раз при старте)"""
+        cached_files = {os.path.abspath(blob[0]) for blob in self._blobs.values()}
+        removed = 0
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                file_path = os.path.join(root, filename)
+                if os.path.abspath(file_path) not in cached_files:
+                    try:
+                        os.remove(file_path)
+                        removed += 1
+                    except Exception as e:
+                        logger.error(f"Не удалось удалить орфанный файл {file_path}: {e}")
+        if removed:
+            logger.info(f"Удалено орфанных файлов кэша: {removed}")
+
+    def get_cache_size(self) -> int:
+        """Общий размер кэша в байтах (по индексу, без обхода каталога)"""
+        return self.total_bytes
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = sum(self.tier_hits.values())
+        return {
+            "hot_hit_rate": self.tier_hits["hot"] / lookups if lookups else 0.0,
+            "cold_hit_rate": self.tier_hits["cold"] / lookups if lookups else 0.0,
+            "cold": self.cold.name if self.cold is not None else None,
+            "cold_entries": len(self._cold_entries),
+            "cold_bytes": self.cold_bytes,
+            "demoted": self.demoted,
+            "promoted": self.promoted,
+            "entries": len(self._entries),
+            "blobs": len(self._blobs),
+            "dedup_hits": self.dedup_hits,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "policy": self.policy,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "pinned": len(self._pinned),
+            "pinned_bytes": self.pinned_bytes,
+            "evicted_size": self.evicted["size"],
+            "evicted_ttl": self.evicted["ttl"],
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+    async def close(self):
+        # Дожидаемся переносов в холодный уровень, иначе файлы останутся сиротами
+        if self._demotions:
+            await asyncio.gather(*self._demotions.values(), return_exceptions=True)
+        await self.writes.close()
 
     async def _auto_cleanup_task(self):
-        """Фоновая задача для регулярной очистки кэша"""
+        """Фоновая задача: истечение TTL небольшими порциями и контроль объёма"""
         while True:
             try:
-                # Очищаем файлы старше 6 часов (было 7 дней)
-                deleted = self.cleanup_old_files_by_hours(hours=6)
-                if deleted > 0:
-                    logger.info(f"Автоочистка кэша: удалено {deleted} старых записей")
-                # Проверяем общий размер кэша
-                cache_size = self.get_cache_size()
-                max_cache_size = 10 * 1024 * 1024 * 1024  # 10 GB
-                if cache_size > max_cache_size:
-                    # Оставляем 8 GB
-                    target_size = 8 * 1024 * 1024 * 1024
-                    deleted_count = self.cleanup_by_size(target_size)
-                    logger.info(f"Автоочистка кэша: удалено {deleted_count} файлов для уменьшения размера кэша")
+                self._unpin_cooled()
+                expired = await self.expire_idle()
+                if expired > 0:
+                    logger.info(f"Автоочистка кэша: удалено {expired} записей по TTL")
+                if self.total_bytes > self.max_bytes:
+                    await self.evict_to(self.target_bytes)
             except Exception as e:
                 logger.error(f"Ошибка в задаче автоочистки кэша: {e}")
-            # Проверяем каждые 24 часа
-            await asyncio.sleep(24 * 3600)
+            await asyncio.sleep(CACHE_SWEEP_INTERVAL)
 
 # ===== МЕНЕДЖЕР ИСТОРИИ ЗАГРУЗОК =====
 class HistoryManager:
     def __init__(self, db_path="history.db"):
         self.db_path = db_path
-        self._init_db()
-
-    def _init_db(self):
-        """Инициализация базы данных для истории загрузок"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS history (
+        self.db = Database.open(db_path)
+        self.writes = WriteBehindQueue(self.db, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_ROWS)
+        self.fts = False
+        self.db.run_sync(self._init_db)
+
+    @staticmethod
+    def _add_entry_id(conn):
+        """Суррогатный id для постраничного вывода (keyset), название и платформа для поиска"""
+        conn.execute("""
+        CREATE TABLE history_v3 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             url TEXT NOT NULL,
             file_type TEXT NOT NULL,
+            title TEXT,
+            platform TEXT,
+            file_id TEXT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, url, file_type)
+            UNIQUE (user_id, url, file_type)
         )
         """)
-        conn.commit()
-        conn.close()
+        rows = conn.execute("SELECT user_id, url, file_type, timestamp FROM history ORDER BY timestamp").fetchall()
+        conn.executemany(
+            "INSERT INTO history_v3 (user_id, url, file_type, platform, timestamp) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, url, file_type, detect_source(url), timestamp) for user_id, url, file_type, timestamp in rows]
+        )
+        conn.execute("DROP TABLE history")
+        conn.execute("ALTER TABLE history_v3 RENAME TO history")
+        conn.execute("CREATE INDEX idx_history_user_id ON history (user_id, id)")
 
-    def add_to_history(self, user_id: int, url: str, file_type: str) -> bool:
-        """Добавить запись в историю"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @staticmethod
+    def _add_fulltext(conn):
+        """Полнотекстовый индекс FTS5 по ссылке, названию и платформе"""
         try:
-            cursor.execute(
-                "INSERT OR REPLACE INTO history (user_id, url, file_type) VALUES (?, ?, ?)",
-                (user_id, url, file_type)
+            conn.execute(
+                "CREATE VIRTUAL TABLE history_fts USING fts5(url, title, platform, content='history', content_rowid='id')"
             )
-            conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка добавления в историю: {e}")
-            return False
-        finally:
-            conn.close()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 недоступен, поиск по истории будет через LIKE: {e}")
+            return
+        conn.execute("""
+        CREATE TRIGGER history_fts_insert AFTER INSERT ON history BEGIN
+            INSERT INTO history_fts (rowid, url, title, platform) VALUES (new.id, new.url, new.title, new.platform);
+        END
+        """)
+        conn.execute("""
+        CREATE TRIGGER history_fts_delete AFTER DELETE ON history BEGIN
+            INSERT INTO history_fts (history_fts, rowid, url, title, platform)
+            VALUES ('delete', old.id, old.url, old.title, old.platform);
+        END
+        """)
+        conn.execute("""
+        CREATE TRIGGER history_fts_update AFTER UPDATE OF url, title, platform ON history BEGIN
+            INSERT INTO history_fts (history_fts, rowid, url, title, platform)
+            VALUES ('delete', old.id, old.url, old.title, old.platform);
+            INSERT INTO history_fts (rowid, url, title, platform) VALUES (new.id, new.url, new.title, new.platform);
+        END
+        """)
+        conn.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+
+    MIGRATIONS = [
+        (
+            """
+            CREATE TABLE IF NOT EXISTS history (
+                user_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                file_type TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, url, file_type)
+            )
+            """,
+        ),
+        # Последние загрузки пользователя без сортировки всей его истории
+        ("CREATE INDEX IF NOT EXISTS idx_history_user_time ON history (user_id, timestamp DESC)",),
+        _add_entry_id,
+        _add_fulltext,
+        # Индекс по времени пропал вместе со старой таблицей в _add_entry_id
+        ("CREATE INDEX IF NOT EXISTS idx_history_user_time ON history (user_id, timestamp DESC)",),
+    ]
+
+    def _init_db(self, conn):
+        """Инициализация базы данных для истории загрузок"""
+        self.db.migrate(conn, self.MIGRATIONS)
+        self.fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_fts'"
+        ).fetchone() is not None
+
+    async def add_to_history(self, user_id: int, url: str, file_type: str,
+                             title: Optional[str] = None, file_id: Optional[str] = None) -> bool:
+        """Добавить запись в историю (запись на диск — пачкой в фоне).
+        Повторная загрузка поднимает запись наверх, сохраняя известные название и file_id."""
+        self.writes.enqueue(
+            "INSERT OR REPLACE INTO history (user_id, url, file_type, title, platform, file_id) VALUES (?, ?, ?, "
+            "COALESCE(?, (SELECT title FROM history WHERE user_id = ? AND url = ? AND file_type = ?)), ?, "
+            "COALESCE(?, (SELECT file_id FROM history WHERE user_id = ? AND url = ? AND file_type = ?)))",
+            (user_id, url, file_type,
+             title, user_id, url, file_type,
+             detect_source(url),
+             file_id, user_id, url, file_type)
+        )
+        return True
 
-    def get_history(self, user_id: int, limit=10) -> List[Tuple[str, str, str]]:
-        """Получить историю загрузок пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    async def active_among(self, user_ids: List[int], days: int) -> set:
+        """Кто из user_ids скачивал что-либо за последние days дней.
+        Поиск по индексу idx_history_user_time (user_id, timestamp), восстановленному миграцией 5"""
+        if not user_ids:
+            return set()
+        marks = ", ".join("?" for _ in user_ids)
+        rows = await self.db.fetchall(
+            f"SELECT DISTINCT user_id FROM history WHERE user_id IN ({marks}) AND timestamp >= datetime('now', ?)",
+            (*user_ids, f"-{int(days)} days")
+        )
+        return {row[0] for row in rows}
+
+    async def get_page(self, user_id: int, before_id: Optional[int] = None, after_id: Optional[int] = None,
+                       query: Optional[str] = None, limit: int = 5) -> Tuple[list, bool, bool]:
+        """Страница истории по ключу id (без OFFSET): записи старше before_id или новее after_id.
+        Возвращает (записи от новых к старым, есть ли старше, есть ли новее)"""
         try:
-            cursor.execute(
-                "SELECT url, file_type, timestamp FROM history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-                (user_id, limit)
-            )
-            return cursor.fetchall()
+            await self.writes.flush()
+            return await self.db.run(self._page, user_id, before_id, after_id, query, limit)
         except Exception as e:
             logger.error(f"Ошибка получения истории: {e}")
-            return []
-        finally:
-            conn.close()
+            return [], False, False
+
+    def _page(self, conn, user_id, before_id, after_id, query, limit):
+        source = "history h"
+        where = ["h.user_id = ?"]
+        params: list = [user_id]
+        if query and self.fts:
+            source = "history_fts JOIN history h ON h.id = history_fts.rowid"
+            where.append("history_fts MATCH ?")
+            # Каждое слово — префиксный поиск, спецсимволы FTS экранируются кавычками
+            params.append(" ".join('"' + token.replace('"', '""') + '"*' for token in query.split()))
+        elif query:
+            where.append("(h.url LIKE ? OR h.title LIKE ? OR h.platform LIKE ?)")
+            params += [f"%{query}%"] * 3
+        select = f"SELECT h.id, h.url, h.file_type, h.title, h.platform, h.timestamp FROM {source} WHERE "
+        if after_id is not None:
+            rows = conn.execute(
+                select + " AND ".join(where + ["h.id > ?"]) + " ORDER BY h.id ASC LIMIT ?",
+                (*params, after_id, limit + 1)
+            ).fetchall()
+            has_newer = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_older = bool(rows) and self._exists(conn, source, where, params, "h.id < ?", rows[-1][0])
+        else:
+            condition = [] if before_id is None else ["h.id < ?"]
+            rows = conn.execute(
+                select + " AND ".join(where + condition) + " ORDER BY h.id DESC LIMIT ?",
+                (*params, *([] if before_id is None else [before_id]), limit + 1)
+            ).fetchall()
+            has_older = len(rows) > limit
+            rows = rows[:limit]
+            has_newer = bool(rows) and self._exists(conn, source, where, params, "h.id > ?", rows[0][0])
+        return rows, has_older, has_newer
+
+    @staticmethod
+    def _exists(conn, source, where, params, condition, entry_id) -> bool:
+        return conn.execute(
+            f"SELECT 1 FROM {source} WHERE " + " AND ".join(where + [condition]) + " LIMIT 1",
+            (*params, entry_id)
+        ).fetchone() is not None
+
+    async def get_entry(self, user_id: int, entry_id: int) -> Optional[Tuple[str, str, Optional[str], Optional[str]]]:
+        """Запись истории пользователя: (url, тип, название, file_id)"""
+        await self.writes.flush()
+        return await self.db.fetchone(
+            "SELECT url, file_type, title, file_id FROM history WHERE id = ? AND user_id = ?",
+            (entry_id, user_id)
+        )
 
-    def clear_history(self, user_id: int) -> bool:
+    def set_file_id(self, user_id: int, url: str, file_type: str, file_id: str):
+        """Запомнить file_id отправленного файла для повторной отправки без загрузки"""
+        self.writes.enqueue(
+            "UPDATE history SET file_id = ? WHERE user_id = ? AND url = ? AND file_type = ?",
+            (file_id, user_id, url, file_type)
+        )
+
+    async def clear_history(self, user_id: int) -> bool:
         """Очистить историю пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         try:
-            cursor.execute(
+            await self.writes.flush()
+            await self.db.execute(
                 "DELETE FROM history WHERE user_id = ?",
                 (user_id,)
             )
-            conn.commit()
             return True
         except Exception as e:
             logger.error(f"Ошибка очистки истории: {e}")
             return False
+
+    async def close(self):
+        await self.writes.close()
+
+# ===== КЭШ НОРМАЛИЗАЦИИ ССЫЛОК =====
+class NormalizationCache:
+    """Ограниченный LRU+TTL кэш «исходная ссылка → нормализованная».
+    Значение None — негативная запись («не видео»), живёт меньше обычной.
+    При указании db_path записи сохраняются в SQLite и переживают перезапуск."""
+    def __init__(self, max_size=5000, ttl=6 * 3600, negative_ttl=600, db_path: str = ""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.db_path = db_path
+        self._entries: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.db: Optional[Database] = None
+        if self.db_path:
+            self.db = Database.open(self.db_path)
+            self.db.run_sync(self._init_db)
+            self.db.run_sync(self._load)
+
+    MIGRATIONS = [
+        (
+            """
+            CREATE TABLE IF NOT EXISTS normalized_urls (
+                url TEXT PRIMARY KEY,
+                normalized TEXT,
+                expires_at REAL NOT NULL
+            )
+            """,
+        ),
+        ("CREATE INDEX IF NOT EXISTS idx_normalized_expires ON normalized_urls (expires_at)",),
+    ]
+
+    def _init_db(self, conn):
+        """Инициализация SQLite для сохранения кэша"""
+        self.db.migrate(conn, self.MIGRATIONS)
+
+    def _load(self, conn):
+        """Загрузка неистёкших записей при старте"""
+        try:
+            now = time.time()
+            with conn:
+                conn.execute("DELETE FROM normalized_urls WHERE expires_at < ?", (now,))
+            rows = conn.execute(
+                "SELECT url, normalized, expires_at FROM normalized_urls ORDER BY expires_at DESC LIMIT ?",
+                (self.max_size,)
+            ).fetchall()
+            for url, normalized, expires_at in reversed(rows):
+                self._entries[url] = (normalized, expires_at)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша нормализации: {e}")
+
+    def get(self, url: str) -> Tuple[bool, Optional[str]]:
+        """Возвращает (найдено, значение); значение None — негативная запись"""
+        entry = self._entries.get(url)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        normalized, expires_at = entry
+        if expires_at < time.time():
+            del self._entries[url]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(url)
+        if normalized is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, normalized
+
+    def put(self, url: str, normalized: Optional[str]):
+        """Сохранить результат нормализации (None — «не видео»)"""
+        expires_at = time.time() + (self.ttl if normalized is not None else self.negative_ttl)
+        self._entries[url] = (normalized, expires_at)
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        if self.db is not None:
+            # Запись в фоне: вызывающему не нужно ждать диска
+            self.db.submit(self._persist, url, normalized, expires_at)
+
+    @staticmethod
+    def _persist(conn, url: str, normalized: Optional[str], expires_at: float):
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO normalized_urls (url, normalized, expires_at) VALUES (?, ?, ?)",
+                    (url, normalized, expires_at)
+                )
+        except Exception as e:
+            logger.error(f"Ошибка сохранения кэша нормализации: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.negative_hits) / total if total else 0.0,
+        }
+
+# Общий для всех нормализаторов кэш
+normalization_cache = NormalizationCache(db_path=NORMALIZE_CACHE_DB)
+# Ключи контента, которые yt-dlp вернул для ссылок без распознаваемого id
+content_key_aliases = NormalizationCache(max_size=20000, ttl=7 * 24 * 3600)
+# Нормализации, выполняющиеся прямо сейчас (одна сетевая попытка на ссылку)
+_NORMALIZE_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+# ===== ИСХОДЯЩИЕ ЗАПРОСЫ К TELEGRAM =====
+# Классы приоритета исходящих запросов (меньше — важнее)
+PRIORITY_FILE = 0       # отправка файлов
+PRIORITY_FINAL = 1      # итоговые статусы и ответы пользователю
+PRIORITY_PROGRESS = 2   # промежуточный прогресс
+PRIORITY_ACTION = 3     # «печатает…», «отправляет видео…»
+PRIORITY_BULK = 4       # рассылки
+PRIORITY_NAMES = ("файлы", "итоги", "прогресс", "действия", "рассылки")
+
+# Класс запроса, заданный вызывающим кодом:
+# (приоритет, повторять ли после RetryAfter, ждать ли лимита чата)
+OUTBOUND_CLASS: ContextVar[Optional[Tuple[int, bool, bool]]] = ContextVar("outbound_class", default=None)
+
+@contextmanager
+def outbound_class(priority: int, retry: bool = True, chat_limit: bool = True):
+    """Задать класс запросов к Telegram внутри блока.
+    chat_limit=False — частоту в чате уже ограничил вызывающий (StatusEditor): запрос не ждёт
+    лимита чата (только конца flood wait), но расходует его запас, чтобы остальные запросы
+    в этот чат это учитывали."""
+    token = OUTBOUND_CLASS.set((priority, retry, chat_limit))
+    try:
+        yield
+    finally:
+        OUTBOUND_CLASS.reset(token)
+
+class OutboundRequest:
+    """Запрос, ожидающий очереди на отправку"""
+    __slots__ = ("chat_id", "priority", "future", "weight", "chat_limit", "queued_at")
+
+    def __init__(self, chat_id, priority: int, future: asyncio.Future, queued_at: float,
+                 weight: int = 1, chat_limit: bool = True):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future = future
+        self.weight = weight  # сколько сообщений отправит запрос (альбом — по числу файлов)
+        self.chat_limit = chat_limit
+        self.queued_at = queued_at
+
+class TelegramGateway(BaseRequestMiddleware):
+    """Общий шлюз исходящих запросов (middleware сессии бота).
+    Запросы в чаты ждут очереди по приоритету с общим лимитом и лимитом на чат;
+    альбом расходует запас по числу файлов (запас может уйти в долг, который затем отрабатывается).
+    После RetryAfter чат приостанавливается, а запрос ставится в очередь повторно.
+    Запросы без chat_id (getUpdates, getMe, answerCallbackQuery) идут напрямую."""
+    FILE_METHODS = (SendVideo, SendAudio, SendDocument, SendPhoto, SendMediaGroup, SendAnimation, SendVoice)
+    ACTION_TTL = 5.0  # действие в чате показывается 5 секунд — позже отправлять его бессмысленно
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, group_rate: float = 20 / 60,
+                 burst: float = 3.0, max_attempts: int = 3, memory: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.memory = memory
+        self.clock = clock  # источник монотонного времени (в тестах — время цикла событий)
+        self._queues: List[deque] = [deque() for _ in PRIORITY_NAMES]
+        self._global_tokens = burst
+        self._global_updated = clock()
+        # chat_id -> [запас, время обновления, пауза до]
+        self._chats: Dict[Any, List[float]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.granted = [0] * len(PRIORITY_NAMES)
+        self.queue_time = [0.0] * len(PRIORITY_NAMES)
+        self.max_queue_time = [0.0] * len(PRIORITY_NAMES)
+        self.flood_waits = 0
+        self.rescheduled = 0
+        self.dropped_actions = 0
+
+    def _classify(self, method) -> int:
+        if isinstance(method, SendChatAction):
+            return PRIORITY_ACTION
+        if isinstance(method, self.FILE_METHODS):
+            return PRIORITY_FILE
+        return PRIORITY_FINAL
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        priority, retry, chat_limit = OUTBOUND_CLASS.get() or (self._classify(method), True, True)
+        weight = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        attempt = 0
+        while True:
+            attempt += 1
+            if not await self._wait_turn(chat_id, priority, weight, chat_limit, retried=attempt > 1):
+                # Устаревшее действие в чате не отправляем
+                return True
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                self._pause_chat(chat_id, e.retry_after)
+                if not retry or attempt >= self.max_attempts:
+                    raise
+                self.rescheduled += 1
+                logger.warning(f"Flood wait {e.retry_after} с в чате {chat_id}: {type(method).__name__} повторно в очереди")
+
+    async def _wait_turn(self, chat_id, priority: int, weight: int = 1, chat_limit: bool = True,
+                         retried: bool = False) -> bool:
+        request = OutboundRequest(chat_id, priority, asyncio.get_running_loop().create_future(), self.clock(),
+                                  weight, chat_limit)
+        # Повтор после flood wait встаёт в начало своего класса
+        if retried:
+            self._queues[priority].appendleft(request)
+        else:
+            self._queues[priority].append(request)
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return await request.future
+
+    def _chat_rate(self, chat_id) -> float:
+        # Отрицательный id или @username — группа или канал
+        return self.chat_rate if isinstance(chat_id, int) and chat_id > 0 else self.group_rate
+
+    def _chat_tokens(self, chat_id, state: List[float], now: float) -> float:
+        """Запас чата на момент now (во время паузы не копится)"""
+        tokens, updated, paused_until = state
+        return min(self.burst, tokens + max(0.0, now - max(updated, paused_until)) * self._chat_rate(chat_id))
+
+    def _chat_wait(self, chat_id, now: float) -> float:
+        state = self._chats.get(chat_id)
+        if state is None:
+            return 0.0
+        if now < state[2]:
+            return state[2] - now
+        tokens = self._chat_tokens(chat_id, state, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self._chat_rate(chat_id)
+
+    def _consume(self, chat_id, now: float, weight: int = 1):
+        self._global_tokens -= weight
+        state = self._chats.get(chat_id)
+        if state is None:
+            self._chats[chat_id] = [self.burst - weight, now, 0.0]
+        else:
+            state[0], state[1] = self._chat_tokens(chat_id, state, now) - weight, now
+        if len(self._chats) > self.memory:
+            # Забываем только простаивающие чаты: без паузы и с полностью восстановленным запасом
+            self._chats = {
+                chat: state for chat, state in self._chats.items()
+                if now < state[2] or self._chat_tokens(chat, state, now) < self.burst
+            }
+
+    def _pause_chat(self, chat_id, seconds: float):
+        now = self.clock()
+        state = self._chats.setdefault(chat_id, [0.0, now, 0.0])
+        # После паузы — ровно один запрос, дальше по обычному лимиту
+        state[0] = 1.0
+        state[1] = now
+        state[2] = max(state[2], now + seconds)
+        self._wakeup.set()
+
+    def _dispatch(self) -> Optional[float]:
+        """Выдать очередь всем готовым запросам; вернуть время до следующей проверки"""
+        now = self.clock()
+        self._global_tokens = min(self.burst, self._global_tokens + (now - self._global_updated) * self.global_rate)
+        self._global_updated = now
+        delay = None
+        for priority, queue in enumerate(self._queues):
+            waiting = deque()
+            while queue:
+                request = queue.popleft()
+                if request.future.done():
+                    # Вызывающий отменён
+                    continue
+                if priority == PRIORITY_ACTION and now - request.queued_at > self.ACTION_TTL:
+                    self.dropped_actions += 1
+                    request.future.set_result(False)
+                    continue
+                if self._global_tokens < 1:
+                    waiting.append(request)
+                    continue
+                if request.chat_limit:
+                    wait = self._chat_wait(request.chat_id, now)
+                else:
+                    # Без лимита чата запрос всё равно ждёт конца flood wait в нём
+                    wait = max(0.0, self._chats.get(request.chat_id, (0.0, 0.0, 0.0))[2] - now)
+                if wait > 0:
+                    delay = wait if delay is None else min(delay, wait)
+                    waiting.append(request)
+                    continue
+                self._consume(request.chat_id, now, request.weight)
+                queued = now - request.queued_at
+                self.granted[priority] += 1
+                self.queue_time[priority] += queued
+                self.max_queue_time[priority] = max(self.max_queue_time[priority], queued)
+                request.future.set_result(True)
+            self._queues[priority] = waiting
+        if self._global_tokens < 1 and any(self._queues):
+            global_wait = (1 - self._global_tokens) / self.global_rate
+            delay = global_wait if delay is None else min(delay, global_wait)
+        return delay
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        """Остановить диспетчер; запросы, так и не получившие очереди, отменяются"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for queue in self._queues:
+            for request in queue:
+                request.future.cancel()
+            queue.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": sum(len(queue) for queue in self._queues),
+            "flood_waits": self.flood_waits,
+            "rescheduled": self.rescheduled,
+            "dropped_actions": self.dropped_actions,
+            "classes": [
+                (name, self.granted[p], self.queue_time[p] / self.granted[p] if self.granted[p] else 0.0,
+                 self.max_queue_time[p])
+                for p, name in enumerate(PRIORITY_NAMES)
+            ],
+        }
+
+# ===== РАССЫЛКИ =====
+class TokenBucket:
+    """Ограничитель частоты: rate разрешений в секунду, запас не больше capacity.
+    pause() приостанавливает выдачу на время flood wait от Telegram."""
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self.waited = 0.0
+
+    async def acquire(self):
+        # Блокировка выдаёт разрешения по очереди (asyncio.Lock справедлив)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            # Во время паузы запас не копится
+            self._tokens = 0.0
+            self._updated = until
+
+BROADCAST_SEGMENT_RE = re.compile(r"\s*(lang|active|inactive)=(\S+)", re.IGNORECASE)
+BROADCAST_SEGMENT_KEYS = {"lang": "language", "active": "active_days", "inactive": "inactive_days"}
+
+def parse_broadcast_segment(args: str) -> Tuple[Dict[str, Any], str]:
+    """Фильтры получателей в начале аргументов /addnews: lang=ru active=30 inactive=90.
+    Возвращает (сегмент, оставшийся текст)."""
+    segment: Dict[str, Any] = {}
+    while True:
+        m = BROADCAST_SEGMENT_RE.match(args)
+        if not m:
+            break
+        key, value = BROADCAST_SEGMENT_KEYS[m.group(1).lower()], m.group(2)
+        if key == "language":
+            segment[key] = value.lower()
+        elif value.isdigit() and int(value) > 0:
+            segment[key] = int(value)
+        else:
+            break
+        args = args[m.end():]
+    return segment, args.strip()
+
+def describe_segment(segment: Dict[str, Any]) -> str:
+    parts = []
+    if segment.get("language"):
+        parts.append(f"язык {segment['language']}")
+    if segment.get("active_days"):
+        parts.append(f"активны за {segment['active_days']} дн.")
+    if segment.get("inactive_days"):
+        parts.append(f"неактивны {segment['inactive_days']}+ дн.")
+    return ", ".join(parts) or "все пользователи"
+
+class BroadcastJob:
+    """Состояние одной рассылки"""
+    __slots__ = ("id", "payload", "chat_id", "progress_message_id", "cursor", "total", "sent", "failed", "blocked")
+
+    def __init__(self, id: int, payload: dict, chat_id: int, progress_message_id: Optional[int],
+                 cursor: int = 0, sent: int = 0, failed: int = 0, blocked: int = 0):
+        self.id = id
+        self.payload = payload
+        self.chat_id = chat_id
+        self.progress_message_id = progress_message_id
+        self.cursor = cursor  # последний обработанный user_id (получатели идут по возрастанию)
+        self.total = 0
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+class BroadcastManager:
+    """Фоновые рассылки с общим лимитом частоты, ограниченной параллельностью и учётом RetryAfter.
+    Прогресс сохраняется после каждой пачки получателей, незавершённые рассылки продолжаются после перезапуска."""
+    CHUNK_SIZE = 100
+    MAX_ATTEMPTS = 3
+    PROGRESS_INTERVAL = 5.0
+
+    def __init__(self, db_path="broadcasts.db", rate: float = 28.0, concurrency: int = 8):
+        self.db = Database.open(db_path)
+        self.limiter = TokenBucket(rate)
+        self.concurrency = concurrency
+        self._jobs: Dict[int, asyncio.Task] = {}
+        self._cancelled: set = set()
+        self._stopping = False
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.flood_waits = 0
+        self.db.run_sync(self._init_db)
+
+    MIGRATIONS = [
+        (
+            """
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                chat_id INTEGER NOT NULL,
+                progress_message_id INTEGER,
+                cursor INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                finished_at DATETIME
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)",
+        ),
+    ]
+
+    def _init_db(self, conn):
+        self.db.migrate(conn, self.MIGRATIONS)
+
+    async def start(self, payload: dict, chat_id: int, progress_message_id: Optional[int]) -> int:
+        """Создать рассылку и запустить её в фоне, возвращает номер рассылки"""
+        def _insert(conn):
+            with conn:
+                return conn.execute(
+                    "INSERT INTO broadcasts (payload, chat_id, progress_message_id) VALUES (?, ?, ?)",
+                    (json.dumps(payload, ensure_ascii=False), chat_id, progress_message_id)
+                ).lastrowid
+        broadcast_id = await self.db.run(_insert)
+        self._spawn(BroadcastJob(broadcast_id, payload, chat_id, progress_message_id))
+        return broadcast_id
+
+    async def resume(self):
+        """Продолжить рассылки, прерванные остановкой бота"""
+        rows = await self.db.fetchall(
+            "SELECT id, payload, chat_id, progress_message_id, cursor, sent, failed, blocked "
+            "FROM broadcasts WHERE status = 'running' ORDER BY id"
+        )
+        for broadcast_id, payload, chat_id, progress_message_id, cursor, sent, failed, blocked in rows:
+            if broadcast_id in self._jobs:
+                continue
+            job = BroadcastJob(broadcast_id, json.loads(payload), chat_id, progress_message_id,
+                               cursor, sent, failed, blocked)
+            logger.info(f"Продолжаю рассылку #{broadcast_id} с пользователя {cursor} ({job.done} уже обработано)")
+            self._spawn(job)
+
+    def cancel(self, broadcast_id: int) -> bool:
+        if broadcast_id not in self._jobs:
+            return False
+        self._cancelled.add(broadcast_id)
+        return True
+
+    def _spawn(self, job: BroadcastJob):
+        task = asyncio.create_task(self._run(job))
+        self._jobs[job.id] = task
+        task.add_done_callback(partial(self._finished, job.id))
+
+    def _finished(self, broadcast_id: int, task: asyncio.Task):
+        self._jobs.pop(broadcast_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            # Статус остаётся 'running': рассылка продолжится при следующем запуске
+            logger.error(f"Рассылка #{broadcast_id} прервана: {task.exception()}")
+
+    @staticmethod
+    def _markup(buttons: list) -> Optional[InlineKeyboardMarkup]:
+        if not buttons:
+            return None
+        row_buttons = [InlineKeyboardButton(text=label, url=url) for label, url in buttons]
+        return InlineKeyboardMarkup(inline_keyboard=[row_buttons[i:i + 2] for i in range(0, len(row_buttons), 2)])
+
+    @staticmethod
+    def _control_kb(broadcast_id: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="⛔ Остановить", callback_data=f"broadcast:cancel:{broadcast_id}")
+        ]])
+
+    async def _recipients(self, segment: Dict[str, Any], after_id: int):
+        """Получатели пачками с фильтрами сегмента: язык — из настроек, активность — из истории загрузок.
+        Вместе с пачкой отдаётся последний просмотренный id (курсор), даже если фильтр оставил её пустой."""
+        active_days = segment.get("active_days")
+        inactive_days = segment.get("inactive_days")
+        async for chunk in user_settings.iter_user_ids(after_id, segment.get("language"), self.CHUNK_SIZE):
+            last_id = chunk[-1]
+            if active_days:
+                active = await history_manager.active_among(chunk, active_days)
+                chunk = [uid for uid in chunk if uid in active]
+            if inactive_days:
+                recent = await history_manager.active_among(chunk, inactive_days)
+                chunk = [uid for uid in chunk if uid not in recent]
+            yield chunk, last_id
+
+    async def _run(self, job: BroadcastJob):
+        markup = self._markup(job.payload.get("buttons"))
+        segment = job.payload.get("segment") or {}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # С фильтром по активности это верхняя граница: часть пользователей отсеется
+        job.total = job.done + await user_settings.count_user_ids(job.cursor, segment.get("language"))
+        estimate = "≤" if segment.get("active_days") or segment.get("inactive_days") else ""
+        last_report = 0.0
+        status = "done"
+        async with aclosing(self._recipients(segment, job.cursor)) as chunks:
+            async for chunk, last_id in chunks:
+                if job.id in self._cancelled:
+                    status = "cancelled"
+                    break
+                if self._stopping:
+                    # Остаётся 'running' — продолжится при следующем запуске
+                    return
+                if time.monotonic() - last_report >= self.PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    self._edit_progress(
+                        job, f"📤 Рассылка #{job.id}: {job.done}/{estimate}{job.total}", self._control_kb(job.id)
+                    )
+                results = await asyncio.gather(*(self._deliver(semaphore, uid, job.payload, markup) for uid in chunk))
+                for result in results:
+                    setattr(job, result, getattr(job, result) + 1)
+                    setattr(self, result, getattr(self, result) + 1)
+                job.cursor = last_id
+                await self._checkpoint(job)
+        self._cancelled.discard(job.id)
+        await self._checkpoint(job, status)
+        await self._report(job, status)
+
+    async def _deliver(self, semaphore: asyncio.Semaphore, user_id: int, payload: dict,
+                       markup: Optional[InlineKeyboardMarkup]) -> str:
+        """Отправить одному получателю: 'sent', 'blocked' или 'failed'"""
+        async with semaphore:
+            for _ in range(self.MAX_ATTEMPTS):
+                await self.limiter.acquire()
+                try:
+                    await self._send(user_id, payload, markup)
+                    return "sent"
+                except TelegramRetryAfter as e:
+                    # Flood wait распространяется на весь бот — останавливаем общий лимитер
+                    self.flood_waits += 1
+                    logger.warning(f"Рассылка: flood wait {e.retry_after} с")
+                    self.limiter.pause(e.retry_after)
+                except TelegramForbiddenError:
+                    await user_settings.mark_blocked(user_id)
+                    return "blocked"
+                except Exception as e:
+                    logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+                    return "failed"
+            return "failed"
+
+    @staticmethod
+    async def _send(user_id: int, payload: dict, markup: Optional[InlineKeyboardMarkup]):
+        media_type = payload.get("media_type")
+        # Рассылка уступает интерактивным запросам; RetryAfter обрабатывает _deliver
+        with outbound_class(PRIORITY_BULK, retry=False):
+            if media_type:
+                # send_photo / send_video / send_document / send_audio
+                sender = getattr(bot, f"send_{media_type}")
+                await sender(user_id, payload["media_file"], caption=payload["text"],
+                             parse_mode="HTML", reply_markup=markup)
+            else:
+                await bot.send_message(user_id, payload["text"], parse_mode="HTML",
+                                       reply_markup=markup, disable_web_page_preview=True)
+
+    async def _checkpoint(self, job: BroadcastJob, status: str = "running"):
+        await self.db.execute(
+            "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, blocked = ?, status = ?, "
+            "finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END WHERE id = ?",
+            (job.cursor, job.sent, job.failed, job.blocked, status, status, job.id)
+        )
+
+    def _edit_progress(self, job: BroadcastJob, text: str, markup: Optional[InlineKeyboardMarkup] = None,
+                       final: bool = False):
+        if job.progress_message_id:
+            status_editor.submit(job.chat_id, job.progress_message_id, text, final=final, reply_markup=markup)
+
+    async def _report(self, job: BroadcastJob, status: str):
+        title = "⛔ Рассылка остановлена" if status == "cancelled" else "✅ Рассылка завершена"
+        report_text = (
+            f"{title} (#{job.id})\n\nОтправлено: {job.sent}\nЗаблокировали бота: {job.blocked}\n"
+            f"Не удалось: {job.failed}"
+        )
+        if job.blocked:
+            report_text += "\n\nЗаблокировавшие бота исключены из следующих рассылок."
+        self._edit_progress(job, report_text, final=True)
+        try:
+            await bot.send_message(job.chat_id, report_text)
+        except Exception as e:
+            logger.error(f"Не удалось отправить отчёт о рассылке #{job.id}: {e}")
+
+    async def close(self, timeout: float = 10.0):
+        """Остановить рассылки после текущей пачки; прогресс сохранён в базе"""
+        self._stopping = True
+        tasks = list(self._jobs.values())
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._jobs),
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "flood_waits": self.flood_waits,
+            "limiter_wait": self.limiter.waited,
+        }
+
+# ===== ПЛАНИРОВЩИК ПРАВОК СТАТУСА =====
+class PendingEdit:
+    """Ожидающая правка сообщения (для сообщения хранится только последняя)"""
+    __slots__ = ("chat_id", "message_id", "text", "kwargs", "final", "waiters", "queued_at")
+
+    def __init__(self, chat_id: int, message_id: int, text: str, kwargs: dict, final: bool):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.kwargs = kwargs
+        self.final = final
+        self.waiters: List[asyncio.Future] = []
+        self.queued_at = time.monotonic()
+
+class StatusEditor:
+    """Единая очередь правок статусных сообщений.
+    Для сообщения хранится только последний ожидающий текст, неизменившийся текст не отправляется,
+    частота правок ограничена в каждом чате и на весь бот. Финальные состояния («готово», «ошибка»)
+    уходят раньше промежуточного прогресса, а поздний прогресс после финала отбрасывается."""
+    MAX_IN_FLIGHT = 4
+
+    def __init__(self, global_rate: float = 20.0, chat_interval: float = 1.0, group_interval: float = 3.0,
+                 memory: int = 10000):
+        self.limiter = TokenBucket(global_rate)
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.memory = memory
+        self._pending: "OrderedDict[Tuple[int, int], PendingEdit]" = OrderedDict()
+        # Последнее применённое состояние сообщения: (текст, разметка, финальное ли)
+        self._applied: "OrderedDict[Tuple[int, int], Tuple[str, Any, bool]]" = OrderedDict()
+        self._in_flight: Dict[Tuple[int, int], PendingEdit] = {}
+        self._chat_ready: Dict[int, float] = {}
+        self._slots = asyncio.Semaphore(self.MAX_IN_FLIGHT)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.unchanged = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.total_delay = 0.0
+
+    def submit(self, chat_id: int, message_id: int, text: str, *, final: bool = False, **kwargs):
+        """Поставить правку в очередь без ожидания (можно вызывать из call_soon_threadsafe)"""
+        self._put(chat_id, message_id, text, final, kwargs, None)
+
+    async def edit(self, chat_id: int, message_id: int, text: str, *, final: bool = False, **kwargs) -> bool:
+        """Поставить правку и дождаться её применения.
+        False — правка отброшена (уже показан финальный статус); ошибки Telegram пробрасываются."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._put(chat_id, message_id, text, final, kwargs, waiter)
+        return await waiter
+
+    def _put(self, chat_id: int, message_id: int, text: str, final: bool, kwargs: dict,
+             waiter: Optional[asyncio.Future]):
+        self.submitted += 1
+        key = (chat_id, message_id)
+        applied = self._applied.get(key)
+        item = self._pending.get(key)
+        sending = self._in_flight.get(key)
+        if not final and ((applied is not None and applied[2]) or (item is not None and item.final)
+                          or (sending is not None and sending.final)):
+            self.dropped += 1
+            if waiter is not None:
+                waiter.set_result(False)
+            return
+        if item is None:
+            item = self._pending[key] = PendingEdit(chat_id, message_id, text, kwargs, final)
+        else:
+            # Промежуточный текст заменяется последним, очередь сообщения сохраняется
+            self.coalesced += 1
+            item.text, item.kwargs, item.final = text, kwargs, final
+        if waiter is not None:
+            item.waiters.append(waiter)
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _interval(self, chat_id: int) -> float:
+        # Отрицательный id — группа или канал: там лимит строже
+        return self.group_interval if chat_id < 0 else self.chat_interval
+
+    def _next_ready(self) -> Tuple[Optional[Tuple[int, int]], Optional[float]]:
+        """Ключ следующей правки (сначала финальные) или время до ближайшей готовности"""
+        now = time.monotonic()
+        first_progress = None
+        delay = None
+        for key, item in self._pending.items():
+            if key in self._in_flight:
+                continue
+            wait = self._chat_ready.get(item.chat_id, 0.0) - now
+            if wait > 0:
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            if item.final:
+                return key, None
+            if first_progress is None:
+                first_progress = key
+        return first_progress, delay
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            key, delay = self._next_ready()
+            if key is None:
+                if self._closing and not self._pending and not self._in_flight:
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            item = self._pending[key]
+            applied = self._applied.get(key)
+            if applied is not None and applied[:2] == (item.text, item.kwargs.get("reply_markup")):
+                del self._pending[key]
+                self.unchanged += 1
+                self._applied[key] = (applied[0], applied[1], applied[2] or item.final)
+                self._resolve(item, True)
+                continue
+            await self._slots.acquire()
+            await self.limiter.acquire()
+            item = self._pending.pop(key, None)
+            if item is None:
+                self._slots.release()
+                continue
+            self._in_flight[key] = item
+            self._chat_ready[item.chat_id] = time.monotonic() + self._interval(item.chat_id)
+            asyncio.create_task(self._apply(key, item))
+
+    async def _apply(self, key: Tuple[int, int], item: PendingEdit):
+        try:
+            try:
+                # RetryAfter возвращается сюда: повтор с учётом более свежего текста делает сам планировщик
+                # Частоту правок в чате StatusEditor ограничивает сам — второй лимит шлюза не нужен
+                priority = PRIORITY_FINAL if item.final else PRIORITY_PROGRESS
+                with outbound_class(priority, retry=False, chat_limit=False):
+                    await bot.edit_message_text(
+                        item.text, chat_id=item.chat_id, message_id=item.message_id, **item.kwargs
+                    )
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                self._chat_ready[item.chat_id] = time.monotonic() + e.retry_after
+                newer = self._pending.get(key)
+                if newer is None:
+                    self._pending[key] = item
+                    self._pending.move_to_end(key, last=False)
+                else:
+                    newer.waiters.extend(item.waiters)
+                return
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+            self.sent += 1
+            self.total_delay += time.monotonic() - item.queued_at
+            self._remember(key, item)
+            self._resolve(item, True)
+        except Exception as e:
+            self.failed += 1
+            logger.debug(f"Не удалось обновить статус {item.chat_id}/{item.message_id}: {e}")
+            self._resolve(item, e)
         finally:
-            conn.close()
+            self._in_flight.pop(key, None)
+            self._slots.release()
+            self._wakeup.set()
+
+    def _remember(self, key: Tuple[int, int], item: PendingEdit):
+        self._applied[key] = (item.text, item.kwargs.get("reply_markup"), item.final)
+        self._applied.move_to_end(key)
+        while len(self._applied) > self.memory:
+            self._applied.popitem(last=False)
+        if len(self._chat_ready) > self.memory:
+            now = time.monotonic()
+            self._chat_ready = {chat: ready for chat, ready in self._chat_ready.items() if ready > now}
+
+    @staticmethod
+    def _resolve(item: PendingEdit, outcome):
+        for waiter in item.waiters:
+            if waiter.done():
+                continue
+            if isinstance(outcome, Exception):
+                waiter.set_exception(outcome)
+            else:
+                waiter.set_result(outcome)
+
+    async def close(self, timeout: float = 5.0):
+        """Дослать ожидающие правки (не дольше timeout секунд)"""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено правок статуса: {len(self._pending)}")
+        self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "submitted": self.submitted,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "unchanged": self.unchanged,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "flood_waits": self.flood_waits,
+            "avg_delay": self.total_delay / self.sent if self.sent else 0.0,
+        }
 
 # ===== Глобальные переменные =====
 # Глобальный словарь для хранения временных ссылок для кнопки "Повторить загрузку"
@@ -1214,13 +3519,43 @@ async def cleanup_retry_links():
         # Проверяем каждые 10 минут
         await asyncio.sleep(600)
 
+async def cleanup_pending_links():
+    """Очистка устаревших PENDING_LINKS (с отменой их спекулятивной подготовки) и PENDING_BATCHES"""
+    while True:
+        try:
+            now = time.time()
+            for msg_id, (url, timestamp) in list(PENDING_LINKS.items()):
+                if now - timestamp > PENDING_LINKS_EXPIRY:
+                    del PENDING_LINKS[msg_id]
+                    prefetch_manager.cancel(msg_id)
+            for msg_id, (urls, timestamp) in list(PENDING_BATCHES.items()):
+                if now - timestamp > PENDING_LINKS_EXPIRY:
+                    del PENDING_BATCHES[msg_id]
+        except Exception as e:
+            logger.error(f"Ошибка при очистке PENDING_LINKS: {e}")
+        await asyncio.sleep(60)
+
 # ---- helper functions ----
+def format_size(num_bytes: float) -> str:
+    """Размер для сообщений пользователю: 512 КБ, 48.3 МБ, 1.5 ГБ"""
+    for unit in ("Б", "КБ", "МБ"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "Б" else f"{num_bytes:.1f} {unit}".replace(".0 ", " ")
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} ГБ".replace(".0 ", " ")
+
 def find_first_url(text: str) -> Optional[str]:
     if not text:
         return None
     m = URL_RE.search(text)
     return m.group(0) if m else None
 
+def find_all_urls(text: str) -> List[str]:
+    """Все ссылки из текста без повторов, в порядке появления"""
+    if not text:
+        return []
+    return list(dict.fromkeys(m.group(0) for m in URL_RE.finditer(text)))
+
 def strip_tracking_params(url: str) -> str:
     try:
         p = urlparse(url)
@@ -1228,255 +3563,571 @@ def strip_tracking_params(url: str) -> str:
     except Exception:
         return url
 
-def resolve_redirects(url: str, timeout: int = 10) -> str:
-    """Следуем редиректам — сначала HEAD, затем GET (если нужно)."""
+_http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общий aiohttp-пул соединений для нормализации ссылок"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300)
+        )
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+def canonicalize_url(url: str) -> Optional[Tuple[str, str]]:
+    """(платформа, id контента) по регуляркам платформ или None"""
+    for platform, pattern in CONTENT_ID_PATTERNS:
+        m = pattern.search(url or "")
+        if m:
+            content_id = m.group(1)
+            # У SoundCloud id — это путь, он регистронезависим
+            if platform == "soundcloud":
+                content_id = content_id.lower()
+            return platform, content_id
+    return None
+
+def content_key(url: str) -> str:
+    """Ключ контента для кэша, single-flight и истории.
+    Сначала регулярки платформ, затем ключ yt-dlp, запомненный после первой экстракции,
+    иначе — сама ссылка."""
+    canonical = canonicalize_url(url)
+    if canonical:
+        return f"{canonical[0]}:{canonical[1]}"
+    found, learned = content_key_aliases.get(url)
+    if found and learned:
+        return learned
+    return url
+
+def remember_content_key(url: str, extractor_key: Optional[str], content_id: Optional[str]):
+    """Запоминает ключ extractor_key:id, который yt-dlp вернул для ссылки"""
+    if not extractor_key or not content_id or canonicalize_url(url):
+        return
+    content_key_aliases.put(url, f"{extractor_key.lower()}:{content_id}")
+
+def canonical_url(key: str, fallback: str) -> str:
+    """Ссылка для показа пользователю по ключу контента"""
+    platform, _, content_id = key.partition(":")
+    template = CANONICAL_URL_TEMPLATES.get(platform)
+    if template and content_id:
+        return template.format(id=content_id)
+    return fallback
+
+async def resolve_redirects_async(url: str, session: aiohttp.ClientSession, headers: Optional[dict] = None) -> str:
+    """Следуем редиректам — сначала HEAD, затем GET (если нужно). Каждый шаг ограничен REDIRECT_TIMEOUT.
+    Если не удался и GET, исключение пробрасывается: сетевой сбой — не ответ «это не видео»."""
+    headers = headers or {"User-Agent": "Mozilla/5.0"}
     try:
-        headers = {"User-Agent": "Mozilla/5.0"}
-        r = requests.head(url, allow_redirects=True, timeout=timeout, headers=headers)
-        if r.url:
-            return r.url
+        async with session.head(url, allow_redirects=True, timeout=REDIRECT_TIMEOUT, headers=headers) as resp:
+            return str(resp.url)
     except Exception:
         pass
+    async with session.get(url, allow_redirects=True, timeout=REDIRECT_TIMEOUT, headers=headers) as resp:
+        return str(resp.url)
+
+def raise_for_transient_status(resp: aiohttp.ClientResponse):
+    """429 и 5xx — временный сбой сайта, а не страница без видео"""
+    if resp.status == 429 or resp.status >= 500:
+        resp.raise_for_status()
+
+# ---- потоковый разбор HTML ----
+class HtmlScanTarget:
+    """Искомый фрагмент страницы: начало (регулярка) и конец (строка).
+    Без end результатом считается само совпадение регулярки."""
+    __slots__ = ("name", "start_re", "end", "keep_end", "must_contain")
+
+    def __init__(self, name: str, start_pattern: str, end: Optional[str] = None,
+                 keep_end: int = 0, must_contain: Tuple[str, ...] = ()):
+        self.name = name
+        self.start_re = re.compile(start_pattern, re.IGNORECASE)
+        self.end = end
+        self.keep_end = keep_end  # сколько символов конечного маркера оставить во фрагменте (например, "}")
+        self.must_contain = must_contain  # дешёвая проверка до json.loads
+
+class HtmlStreamScanner:
+    """Однопроходный сканер HTML-ответа: читает тело кусками, отдаёт найденные фрагменты
+    по мере появления и не читает больше max_bytes. Буфер держит только ещё не
+    разобранный хвост, поэтому память ограничена размером самого большого фрагмента."""
+    OVERLAP = 1024  # хвост, в котором может начинаться разорванный между кусками тег
+
+    def __init__(self, targets: List[HtmlScanTarget], max_bytes: int = 4 * 1024 * 1024, chunk_size: int = 64 * 1024):
+        self.targets = targets
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self._buffer = ""
+        # Для каждой цели: откуда искать начало и откуда продолжать поиск конца
+        self._positions = [0] * len(targets)
+        self._end_from = [-1] * len(targets)
+
+    def feed(self, text: str, final: bool = False) -> List[Tuple[str, str]]:
+        """Добавляет текст и возвращает фрагменты, завершившиеся в нём"""
+        buf = self._buffer + text
+        found: List[Tuple[str, str]] = []
+        for i, target in enumerate(self.targets):
+            pos = self._positions[i]
+            while True:
+                m = target.start_re.search(buf, pos)
+                if not m:
+                    pos = len(buf) if final else max(pos, len(buf) - self.OVERLAP)
+                    break
+                if target.end is None:
+                    # Совпадение у самого конца буфера может быть обрезано — ждём следующий кусок
+                    if m.end() == len(buf) and not final:
+                        pos = m.start()
+                        break
+                    found.append((target.name, m.group(0)))
+                    pos = m.end()
+                    continue
+                end_idx = buf.find(target.end, max(m.end(), self._end_from[i]))
+                if end_idx == -1:
+                    pos = m.start()
+                    self._end_from[i] = max(m.end(), len(buf) - len(target.end))
+                    break
+                self._end_from[i] = -1
+                blob = buf[m.end():end_idx + target.keep_end]
+                pos = end_idx + len(target.end)
+                if not target.must_contain or any(tok in blob for tok in target.must_contain):
+                    found.append((target.name, blob))
+            self._positions[i] = pos
+        # Отбрасываем уже разобранное всеми целями начало буфера
+        offset = min(self._positions) if self._positions else len(buf)
+        if offset > 0:
+            buf = buf[offset:]
+            self._positions = [p - offset for p in self._positions]
+            self._end_from = [e - offset if e >= 0 else -1 for e in self._end_from]
+        self._buffer = buf
+        return found
+
+    async def iter_matches(self, resp: aiohttp.ClientResponse):
+        """Асинхронно отдаёт (имя цели, фрагмент); чтение прекращается, как только потребитель остановится"""
+        try:
+            decoder = codecs.getincrementaldecoder(resp.charset or "utf-8")(errors="replace")
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        async for chunk in resp.content.iter_chunked(self.chunk_size):
+            self.bytes_read += len(chunk)
+            for match in self.feed(decoder.decode(chunk)):
+                yield match
+            if self.bytes_read >= self.max_bytes:
+                logger.debug(f"HTML scan stopped at {self.bytes_read} bytes for {resp.url}")
+                break
+        for match in self.feed(decoder.decode(b"", final=True), final=True):
+            yield match
+
+# Порядок целей — приоритет источников: JSON-LD надёжнее SIGI_STATE, тот — og:url и т.д.
+TIKTOK_SCAN_TARGETS = [
+    HtmlScanTarget("jsonld", r'<script[^>]*type=["\']application/ld\+json["\'][^>]*>', "</script>",
+                   must_contain=("contentUrl", "/video/")),
+    HtmlScanTarget("sigi", r'<script[^>]*id=["\']SIGI_STATE["\'][^>]*>', "</script>"),
+    HtmlScanTarget("og_url", r'<meta[^>]+property=["\']og:url["\'][^>]+content=["\']', '"',
+                   must_contain=("/video/",)),
+    HtmlScanTarget("item_id", r'itemId["\']?\s*[:=]\s*["\']?\d{6,}'),
+    HtmlScanTarget("user_video", r'/@[^/"\s]+/video/\d{6,}'),
+]
+TIKTOK_SCAN_MAX_BYTES = 2 * 1024 * 1024
+
+INSTAGRAM_JSON_MARKERS = ("video_url", "videoUrl", "video_versions", "contentUrl", ".mp4")
+INSTAGRAM_SCAN_TARGETS = [
+    HtmlScanTarget("additional_data", r'window\.__additionalDataLoaded\([^,]+,\s*(?={)', "});", keep_end=1,
+                   must_contain=INSTAGRAM_JSON_MARKERS),
+    HtmlScanTarget("json_script", r'<script type="application/json"[^>]*>', "</script>",
+                   must_contain=INSTAGRAM_JSON_MARKERS),
+    HtmlScanTarget("initial_data", r'window\.__initialDataLoaded\([^,]+,\s*(?={)', "});", keep_end=1,
+                   must_contain=INSTAGRAM_JSON_MARKERS),
+    HtmlScanTarget("shared_data", r'window\._{1,2}sharedData\s*=\s*(?={)', "};", keep_end=1,
+                   must_contain=INSTAGRAM_JSON_MARKERS),
+    HtmlScanTarget("graphql", r'window\.__graphql__\s*=\s*(?={)', "};", keep_end=1,
+                   must_contain=INSTAGRAM_JSON_MARKERS),
+    HtmlScanTarget("og_video", r'<meta[^>]+property="og:video"[^>]+content="', '"'),
+]
+INSTAGRAM_SCAN_MAX_BYTES = 4 * 1024 * 1024
+
+# ---- поиск ссылок на видео во вложенном JSON ----
+VIDEO_URL_KEYS = ('video_url', 'videoUrl', 'contentUrl', 'url', 'src')
+VIDEO_VARIANT_KEYS = ('video_versions', 'video_resources')
+VIDEO_SEARCH_MAX_NODES = 50000
+VIDEO_PATH_HINTS_LIMIT = 8
+# Пути (ключи/индексы) к спискам вариантов видео, которые уже срабатывали, по платформам.
+# Самый свежий успешный путь — первый.
+VIDEO_PATH_HINTS: Dict[str, List[Tuple[Any, ...]]] = {
+    "instagram": [
+        ("items", 0, "video_versions"),
+        ("graphql", "shortcode_media", "video_url"),
+        ("shortcode_media", "video_url"),
+    ],
+}
+
+class VideoCandidate:
+    """Вариант видео, найденный в JSON"""
+    __slots__ = ("url", "width", "height", "bitrate", "is_variant")
+
+    def __init__(self, url: str, width: int = 0, height: int = 0, bitrate: int = 0, is_variant: bool = False):
+        self.url = url
+        self.width = width
+        self.height = height
+        self.bitrate = bitrate
+        self.is_variant = is_variant  # из списка video_versions, а не случайная ссылка на .mp4
+
+def _as_int(value) -> int:
     try:
-        r = requests.get(url, allow_redirects=True, timeout=timeout, headers={"User-Agent": "Mozilla/5.0"})
-        return r.url
-    except Exception:
-        return url
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def _is_video_link(value) -> bool:
+    return isinstance(value, str) and value.startswith('http') and ('.mp4' in value or '.mov' in value)
+
+def _video_candidates_at(node: Any, key: Any = None) -> List[VideoCandidate]:
+    """Варианты видео непосредственно в узле (без обхода вглубь)"""
+    found: List[VideoCandidate] = []
+    if isinstance(node, list) and key in VIDEO_VARIANT_KEYS:
+        for v in node:
+            if isinstance(v, dict) and isinstance(v.get('url'), str):
+                found.append(VideoCandidate(
+                    v['url'], _as_int(v.get('width')), _as_int(v.get('height')),
+                    _as_int(v.get('bandwidth') or v.get('bitrate')), is_variant=True
+                ))
+    elif isinstance(node, str) and _is_video_link(node):
+        found.append(VideoCandidate(node))
+    elif isinstance(node, dict):
+        for variant_key in VIDEO_VARIANT_KEYS:
+            if isinstance(node.get(variant_key), list):
+                found.extend(_video_candidates_at(node[variant_key], variant_key))
+        for url_key in VIDEO_URL_KEYS:
+            value = node.get(url_key)
+            if _is_video_link(value):
+                found.append(VideoCandidate(
+                    value,
+                    _as_int(node.get('width') or node.get('original_width')),
+                    _as_int(node.get('height') or node.get('original_height')),
+                    _as_int(node.get('bitrate')),
+                ))
+    return found
+
+def _resolve_json_path(data: Any, path: Tuple[Any, ...]) -> Any:
+    node = data
+    for step in path:
+        if isinstance(step, int):
+            if not isinstance(node, list) or step >= len(node):
+                return None
+        elif not isinstance(node, dict) or step not in node:
+            return None
+        node = node[step]
+    return node
+
+def find_video_candidates(data: Any, platform: str = "") -> Tuple[List[VideoCandidate], Optional[Tuple[Any, ...]]]:
+    """Ищет варианты видео: сначала по известным путям платформы, затем итеративным обходом
+    с явным стеком. Обход останавливается на первом списке вариантов (video_versions),
+    случайные ссылки на .mp4 используются только если такого списка нет.
+    Возвращает (кандидаты, путь, по которому они найдены)."""
+    for path in VIDEO_PATH_HINTS.get(platform, ()):
+        node = _resolve_json_path(data, path)
+        if node is not None:
+            found = _video_candidates_at(node, path[-1] if path else None)
+            if found:
+                return found, path
+
+    loose: List[VideoCandidate] = []
+    loose_path: Optional[Tuple[Any, ...]] = None
+    stack: List[Tuple[Any, Tuple[Any, ...]]] = [(data, ())]
+    visited = 0
+    while stack and visited < VIDEO_SEARCH_MAX_NODES:
+        node, path = stack.pop()
+        visited += 1
+        if isinstance(node, dict):
+            for variant_key in VIDEO_VARIANT_KEYS:
+                if isinstance(node.get(variant_key), list):
+                    variants = _video_candidates_at(node[variant_key], variant_key)
+                    if variants:
+                        return variants, path + (variant_key,)
+            for url_key in VIDEO_URL_KEYS:
+                if _is_video_link(node.get(url_key)):
+                    if not loose:
+                        loose_path = path + (url_key,)
+                    loose.extend(_video_candidates_at(node))
+                    break
+            # В обратном порядке, чтобы обход шёл по документу сверху вниз
+            for k in reversed(list(node.keys())):
+                child = node[k]
+                if isinstance(child, (dict, list)):
+                    stack.append((child, path + (k,)))
+        elif isinstance(node, list):
+            for idx in range(len(node) - 1, -1, -1):
+                child = node[idx]
+                if isinstance(child, (dict, list)):
+                    stack.append((child, path + (idx,)))
+    return loose, loose_path
+
+def pick_video_candidate(candidates: List[VideoCandidate], quality: str = "best") -> Optional[VideoCandidate]:
+    """Выбор варианта по preferred_quality пользователя ("best", "1080p", "720p", "480p")"""
+    if not candidates:
+        return None
+    # Варианты из списков качества надёжнее одиночных ссылок (те бывают превью)
+    pool = [c for c in candidates if c.is_variant] or candidates
 
-def extract_jsonld(html: str) -> Optional[dict]:
-    try:
-        for m in re.finditer(
-            r'<script[^>]*type=["\']application/ld\+json["\'][^>]*>(.*?)</script>',
-            html, re.DOTALL | re.IGNORECASE
-        ):
-            text = m.group(1).strip()
-            try:
-                return json.loads(text)
-            except Exception:
-                try:
-                    return json.loads(text.replace('\n', ''))
-                except Exception:
-                    continue
-    except Exception:
-        pass
-    return None
+    def resolution(c: VideoCandidate) -> int:
+        # "720p" — это меньшая сторона кадра, в том числе у вертикальных видео
+        return min(c.width, c.height) if c.width and c.height else (c.height or c.width)
 
-def extract_sigi_state(html: str) -> Optional[dict]:
+    by_size = lambda c: (resolution(c), c.bitrate)
+    if quality == "best":
+        return max(pool, key=by_size)
     try:
-        m = re.search(r'<script[^>]*id=["\']SIGI_STATE["\'][^>]*>(.*?)</script>', html, re.DOTALL | re.IGNORECASE)
-        if not m:
-            return None
-        text = m.group(1).strip()
-        text = re.sub(r'^\s*(?:window\.)?SIGI_STATE\s*=\s*', '', text)
-        text = text.rstrip(';\n ')
-        try:
-            return json.loads(text)
-        except Exception:
-            mm = re.search(r'"ItemModule"\s*:\s*({.*?})\s*,', text, re.DOTALL)
-            if mm:
-                try:
-                    return {"ItemModule": json.loads(mm.group(1))}
-                except Exception:
-                    return None
-    except Exception:
-        pass
+        target = int(quality.replace('p', ''))
+    except ValueError:
+        return max(pool, key=by_size)
+    exact = [c for c in pool if resolution(c) == target]
+    if exact:
+        return max(exact, key=lambda c: c.bitrate)
+    lower = [c for c in pool if 0 < resolution(c) < target]
+    if lower:
+        return max(lower, key=by_size)
+    return min(pool, key=by_size)
+
+def remember_video_path(platform: str, path: Tuple[Any, ...]):
+    """Поднимает сработавший путь в начало подсказок платформы"""
+    hints = VIDEO_PATH_HINTS.setdefault(platform, [])
+    if path in hints:
+        if hints[0] == path:
+            return
+        hints.remove(path)
+    hints.insert(0, path)
+    del hints[VIDEO_PATH_HINTS_LIMIT:]
+
+def find_best_video_url(data: Any, platform: str = "", quality: str = "best") -> Optional[str]:
+    candidates, path = find_video_candidates(data, platform)
+    best = pick_video_candidate(candidates, quality)
+    if best is None:
+        return None
+    # Запоминаем только пути к спискам вариантов: одиночная ссылка на .mp4 бывает превью
+    if platform and path is not None and any(c.is_variant for c in candidates):
+        remember_video_path(platform, path)
+    return best.url
+
+def _pick_tiktok_from_ld(obj) -> Optional[str]:
+    if not isinstance(obj, dict):
+        return None
+    cu = obj.get("contentUrl")
+    if cu:
+        return strip_tracking_params(cu)
+    u = obj.get("url")
+    if u and "/video/" in u:
+        return strip_tracking_params(u)
     return None
 
-def extract_tiktok_video_from_html(html: str) -> Optional[str]:
-    # 1) JSON-LD
+def tiktok_url_from_jsonld(text: str) -> Optional[str]:
+    """Ссылка на видео из содержимого JSON-LD скрипта"""
+    text = text.strip()
     try:
-        ld = extract_jsonld(html)
-        def pick_from_ld(obj) -> Optional[str]:
-            if not isinstance(obj, dict):
-                return None
-            cu = obj.get("contentUrl")
-            if cu:
-                return strip_tracking_params(cu)
-            u = obj.get("url")
-            if u and "/video/" in u:
-                return strip_tracking_params(u)
+        ld = json.loads(text)
+    except Exception:
+        try:
+            ld = json.loads(text.replace('\n', ''))
+        except Exception:
             return None
-        if isinstance(ld, dict):
-            got = pick_from_ld(ld)
+    if isinstance(ld, dict):
+        return _pick_tiktok_from_ld(ld)
+    if isinstance(ld, list):
+        for el in ld:
+            got = _pick_tiktok_from_ld(el)
             if got:
                 return got
-        elif isinstance(ld, list):
-            for el in ld:
-                got = pick_from_ld(el) if isinstance(el, dict) else None
-                if got:
-                    return got
-    except Exception:
-        pass
-    # 2) SIGI_STATE
+    return None
+
+def tiktok_url_from_sigi(text: str) -> Optional[str]:
+    """Ссылка на видео из содержимого скрипта SIGI_STATE"""
+    text = re.sub(r'^\s*(?:window\.)?SIGI_STATE\s*=\s*', '', text.strip())
+    text = text.rstrip(';\n ')
     try:
-        sigi = extract_sigi_state(html)
-        if sigi:
-            item_module = sigi.get("ItemModule") or {}
-            if isinstance(item_module, dict):
-                for k, v in item_module.items():
-                    vid = None
-                    user = None
-                    if isinstance(v, dict):
-                        vid = v.get("id") or v.get("itemInfos", {}).get("id") or k
-                        user = (
-                            v.get("author") or
-                            v.get("authorInfo") or
-                            v.get("itemInfos", {}).get("author")
-                        )
-                    if vid:
-                        if isinstance(user, dict):
-                            user = user.get("uniqueId") or user.get("nickname")
-                        if user:
-                            return f"https://www.tiktok.com/@{user}/video/{vid}"
-                        return f"https://www.tiktok.com/video/{vid}"
+        sigi = json.loads(text)
     except Exception:
-        pass
-    # 3) og:url
-    m = re.search(r'<meta[^>]+property=["\']og:url["\'][^>]+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
-    if m:
-        u = m.group(1)
-        if "/video/" in u:
-            return strip_tracking_params(u)
-    # 4) itemId
-    m = re.search(r'itemId["\']?\s*[:=]\s*["\']?(\d{6,})["\']?', html)
-    if m:
-        vid = m.group(1)
-        u = re.search(r'"uniqueId"\s*:\s*"([^"]+)"', html)
-        if u:
-            return f"https://www.tiktok.com/@{u.group(1)}/video/{vid}"
-        return f"https://www.tiktok.com/video/{vid}"
-    # 5) fallback по /@user/video/<id>
-    m = re.search(r'/@([^/]+)/video/(\d{6,})', html)
-    if m:
-        user, vid = m.group(1), m.group(2)
-        return f"https://www.tiktok.com/@{user}/video/{vid}"
+        mm = re.search(r'"ItemModule"\s*:\s*({.*?})\s*,', text, re.DOTALL)
+        if not mm:
+            return None
+        try:
+            sigi = {"ItemModule": json.loads(mm.group(1))}
+        except Exception:
+            return None
+    item_module = sigi.get("ItemModule") or {} if isinstance(sigi, dict) else {}
+    if not isinstance(item_module, dict):
+        return None
+    for k, v in item_module.items():
+        vid = None
+        user = None
+        if isinstance(v, dict):
+            vid = v.get("id") or v.get("itemInfos", {}).get("id") or k
+            user = (
+                v.get("author") or
+                v.get("authorInfo") or
+                v.get("itemInfos", {}).get("author")
+            )
+        if vid:
+            if isinstance(user, dict):
+                user = user.get("uniqueId") or user.get("nickname")
+            if user:
+                return f"https://www.tiktok.com/@{user}/video/{vid}"
+            return f"https://www.tiktok.com/video/{vid}"
     return None
 
+def _tiktok_url_from_match(name: str, blob: str) -> Optional[str]:
+    if name == "jsonld":
+        return tiktok_url_from_jsonld(blob)
+    if name == "sigi":
+        return tiktok_url_from_sigi(blob)
+    if name == "og_url":
+        return strip_tracking_params(html_unescape(blob))
+    if name == "item_id":
+        m = re.search(r'(\d{6,})', blob)
+        return f"https://www.tiktok.com/video/{m.group(1)}" if m else None
+    if name == "user_video":
+        m = re.search(r'/@([^/]+)/video/(\d{6,})', blob)
+        return f"https://www.tiktok.com/@{m.group(1)}/video/{m.group(2)}" if m else None
+    return None
+
+TIKTOK_SCAN_RANK = {target.name: rank for rank, target in enumerate(TIKTOK_SCAN_TARGETS)}
+
+async def scan_tiktok_video_url(resp: aiohttp.ClientResponse) -> Optional[str]:
+    """Ищет ссылку на видео на странице TikTok. Находки ранжируются по TIKTOK_SCAN_TARGETS,
+    чтение прекращается сразу только на источнике высшего приоритета (JSON-LD)"""
+    scanner = HtmlStreamScanner(TIKTOK_SCAN_TARGETS, max_bytes=TIKTOK_SCAN_MAX_BYTES)
+    best: Optional[str] = None
+    best_rank = len(TIKTOK_SCAN_TARGETS)
+    async with aclosing(scanner.iter_matches(resp)) as matches:
+        async for name, blob in matches:
+            rank = TIKTOK_SCAN_RANK[name]
+            if rank >= best_rank:
+                continue
+            try:
+                found = _tiktok_url_from_match(name, blob)
+            except Exception:
+                found = None
+            if found:
+                best, best_rank = found, rank
+                if rank == 0:
+                    break
+    return best
+
 async def normalize_tiktok_url_async(url: str, session: aiohttp.ClientSession) -> Optional[str]:
     """
     Асинхронная нормализация TikTok URL без блокировок.
+    None — страница разобрана, видео нет; сетевые сбои пробрасываются как исключения.
     """
-    try:
-        url_low = url.lower()
-        headers = {"User-Agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15"}
-
-        # Если это короткая ссылка — разрешаем редирект
-        if any(d in url_low for d in SHORTENER_DOMAINS):
-            try:
-                async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10), headers=headers) as resp:
-                    final = str(resp.url)
-            except Exception:
-                async with session.get(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=12), headers=headers) as resp:
-                    final = str(resp.url)
-            final_clean = strip_tracking_params(final)
-            if "/video/" in final_clean:
-                return final_clean
-
-            # Пытаемся распарсить HTML
-            async with session.get(final, headers=headers, timeout=aiohttp.ClientTimeout(total=12)) as resp:
-                if resp.status == 200:
-                    html = await resp.text()
-                    ex = extract_tiktok_video_from_html(html)
-                    if ex:
-                        return ex
-
-        # Уже /video/ — просто чистим
-        if "/video/" in url_low:
-            return strip_tracking_params(url)
-
-        # Профиль/хэштег — парсим HTML
-        if any(p in url_low for p in ("/@", "/tag/", "/hashtag/", "/music/", "/explore", "/search")):
-            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=12)) as resp:
-                if resp.status == 200:
-                    html = await resp.text()
-                    ex = extract_tiktok_video_from_html(html)
-                    if ex:
-                        return ex
+    url_low = url.lower()
+    headers = {"User-Agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15"}
 
-        # Последняя попытка
-        try:
-            async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10), headers=headers) as resp:
-                final = str(resp.url)
-        except Exception:
-            async with session.get(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10), headers=headers) as resp:
-                final = str(resp.url)
+    # Если это короткая ссылка — разрешаем редирект
+    if host_in_domains(url_host(url), SHORTENER_DOMAINS):
+        final = await resolve_redirects_async(url, session, headers)
         final_clean = strip_tracking_params(final)
         if "/video/" in final_clean:
             return final_clean
 
-    except Exception:
-        logger.exception("normalize_tiktok_url_async error for %s", url)
+        # Пытаемся распарсить HTML
+        async with session.get(final, headers=headers, timeout=PAGE_TIMEOUT) as resp:
+            raise_for_transient_status(resp)
+            if resp.status == 200:
+                ex = await scan_tiktok_video_url(resp)
+                if ex:
+                    return ex
+
+    # Уже /video/ — просто чистим
+    if "/video/" in url_low:
+        return strip_tracking_params(url)
+
+    # Профиль/хэштег — парсим HTML
+    if any(p in url_low for p in ("/@", "/tag/", "/hashtag/", "/music/", "/explore", "/search")):
+        async with session.get(url, headers=headers, timeout=PAGE_TIMEOUT) as resp:
+            raise_for_transient_status(resp)
+            if resp.status == 200:
+                ex = await scan_tiktok_video_url(resp)
+                if ex:
+                    return ex
+
+    # Последняя попытка
+    final = await resolve_redirects_async(url, session, headers)
+    final_clean = strip_tracking_params(final)
+    if "/video/" in final_clean:
+        return final_clean
     return None
 
-def normalize_twitter_url(url: str) -> Optional[str]:
+async def normalize_twitter_url_async(url: str, session: aiohttp.ClientSession) -> Optional[str]:
     """Нормализация URL Twitter/X"""
-    try:
-        url_low = url.lower()
-        if "x.com" in url_low or "twitter.com" in url_low:
-            # Разрешаем редиректы
-            final = resolve_redirects(url)
-            # Убираем трекинг-параметры
-            clean = strip_tracking_params(final)
-            # Проверяем, что это ссылка на статус
-            if re.search(r'(?:twitter\.com|x\.com)/[^/]+/status/\d+', clean, re.IGNORECASE):
-                return clean
-    except Exception:
-        logger.exception("normalize_twitter_url error for %s", url)
+    platform = classify_url(url)
+    if platform is not None and platform.key == "twitter":
+        # Разрешаем редиректы
+        final = await resolve_redirects_async(url, session)
+        # Убираем трекинг-параметры
+        clean = strip_tracking_params(final)
+        # Проверяем, что это ссылка на статус
+        if re.search(r'(?:twitter\.com|x\.com)/[^/]+/status/\d+', clean, re.IGNORECASE):
+            return clean
     return None
 
-def normalize_reddit_url(url: str) -> Optional[str]:
-    """Нормализация URL Reddit — извлекает прямую ссылку на видео"""
-    try:
-        url_low = url.lower()
-        if "reddit.com" in url_low:
-            # Разрешаем редиректы
-            final = resolve_redirects(url)
-            # Проверяем, что это ссылка на пост
-            if not re.search(r'reddit\.com/(?:r/[^/]+/comments/|comments/)[\w]+/[\w_-]+/[\w]+', final, re.IGNORECASE):
-                return None
-            # Загружаем HTML страницы
-            headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-            r = requests.get(final, headers=headers, timeout=12)
-            if r.status_code != 200:
-                return None
-            html = r.text
-            # Ищем JSON в HTML (Reddit использует JSON для хранения данных поста)
-            # Ищем window.___r = или подобное
-            match = re.search(r'window\.___r\s*=\s*({.*?});', html, re.DOTALL)
-            if not match:
+async def normalize_reddit_url_async(url: str, session: aiohttp.ClientSession) -> Optional[str]:
+    """Нормализация URL Reddit — извлекает прямую ссылку на видео (None — видео в посте нет)"""
+    platform = classify_url(url)
+    if platform is not None and platform.key == "reddit":
+        # Разрешаем редиректы
+        final = await resolve_redirects_async(url, session)
+        # Проверяем, что это ссылка на пост
+        if not re.search(r'reddit\.com/(?:r/[^/]+/comments/|comments/)[\w]+/[\w_-]+/[\w]+', final, re.IGNORECASE):
+            return None
+        # Загружаем HTML страницы
+        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+        async with session.get(final, headers=headers, timeout=PAGE_TIMEOUT) as resp:
+            raise_for_transient_status(resp)
+            if resp.status != 200:
                 return None
-            try:
-                data = json.loads(match.group(1))
-                # Ищем видео в данных
-                # Структура может меняться, но обычно видео находится в:
-                # data.props.pageProps.postInfo.post
-                post = data.get("props", {}).get("pageProps", {}).get("postInfo", {}).get("post", {})
-                if not post:
-                    return None
-                # Ищем видео
-                video_url = None
-                media = post.get("media", {})
-                if media.get("type") == "video":
-                    video_url = media.get("content", {}).get("url")
-                # Альтернативный способ: через secure_media
-                if not video_url:
-                    secure_media = post.get("secure_media", {})
-                    if secure_media.get("type") == "video":
-                        video_url = secure_media.get("content", {}).get("url")
-                # Еще один способ: через crosspost_parent_list
-                if not video_url:
-                    crosspost = post.get("crosspost_parent_list", [])
-                    if crosspost and len(crosspost) > 0:
-                        media = crosspost[0].get("media", {})
-                        if media.get("type") == "video":
-                            video_url = media.get("content", {}).get("url")
-                if video_url:
-                    return video_url
-            except Exception:
-                logger.exception("Failed to parse Reddit JSON")
+            html = await resp.text()
+        # Ищем JSON в HTML (Reddit использует JSON для хранения данных поста)
+        # Ищем window.___r = или подобное
+        match = re.search(r'window\.___r\s*=\s*({.*?});', html, re.DOTALL)
+        if not match:
+            return None
+        try:
+            data = json.loads(match.group(1))
+            # Ищем видео в данных
+            # Структура может меняться, но обычно видео находится в:
+            # data.props.pageProps.postInfo.post
+            post = data.get("props", {}).get("pageProps", {}).get("postInfo", {}).get("post", {})
+            if not post:
                 return None
-    except Exception:
-        logger.exception("normalize_reddit_url error for %s", url)
+            # Ищем видео
+            video_url = None
+            media = post.get("media", {})
+            if media.get("type") == "video":
+                video_url = media.get("content", {}).get("url")
+            # Альтернативный способ: через secure_media
+            if not video_url:
+                secure_media = post.get("secure_media", {})
+                if secure_media.get("type") == "video":
+                    video_url = secure_media.get("content", {}).get("url")
+            # Еще один способ: через crosspost_parent_list
+            if not video_url:
+                crosspost = post.get("crosspost_parent_list", [])
+                if crosspost and len(crosspost) > 0:
+                    media = crosspost[0].get("media", {})
+                    if media.get("type") == "video":
+                        video_url = media.get("content", {}).get("url")
+            if video_url:
+                return video_url
+        except Exception:
+            logger.exception("Failed to parse Reddit JSON")
+            return None
+    return None
+
+async def normalize_pinterest_url_async(url: str, session: aiohttp.ClientSession) -> Optional[str]:
+    """Нормализация URL Pinterest — pin.it и прочие редиректы до /pin/<id>"""
+    final = await resolve_redirects_async(url, session)
+    clean = strip_tracking_params(final)
+    if "/pin/" in clean:
+        return clean
     return None
 
 async def download_instagram_video_async(url: str, out_dir: str, mode: str = "video", quality: str = "best", session: aiohttp.ClientSession = None) -> str:
@@ -1499,81 +4150,40 @@ async def download_instagram_video_async(url: str, out_dir: str, mode: str = "vi
     try:
         for attempt in range(3):
             try:
+                # Читаем страницу потоково: останавливаемся на первом JSON с видео,
+                # og:video запоминаем как запасной вариант
+                json_found = False
+                og_video = None
+                video_url = None
                 async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
                     if resp.status != 200:
                         raise Exception(f"Не удалось загрузить страницу Instagram: {resp.status}")
-                    html_content = await resp.text()
-
-                # Ищем JSON (те же паттерны)
-                json_data = None
-                json_patterns = [
-                    r'window\.__additionalDataLoaded\([^,]+,\s*({.+?})\);',
-                    r'<script type="application/json"[^>]*>(.+?)</script>',
-                    r'window\.__initialDataLoaded\([^,]+,\s*({.+?})\);',
-                    r'window\.__sharedData\s*=\s*({.+?});',
-                    r'window\._sharedData\s*=\s*({.+?});',
-                    r'window\.__graphql__\s*=\s*({.+?});',
-                ]
-                for pattern in json_patterns:
-                    matches = re.findall(pattern, html_content, re.DOTALL)
-                    for match in matches:
-                        try:
-                            if isinstance(match, tuple):
-                                match = match[0]
-                            json_data = json.loads(match)
-                            break
-                        except json.JSONDecodeError:
-                            continue
-                    if json_data:
-                        break
-
-                if not json_data:
-                    raise Exception("Не удалось найти данные поста")
+                    scanner = HtmlStreamScanner(INSTAGRAM_SCAN_TARGETS, max_bytes=INSTAGRAM_SCAN_MAX_BYTES)
+                    async with aclosing(scanner.iter_matches(resp)) as matches:
+                        async for name, blob in matches:
+                            if name == "og_video":
+                                og_video = og_video or html_unescape(blob)
+                                continue
+                            try:
+                                json_data = json.loads(blob)
+                            except json.JSONDecodeError:
+                                continue
+                            json_found = True
+                            video_url = find_best_video_url(json_data, "instagram", quality)
+                            if video_url:
+                                break
 
-                def find_video_url(data, depth=0):
-                    if depth > 10:
-                        return None
-                    if isinstance(data, dict):
-                        for key in ['video_url', 'videoUrl', 'contentUrl', 'url', 'src', 'video_versions']:
-                            if key in data:
-                                value = data[key]
-                                if isinstance(value, str) and value.startswith('http') and any(ext in value for ext in ['.mp4', '.mov']):
-                                    return value
-                                elif isinstance(value, list) and key == 'video_versions':
-                                    best = None
-                                    for v in value:
-                                        if isinstance(v, dict) and 'url' in v:
-                                            if quality == "best":
-                                                if not best or v.get('width', 0) > best.get('width', 0):
-                                                    best = v
-                                            else:
-                                                target_h = int(quality.replace('p', ''))
-                                                if v.get('height') == target_h:
-                                                    return v['url']
-                                    if best:
-                                        return best['url']
-                        for v in data.values():
-                            res = find_video_url(v, depth + 1)
-                            if res:
-                                return res
-                    elif isinstance(data, list):
-                        for item in data:
-                            res = find_video_url(item, depth + 1)
-                            if res:
-                                return res
-                    return None
-
-                video_url = find_video_url(json_data)
                 if not video_url:
-                    og_match = re.search(r'<meta[^>]+property="og:video"[^>]+content="([^"]+)"', html_content)
-                    if og_match:
-                        video_url = og_match.group(1)
+                    if og_video:
+                        video_url = og_video
+                    elif not json_found:
+                        raise Exception("Не удалось найти данные поста")
                     else:
                         raise Exception("Видео не найдено")
 
                 timestamp = int(time.time())
                 filename = f"instagram_{timestamp}"
-                filepath = os.path.join(out_dir, filename + (".mp3" if mode == "audio" else ".mp4"))
+                filepath = os.path.join(out_dir, filename + ".mp4")
 
                 # Скачиваем видео асинхронно
                 async with session.get(video_url, timeout=aiohttp.ClientTimeout(total=300)) as resp:
@@ -1588,21 +4198,14 @@ async def download_instagram_video_async(url: str, out_dir: str, mode: str = "vi
                                 percent = downloaded / total_size * 100
                                 logger.info(f"Instagram: скачано {percent:.1f}%")
 
-                # Конвертация в аудио (если нужно) — остаётся синхронной (ffmpeg не имеет async-обёртки)
+                # Конвертация в аудио (если нужно)
                 if mode == "audio":
-                    audio_path = filepath.replace(".mp4", ".mp3")
-                    try:
-                        await asyncio.create_subprocess_exec(
-                            "ffmpeg", "-i", filepath, "-vn", "-acodec", "libmp3lame", "-q:a", "2", "-y", audio_path,
-                            stdout=asyncio.subprocess.DEVNULL,
-                            stderr=asyncio.subprocess.DEVNULL
-                        )
+                    audio_path = os.path.splitext(filepath)[0] + ".mp3"
+                    if await extract_audio_track(filepath, audio_path):
                         os.remove(filepath)
                         filepath = audio_path
-                    except Exception as e:
-                        logger.warning(f"Не удалось конвертировать аудио: {e}")
-                        if not os.path.exists(filepath):
-                            raise
+                    else:
+                        logger.warning(f"Не удалось конвертировать аудио: {filepath}")
 
                 return filepath
 
@@ -1627,37 +4230,106 @@ async def download_instagram_video_async(url: str, out_dir: str, mode: str = "vi
 
     raise Exception("Не удалось скачать Instagram после 3 попыток")
 
-def is_youtube_video(url: str) -> bool:
-    return bool(YOUTUBE_VIDEO_RE.search(url or ""))
+# ===== РЕЕСТР ПЛАТФОРМ =====
+class Platform:
+    """Описание поддерживаемой платформы: домены, регулярка прямой ссылки на видео,
+    асинхронный нормализатор, отображаемое имя и лимиты загрузки"""
+    __slots__ = ("key", "display_name", "domains", "url_re", "normalizer", "max_filesize", "download_timeout")
+
+    def __init__(self, key: str, display_name: str, domains: Tuple[str, ...], url_re: re.Pattern,
+                 normalizer=None, max_filesize: int = 1024 * 1024 * 1024, download_timeout: int = 420):
+        self.key = key
+        self.display_name = display_name
+        self.domains = domains
+        self.url_re = url_re
+        self.normalizer = normalizer
+        self.max_filesize = max_filesize
+        self.download_timeout = download_timeout
+
+PLATFORMS: Dict[str, Platform] = {p.key: p for p in (
+    Platform("youtube", "YouTube", ("youtube.com", "youtu.be"), YOUTUBE_VIDEO_RE),
+    Platform("tiktok", "TikTok", ("tiktok.com",), TIKTOK_ANY_RE, normalize_tiktok_url_async),
+    Platform("instagram", "Instagram", ("instagram.com",), INSTAGRAM_RE),
+    Platform("facebook", "Facebook", ("facebook.com",), FACEBOOK_RE),
+    Platform("twitter", "Twitter/X", ("twitter.com", "x.com"), TWITTER_RE, normalize_twitter_url_async),
+    Platform("vk", "VK", ("vk.com", "m.vkvideo.ru"), VK_RE),
+    Platform("reddit", "Reddit", ("reddit.com",), REDDIT_RE, normalize_reddit_url_async),
+    Platform("pinterest", "Pinterest", (
+        "pin.it", "pinterest.com", "pinterest.ru", "pinterest.ca", "pinterest.de", "pinterest.fr",
+        "pinterest.jp", "pinterest.uk", "pinterest.it", "pinterest.es", "pinterest.nl", "pinterest.se",
+        "pinterest.pl", "pinterest.com.br", "pinterest.mx", "pinterest.co.uk",
+    ), PINTEREST_RE, normalize_pinterest_url_async),
+    Platform("dailymotion", "Dailymotion", ("dailymotion.com",), DAILYMOTION_RE),
+    Platform("vimeo", "Vimeo", ("vimeo.com",), VIMEO_RE),
+    Platform("soundcloud", "SoundCloud", ("soundcloud.com",), SOUNDCLOUD_RE),
+)}
+
+# Индекс «домен -> платформа»; поиск идёт по суффиксам хоста по границам меток,
+# поэтому dropbox.com не совпадает с x.com
+PLATFORM_DOMAIN_INDEX: Dict[str, Platform] = {
+    domain: platform for platform in PLATFORMS.values() for domain in platform.domains
+}
+
+def url_host(url: str) -> str:
+    """Хост ссылки в нижнем регистре без порта и www."""
+    try:
+        host = (urlparse(url if "://" in url else f"//{url}").hostname or "")
+    except ValueError:
+        return ""
+    return host[4:] if host.startswith("www.") else host
+
+def host_in_domains(host: str, domains) -> bool:
+    """Совпадает ли хост (или его родительский домен) с одним из доменов"""
+    while host:
+        if host in domains:
+            return True
+        _, _, host = host.partition(".")
+    return False
+
+@lru_cache(maxsize=4096)
+def _platform_for_host(host: str) -> Optional[Platform]:
+    while host:
+        platform = PLATFORM_DOMAIN_INDEX.get(host)
+        if platform is not None:
+            return platform
+        _, _, host = host.partition(".")
+    return None
+
+def classify_url(url: str) -> Optional[Platform]:
+    """Платформа ссылки по её хосту (netloc разбирается один раз)"""
+    if not url:
+        return None
+    return _platform_for_host(url_host(url))
+
+async def extract_audio_track(src: str, dst: str) -> bool:
+    """Локально извлекает звуковую дорожку в mp3 через ffmpeg (без сети)"""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-i", src, "-vn", "-acodec", "libmp3lame", "-q:a", "2", "-y", dst,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        returncode = await proc.wait()
+    except Exception as e:
+        logger.warning(f"ffmpeg не запустился: {e}")
+        return False
+    return returncode == 0 and os.path.exists(dst) and os.path.getsize(dst) > 0
 
 def is_supported_by_platform(url: str) -> bool:
-    u = (url or "").lower()
-    if "tiktok.com" in u or "vm.tiktok.com" in u or "m.tiktok.com" in u:
-        return bool(TIKTOK_ANY_RE.search(u))
-    if "youtube.com" in u or "youtu.be" in u:
-        return is_youtube_video(url)
-    if "instagram.com" in u:
-        return bool(INSTAGRAM_RE.search(u))
-    if "facebook.com" in u:
-        return bool(FACEBOOK_RE.search(u))
-    if "twitter.com" in u or "x.com" in u:
-        return bool(TWITTER_RE.search(u))
-    if "vk.com" in u or "m.vkvideo.ru" in u:
-        return bool(VK_RE.search(u))
-    if "reddit.com" in u:
-        return bool(REDDIT_RE.search(u))
-    if "pinterest.com" in u or "pin.it" in u:
-        return bool(PINTEREST_RE.search(u))
-    if "dailymotion.com" in u:
-        return bool(DAILYMOTION_RE.search(u))
-    if "vimeo.com" in u:
-        return bool(VIMEO_RE.search(u))
-    if "soundcloud.com" in u:
-        return bool(SOUNDCLOUD_RE.search(u))
+    platform = classify_url(url)
+    if platform is not None:
+        return bool(platform.url_re.search(url))
     # Проверяем прямые ссылки на файлы
-    if DIRECT_FILE_RE.search(url):
-        return True
-    return False
+    return bool(DIRECT_FILE_RE.search(url or ""))
+
+def detect_source(url: str) -> str:
+    """Название платформы для подписи к файлу"""
+    platform = classify_url(url)
+    if platform is not None:
+        return platform.display_name
+    if DIRECT_FILE_RE.search(url or ""):
+        return "Прямая ссылка"
+    return "Неизвестно"
 
 def make_actions_kb(pending_msg_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -1670,6 +4342,17 @@ def make_actions_kb(pending_msg_id: int) -> InlineKeyboardMarkup:
         ]
     ])
 
+def make_batch_kb(pending_msg_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Все аудио (mp3)", callback_data=f"batch:audio:{pending_msg_id}"),
+            InlineKeyboardButton(text="Все видео (mp4)", callback_data=f"batch:video:{pending_msg_id}")
+        ],
+        [
+            InlineKeyboardButton(text="Отмена", callback_data=f"batch:cancel:{pending_msg_id}")
+        ]
+    ])
+
 def upload_to_transfersh(path: str) -> Optional[str]:
     filename = os.path.basename(path)
     url = f"https://transfer.sh/{filename}"
@@ -1761,10 +4444,11 @@ async def upload_to_multiple_services(filepath: str) -> Optional[str]:
     return None
 
 # ---- yt-dlp download ----
-def ytdl_download(url: str, out_dir: str, mode: str, progress_hook=None) -> str:
+def ytdl_download(url: str, out_dir: str, mode: str, progress_hook=None, info_sink: Optional[dict] = None) -> str:
     """
     Прямая загрузка через yt-dlp. Поддерживает прогресс-хук.
     Возвращает путь к реальному файлу на диске.
+    В info_sink (если передан) кладутся extractor_key, id и title из ответа yt-dlp.
     """
     opts = YTDL_BASE_OPTS.copy()
     opts["outtmpl"] = os.path.join(out_dir, "%(id)s.%(ext)s")
@@ -1790,6 +4474,8 @@ def ytdl_download(url: str, out_dir: str, mode: str, progress_hook=None) -> str:
 
     with YoutubeDL(opts) as ytdl:
         info = ytdl.extract_info(url, download=True)
+        if info_sink is not None:
+            info_sink.update({k: info.get(k) for k in ("extractor_key", "id", "title")})
 
         # === КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: получаем путь к файлу из самого yt-dlp ===
         # После postprocessing (например, конвертации в mp3) yt-dlp обновляет 'filepath'
@@ -1829,6 +4515,24 @@ def ytdl_download(url: str, out_dir: str, mode: str, progress_hook=None) -> str:
         # Если ничего не нашли — ошибка
         raise FileNotFoundError(f"Файл не найден после загрузки. Ожидался: {filepath}")
 
+def ytdl_probe(url: str, mode: str) -> dict:
+    """Метаданные через yt-dlp без скачивания (для оценки размера)"""
+    opts = YTDL_BASE_OPTS.copy()
+    opts["format"] = "bestaudio/best" if mode == "audio" else "bestvideo+bestaudio/best"
+    with YoutubeDL(opts) as ytdl:
+        return ytdl.extract_info(url, download=False)
+
+def estimate_filesize(info: dict) -> Optional[int]:
+    """Оценка размера итогового файла по метаданным yt-dlp"""
+    size = info.get("filesize") or info.get("filesize_approx")
+    if size:
+        return int(size)
+    formats = info.get("requested_formats") or []
+    sizes = [f.get("filesize") or f.get("filesize_approx") for f in formats]
+    if sizes and all(sizes):
+        return int(sum(sizes))
+    return None
+
 def make_progress_hook(loop: asyncio.AbstractEventLoop, chat_id: int, status_message_id: int, task_id: int):
     """
     Потокобезопасный прогресс-хук для yt-dlp с улучшенным визуальным прогресс-баром и интерактивными элементами
@@ -1836,32 +4540,26 @@ def make_progress_hook(loop: asyncio.AbstractEventLoop, chat_id: int, status_mes
     last_update = 0.0
     total_size = 0
     start_time = time.time()
+    # Кнопки управления
+    control_kb = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="⏸️ Приостановить", callback_data=f"progress:pause:{task_id}"),
+            InlineKeyboardButton(text="⏹️ Отменить", callback_data=f"progress:cancel:{task_id}")
+        ]
+    ])
 
-    async def _edit(text: str, reply_markup=None):
-        try:
-            await bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=status_message_id,
-                text=text,
-                reply_markup=reply_markup,
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.debug(f"Failed to edit progress message: {e}")
-            pass
+    def _edit(text: str, reply_markup=None):
+        # Частоту правок и повторы одинакового текста отсекает status_editor
+        loop.call_soon_threadsafe(partial(
+            status_editor.submit, chat_id, status_message_id, text,
+            reply_markup=reply_markup, parse_mode="HTML"
+        ))
 
     def hook(d: dict):
         nonlocal last_update, total_size
         try:
             status = d.get("status")
             now = time.time()
-            # Кнопки управления
-            control_kb = InlineKeyboardMarkup(inline_keyboard=[
-                [
-                    InlineKeyboardButton(text="⏸️ Приостановить", callback_data=f"progress:pause:{task_id}"),
-                    InlineKeyboardButton(text="⏹️ Отменить", callback_data=f"progress:cancel:{task_id}")
-                ]
-            ])
             if status == "downloading":
                 total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
                 downloaded = d.get("downloaded_bytes", 0)
@@ -1896,29 +4594,348 @@ def make_progress_hook(loop: asyncio.AbstractEventLoop, chat_id: int, status_mes
                     )
                 else:
                     text = f"📥 Скачано: {downloaded//1024} KB"
-                # Обновляем каждые 2 секунды или при значительном изменении прогресса
-                if now - last_update > 2.0 or (percent % 5 == 0 and percent > 0):
+                # Хук вызывается на каждый блок данных — в очередь правок не чаще раза в полсекунды
+                if now - last_update > 0.5:
                     last_update = now
-                    asyncio.run_coroutine_threadsafe(_edit(text, control_kb), loop)
+                    _edit(text, control_kb)
             elif status == "processing":
                 text = (
                     "🎬 <b>Обработка видео</b>\n"
                     "Выполняется конвертация и объединение потоков...\n"
                     "Этот этап может занять некоторое время в зависимости от длины видео."
                 )
-                asyncio.run_coroutine_threadsafe(_edit(text, control_kb), loop)
+                _edit(text, control_kb)
             elif status == "finished":
                 text = "✅ <b>Загрузка завершена!</b>\nПодготовка файла к отправке..."
-                asyncio.run_coroutine_threadsafe(_edit(text), loop)
+                _edit(text)
         except Exception as e:
             logger.debug(f"Progress hook error: {str(e)}", exc_info=True)
     return hook
 
+# ===== РЕЕСТР ЭКСТРАКТОРОВ =====
+class ExtractContext:
+    """Параметры одной попытки скачивания"""
+    def __init__(self, url: str, tempdir: str, mode: str, quality: str = "best", progress_hook=None, status=None):
+        self.url = url
+        self.tempdir = tempdir
+        self.mode = mode
+        self.quality = quality
+        self.progress_hook = progress_hook
+        self.status = status  # async callable(text) для сообщения статуса или None
+        self.platform = classify_url(url)
+
+    async def set_status(self, text: str):
+        if self.status is not None:
+            await self.status(text)
+
+class Extractor(ABC):
+    """Стратегия скачивания. fetch возвращает путь к файлу или бросает исключение."""
+    name = "base"
+
+    def can_handle(self, ctx: ExtractContext) -> bool:
+        return True
+
+    @abstractmethod
+    async def fetch(self, ctx: ExtractContext, out_dir: str) -> Optional[str]:
+        ...
+
+class DirectFileExtractor(Extractor):
+    """Прямая ссылка на медиафайл — потоковое скачивание через общий пул соединений"""
+    name = "direct"
+    EXTENSIONS = (".mp4", ".mp3", ".mkv", ".webm", ".avi", ".mov", ".wmv", ".flv", ".m4a", ".wav", ".aac", ".ogg")
+    WRITE_BUFFER = 1024 * 1024  # запись на диск в потоке кусками по 1 МБ, а не на каждый пакет сети
+
+    def can_handle(self, ctx: ExtractContext) -> bool:
+        return bool(DIRECT_FILE_RE.search(ctx.url))
+
+    async def fetch(self, ctx: ExtractContext, out_dir: str) -> Optional[str]:
+        await ctx.set_status("📥 Обнаружена прямая ссылка на файл. Начинаю загрузку...")
+        filename = os.path.basename(urlparse(ctx.url).path) or "downloaded_file"
+        if not filename.endswith(self.EXTENSIONS):
+            filename += ".mp4"  # Добавляем расширение по умолчанию
+        filepath = os.path.join(out_dir, filename)
+        async with get_http_session().get(ctx.url, timeout=aiohttp.ClientTimeout(total=300)) as resp:
+            resp.raise_for_status()
+            # Файловые операции — в потоке, чтобы медленный диск не останавливал event loop
+            f = await asyncio.to_thread(open, filepath, 'wb')
+            try:
+                buffer = bytearray()
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    buffer += chunk
+                    if len(buffer) >= self.WRITE_BUFFER:
+                        await asyncio.to_thread(f.write, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    await asyncio.to_thread(f.write, bytes(buffer))
+            finally:
+                await asyncio.to_thread(f.close)
+        return filepath
+
+class InstagramHtmlExtractor(Extractor):
+    """Быстрый путь для Instagram: разбор JSON со страницы поста"""
+    name = "instagram_html"
+
+    def can_handle(self, ctx: ExtractContext) -> bool:
+        return ctx.platform is not None and ctx.platform.key == "instagram"
+
+    async def fetch(self, ctx: ExtractContext, out_dir: str) -> Optional[str]:
+        await ctx.set_status("📥 Скачиваю видео с Instagram...")
+        return await download_instagram_video_async(ctx.url, out_dir, ctx.mode, ctx.quality)
+
+class YtDlpExtractor(Extractor):
+    """Универсальная стратегия через yt-dlp (с прогресс-хуком)"""
+    name = "yt-dlp"
+
+    async def fetch(self, ctx: ExtractContext, out_dir: str) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        info: Dict[str, Any] = {}
+        func = partial(ytdl_download, ctx.url, out_dir, ctx.mode, ctx.progress_hook, info)
+        timeout = ctx.platform.download_timeout if ctx.platform is not None else 420
+        filepath = await asyncio.wait_for(loop.run_in_executor(None, func), timeout=timeout)
+        # Ключ yt-dlp делает повторные запросы по «нераспознанным» ссылкам попаданиями в кэш
+        remember_content_key(ctx.url, info.get("extractor_key"), info.get("id"))
+        return filepath
+
+class StrategyStats:
+    """Скользящая статистика стратегии: доля успехов и средняя задержка"""
+    WINDOW = 50
+
+    def __init__(self):
+        self.recent: deque = deque(maxlen=self.WINDOW)  # (успех, секунды)
+        self.attempts = 0
+        self.successes = 0
+
+    def record(self, ok: bool, latency: float):
+        self.recent.append((ok, latency))
+        self.attempts += 1
+        if ok:
+            self.successes += 1
+
+    @property
+    def success_rate(self) -> float:
+        # Сглаживание Лапласа: у новой стратегии 0.5, а не 0 или 1
+        ok = sum(1 for success, _ in self.recent if success)
+        return (ok + 1) / (len(self.recent) + 2)
+
+    @property
+    def avg_latency(self) -> float:
+        latencies = [latency for success, latency in self.recent if success]
+        return sum(latencies) / len(latencies) if latencies else ExtractorRegistry.DEFAULT_LATENCY
+
+    @property
+    def expected_cost(self) -> float:
+        """Ожидаемое время до успеха; меньше — раньше в цепочке"""
+        return self.avg_latency / self.success_rate
+
+class ExtractorRegistry:
+    """Цепочки стратегий по платформам. Порядок внутри цепочки подстраивается
+    под скользящую статистику (успешность и задержка) каждой стратегии на платформе."""
+    DEFAULT_LATENCY = 5.0
+    ATTEMPT_LOG_SIZE = 200
+
+    def __init__(self):
+        self._chains: Dict[str, List[Extractor]] = {}
+        self._default: List[Extractor] = []
+        self.stats: Dict[Tuple[str, str], StrategyStats] = {}
+        self.attempt_log: deque = deque(maxlen=self.ATTEMPT_LOG_SIZE)
+
+    def register(self, platform_key: Optional[str], extractors: List[Extractor]):
+        """Объявить цепочку для платформы (None — цепочка по умолчанию)"""
+        if platform_key is None:
+            self._default = list(extractors)
+        else:
+            self._chains[platform_key] = list(extractors)
+
+    def _stats(self, platform_key: str, extractor: Extractor) -> StrategyStats:
+        key = (platform_key, extractor.name)
+        if key not in self.stats:
+            self.stats[key] = StrategyStats()
+        return self.stats[key]
+
+    def chain_for(self, ctx: ExtractContext) -> List[Extractor]:
+        platform_key = ctx.platform.key if ctx.platform is not None else "other"
+        declared = self._chains.get(platform_key, self._default)
+        usable = [ex for ex in declared if ex.can_handle(ctx)]
+        # sorted стабилен: при равной стоимости сохраняется объявленный порядок
+        return sorted(usable, key=lambda ex: self._stats(platform_key, ex).expected_cost)
+
+    async def run(self, ctx: ExtractContext) -> str:
+        platform_key = ctx.platform.key if ctx.platform is not None else "other"
+        chain = self.chain_for(ctx)
+        last_error: Optional[Exception] = None
+        for index, extractor in enumerate(chain):
+            if index > 0:
+                await ctx.set_status("🔁 Пробую другой способ загрузки...")
+            out_dir = os.path.join(ctx.tempdir, extractor.name)
+            os.makedirs(out_dir, exist_ok=True)
+            started = time.monotonic()
+            error: Optional[Exception] = None
+            filepath = None
+            try:
+                filepath = await extractor.fetch(ctx, out_dir)
+                if not filepath or not os.path.exists(filepath):
+                    raise FileNotFoundError("Файл не найден после загрузки.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e
+            latency = time.monotonic() - started
+            self._stats(platform_key, extractor).record(error is None, latency)
+            self.attempt_log.append({
+                "time": time.time(),
+                "platform": platform_key,
+                "strategy": extractor.name,
+                "ok": error is None,
+                "latency": latency,
+                "error": str(error)[:200] if error else None,
+            })
+            if error is None:
+                return filepath
+            logger.warning(f"Стратегия {extractor.name} не сработала для {ctx.url}: {error}")
+            last_error = error
+        raise last_error or FileNotFoundError("Нет подходящего способа загрузки.")
+
+    def stats_report(self) -> List[Tuple[str, str, int, float, float]]:
+        """(платформа, стратегия, попыток, успешность, средняя задержка)"""
+        return [
+            (platform_key, name, st.attempts, st.success_rate, st.avg_latency)
+            for (platform_key, name), st in sorted(self.stats.items())
+        ]
+
+extractor_registry = ExtractorRegistry()
+_direct_extractor = DirectFileExtractor()
+_ytdlp_extractor = YtDlpExtractor()
+extractor_registry.register(None, [_direct_extractor, _ytdlp_extractor])
+extractor_registry.register("instagram", [_direct_extractor, InstagramHtmlExtractor(), _ytdlp_extractor])
+
+# ===== СПЕКУЛЯТИВНАЯ ПОДГОТОВКА =====
+class PrefetchManager:
+    """Пока пользователь выбирает формат, заранее извлекает метаданные и оценивает размер,
+    а небольшие файлы (до PREFETCH_MAX_BYTES) скачивает в кэш в формате по умолчанию.
+    Загрузка регистрируется в single-flight менеджера загрузок, поэтому нажатие кнопки
+    во время подготовки просто дожидается её. Отмена или устаревание ссылки прерывает подготовку."""
+    PROBE_TIMEOUT = 30
+    ESTIMATES_LIMIT = 1000
+
+    def __init__(self, max_bytes: int = PREFETCH_MAX_BYTES, concurrency: int = 2):
+        self.max_bytes = max_bytes
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.modes: Dict[int, str] = {}  # формат, который готовится для клавиатуры
+        self._estimates: "OrderedDict[Tuple[str, str], int]" = OrderedDict()  # (ссылка, формат) -> байты
+        self._slots = asyncio.Semaphore(concurrency)
+        self.started = 0
+        self.prefetched = 0
+        self.cancelled = 0
+
+    def start(self, msg_id: int, url: str, user_id: int):
+        if not SPECULATIVE_PREFETCH:
+            return
+        self.started += 1
+        self.tasks[msg_id] = asyncio.create_task(self._run(msg_id, url, user_id))
+
+    def cancel(self, msg_id: int):
+        """Пользователь отменил выбор или ссылка устарела"""
+        task = self.tasks.pop(msg_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            self.cancelled += 1
+
+    def detach(self, msg_id: int, mode: str):
+        """Формат выбран: подготовка в этом формате продолжается без привязки к клавиатуре,
+        подготовка другого формата прерывается"""
+        if self.modes.get(msg_id) != mode:
+            self.cancel(msg_id)
+            return
+        self.tasks.pop(msg_id, None)
+
+    def estimated_size(self, url: str, mode: str) -> Optional[int]:
+        """Оценка размера в том формате, в котором ссылку проверяли (аудио намного меньше видео)"""
+        return self._estimates.get((url, mode))
+
+    def _remember_estimate(self, url: str, mode: str, size: int):
+        self._estimates[(url, mode)] = size
+        self._estimates.move_to_end((url, mode))
+        while len(self._estimates) > self.ESTIMATES_LIMIT:
+            self._estimates.popitem(last=False)
+
+    @staticmethod
+    def _cancel_hook(cancelled: threading.Event):
+        # yt-dlp работает в потоке; исключение из хука прерывает его загрузку
+        def hook(d: dict):
+            if cancelled.is_set():
+                raise DownloadError("Prefetch cancelled")
+        return hook
+
+    async def _probe_size(self, url: str, mode: str) -> Optional[int]:
+        if DIRECT_FILE_RE.search(url):
+            async with get_http_session().head(url, allow_redirects=True, timeout=REDIRECT_TIMEOUT) as resp:
+                return resp.content_length
+        loop = asyncio.get_running_loop()
+        info = await asyncio.wait_for(
+            loop.run_in_executor(None, partial(ytdl_probe, url, mode)), timeout=self.PROBE_TIMEOUT
+        )
+        remember_content_key(url, info.get("extractor_key"), info.get("id"))
+        return estimate_filesize(info)
+
+    async def _run(self, msg_id: int, url: str, user_id: int):
+        settings = await user_settings.get_settings(user_id)
+        mode = "audio" if settings["default_format"] == "audio" else "video"
+        self.modes[msg_id] = mode
+        cancelled = threading.Event()
+        tempdir = None
+        flight_key = None
+        try:
+            if await cache_manager.get_cached_file(content_key(url), mode, touch=False):
+                return
+            size = await self._probe_size(url, mode)
+            if size:
+                self._remember_estimate(url, mode, size)
+            if not size or size > self.max_bytes:
+                return
+            key = content_key(url)
+            if await cache_manager.get_cached_file(key, mode, touch=False) or (key, mode) in download_manager.inflight:
+                return
+            flight_key = (key, mode)
+            download_manager.inflight[flight_key] = asyncio.get_running_loop().create_future()
+            async with self._slots:
+                tempdir = tempfile.mkdtemp(prefix="tgdl_prefetch_")
+                ctx = ExtractContext(url, tempdir, mode, settings["preferred_quality"], self._cancel_hook(cancelled))
+                filepath = await extractor_registry.run(ctx)
+            await cache_manager.add_to_cache(content_key(url), filepath, mode)
+            self.prefetched += 1
+            logger.info(f"Спекулятивно подготовлено: {url} ({size/(1024*1024):.1f} MB)")
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        except Exception as e:
+            logger.debug(f"Спекулятивная подготовка не удалась для {url}: {e}")
+        finally:
+            if flight_key is not None:
+                future = download_manager.inflight.pop(flight_key, None)
+                if future is not None and not future.done():
+                    future.set_result(None)
+            if tempdir:
+                shutil.rmtree(tempdir, ignore_errors=True)
+            self.modes.pop(msg_id, None)
+            if self.tasks.get(msg_id) is asyncio.current_task():
+                del self.tasks[msg_id]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": sum(1 for t in self.tasks.values() if not t.done()),
+            "started": self.started,
+            "prefetched": self.prefetched,
+            "cancelled": self.cancelled,
+        }
+
 # ---- handlers ----
 async def cmd_start(message: types.Message):
     user_id = message.from_user.id
     # Убедимся, что пользователь добавлен в базу
-    settings = user_settings.get_settings(user_id)
+    settings = await user_settings.get_settings(user_id)
+    # Написал боту — значит, снова получает рассылки
+    if message.chat.type == "private":
+        await user_settings.unmark_blocked(user_id)
     
     # Создаем интерактивную клавиатуру с основными действиями
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1996,59 +5013,85 @@ def has_enough_disk_space(path: str, required_mb: int = 500) -> bool:
     except Exception:
         return True  # На случай ошибки, не блокируем загрузку
 
+def pick_normalizer(url: str):
+    """Асинхронный нормализатор для платформы ссылки (или None, если не нужен)"""
+    platform = classify_url(url)
+    return platform.normalizer if platform is not None else None
+
+async def normalize_url(url: str) -> str:
+    """Единый асинхронный пайплайн нормализации; при неудаче возвращает исходную ссылку"""
+    normalizer = pick_normalizer(url)
+    if normalizer is None:
+        return url
+    found, cached = normalization_cache.get(url)
+    if found:
+        return cached or url
+    # Та же ссылка уже нормализуется — ждём готовый результат
+    inflight = _NORMALIZE_INFLIGHT.get(url)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+    future = asyncio.get_running_loop().create_future()
+    _NORMALIZE_INFLIGHT[url] = future
+    result = url
+    try:
+        norm = await asyncio.wait_for(normalizer(url, get_http_session()), timeout=NORMALIZE_TOTAL_TIMEOUT)
+        # Нормализаторы пробрасывают сетевые сбои, поэтому None здесь — разобранный ответ
+        # «видео нет». Таймауты и исключения не кэшируем — они обычно временные
+        normalization_cache.put(url, norm or None)
+        if norm:
+            result = norm
+    except asyncio.TimeoutError:
+        logger.warning("Normalization timed out for %s", url)
+    except Exception:
+        logger.exception("Normalization failed for %s", url)
+    finally:
+        _NORMALIZE_INFLIGHT.pop(url, None)
+        future.set_result(result)
+    return result
+
 async def handle_text(message: types.Message):
     user_id = message.from_user.id
     # Добавляем пользователя в базу при первом взаимодействии
-    user_settings.get_settings(user_id)
+    await user_settings.get_settings(user_id)
     text = (message.text or "").strip()
-    url = find_first_url(text)
+    urls = find_all_urls(text)
     # Если ссылка не найдена, но это личный чат - сообщаем об ошибке
-    if not url:
+    if not urls:
         if message.chat.type == "private":
             await message.reply("Не нашёл ссылку в сообщении. Пришлите ссылку на видео.")
         return
 
-    normalized = url
-    ulow = url.lower()
+    if len(urls) > 1:
+        await handle_batch_text(message, urls)
+        return
 
-    if any(dom in ulow for dom in ("tiktok.com", "vm.tiktok.com", "m.tiktok.com")):
-        try:
-            async with aiohttp.ClientSession() as session:
-                norm = await normalize_tiktok_url_async(url, session)
-            if norm:
-                normalized = norm
-        except Exception:
-            logger.exception("Normalization failed for %s", url)
-    elif any(dom in ulow for dom in ("twitter.com", "x.com")):
-        try:
-            norm = normalize_twitter_url(url)
-            if norm:
-                normalized = norm
-        except Exception:
-            logger.exception("Normalization failed for %s", url)
-    elif "reddit.com" in ulow:
-        try:
-            norm = normalize_reddit_url(url)
-            if norm:
-                normalized = norm
-        except Exception:
-            logger.exception("Normalization failed for %s", url)
-    elif "pinterest.com" in ulow or "pin.it" in ulow:
-        try:
-            final = resolve_redirects(url)
-            clean = strip_tracking_params(final)
-            if "/pin/" in clean:
-                normalized = clean
-        except Exception:
-            logger.exception("Normalization failed for %s", url)
-    elif DIRECT_FILE_RE.search(url):
-        # Если это прямая ссылка на файл, показываем уведомление
-        await message.answer(
-            "📥 Обнаружена прямая ссылка на файл. Начинаю загрузку...\n"
-            "Это может занять некоторое время в зависимости от размера файла."
+    url = urls[0]
+    is_group = message.chat.type != "private"
+    if is_group and await reply_with_recent_result(message, content_key(url)):
+        return
+    kb_msg = None
+    if pick_normalizer(url) is not None:
+        # Нормализация идёт по сети — отправляем сообщение выбора формата параллельно с ней,
+        # кнопки появятся, как только станет известна итоговая ссылка
+        kb_msg, normalized = await asyncio.gather(
+            message.answer("Выберите формат для скачивания:"),
+            normalize_url(url)
         )
+    else:
+        normalized = url
+        if DIRECT_FILE_RE.search(url):
+            # Если это прямая ссылка на файл, показываем уведомление
+            await message.answer(
+                "📥 Обнаружена прямая ссылка на файл. Начинаю загрузку...\n"
+                "Это может занять некоторое время в зависимости от размера файла."
+            )
 
     if not is_supported_by_platform(normalized):
+        if kb_msg is not None:
+            try:
+                await kb_msg.delete()
+            except Exception:
+                pass
         # В личном чате сообщаем об ошибке
         if message.chat.type == "private":
             await message.reply(
@@ -2059,14 +5102,73 @@ async def handle_text(message: types.Message):
             )
         return
 
-    kb_msg = await message.answer("Выберите формат для скачивания:", reply_markup=make_actions_kb(0))
-    PENDING_LINKS[kb_msg.message_id] = normalized
+    if is_group and normalized != url and await reply_with_recent_result(message, content_key(normalized)):
+        if kb_msg is not None:
+            try:
+                await kb_msg.delete()
+            except Exception:
+                pass
+        return
+
+    if kb_msg is None:
+        kb_msg = await message.answer("Выберите формат для скачивания:", reply_markup=make_actions_kb(0))
+    PENDING_LINKS[kb_msg.message_id] = (normalized, time.time())
+    prefetch_manager.start(kb_msg.message_id, normalized, user_id)
     await bot.edit_message_reply_markup(
         chat_id=kb_msg.chat.id,
         message_id=kb_msg.message_id,
         reply_markup=make_actions_kb(kb_msg.message_id)
     )
 
+async def reply_with_recent_result(message: types.Message, key: str) -> bool:
+    """Если ссылку недавно уже присылали в этот чат — отвечаем на прежний результат"""
+    previous_id = recent_links.lookup(message.chat.id, key)
+    if previous_id is None:
+        return False
+    try:
+        await bot.send_message(
+            message.chat.id,
+            "🔁 Эту ссылку уже присылали недавно — результат здесь.",
+            reply_to_message_id=previous_id
+        )
+    except TelegramBadRequest:
+        # Прежнее сообщение удалено — обрабатываем ссылку заново
+        return False
+    recent_links.duplicates += 1
+    return True
+
+async def handle_batch_text(message: types.Message, urls: List[str]):
+    """Несколько ссылок в одном сообщении — один пакет и одна клавиатура"""
+    urls = urls[:BATCH_MAX_LINKS]
+    normalized = await asyncio.gather(*(normalize_url(u) for u in urls))
+    # Разные короткие ссылки могут вести на одно видео — убираем повторы после нормализации
+    supported = [u for u in dict.fromkeys(normalized) if is_supported_by_platform(u)]
+    if not supported:
+        if message.chat.type == "private":
+            await message.reply("В сообщении нет ссылок на поддерживаемые платформы.")
+        return
+    if len(supported) == 1:
+        kb_msg = await message.answer("Выберите формат для скачивания:", reply_markup=make_actions_kb(0))
+        PENDING_LINKS[kb_msg.message_id] = (supported[0], time.time())
+        prefetch_manager.start(kb_msg.message_id, supported[0], message.from_user.id)
+        await bot.edit_message_reply_markup(
+            chat_id=kb_msg.chat.id,
+            message_id=kb_msg.message_id,
+            reply_markup=make_actions_kb(kb_msg.message_id)
+        )
+        return
+
+    kb_msg = await message.answer(
+        f"Найдено ссылок: {len(supported)}. Выберите формат для всех:",
+        reply_markup=make_batch_kb(0)
+    )
+    PENDING_BATCHES[kb_msg.message_id] = (supported, time.time())
+    await bot.edit_message_reply_markup(
+        chat_id=kb_msg.chat.id,
+        message_id=kb_msg.message_id,
+        reply_markup=make_batch_kb(kb_msg.message_id)
+    )
+
 # --- колбэк ---
 async def cb_download(callback: types.CallbackQuery):
     data = callback.data or ""
@@ -2080,12 +5182,14 @@ async def cb_download(callback: types.CallbackQuery):
     except ValueError:
         await callback.answer("Ошибка данных.", show_alert=True)
         return
-    original_url = PENDING_LINKS.get(msg_id)
-    if not original_url:
+    pending = PENDING_LINKS.get(msg_id)
+    if not pending:
         await callback.answer("Ссылка устарела или не найдена. Отправьте ссылку снова.", show_alert=True)
         return
+    original_url, _ = pending
     if what == "cancel":
         PENDING_LINKS.pop(msg_id, None)
+        prefetch_manager.cancel(msg_id)
         try:
             await callback.message.edit_text("Отменено.")
         except Exception:
@@ -2097,63 +5201,136 @@ async def cb_download(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     mode = "audio" if what == "audio" else "video"
     await download_manager.add_download(callback, original_url, mode)
-    # Удаляем из PENDING_LINKS, чтобы не дублировать
+    # Удаляем из PENDING_LINKS, чтобы не дублировать; подготовка выбранного формата продолжается
     PENDING_LINKS.pop(msg_id, None)
+    prefetch_manager.detach(msg_id, mode)
 
-async def cmd_history(message: types.Message):
-    """Показать историю загрузок пользователя"""
-    user_id = message.from_user.id
-    history = history_manager.get_history(user_id)
-    if not history:
-        await message.reply("Ваша история загрузок пуста.")
+async def cb_batch(callback: types.CallbackQuery):
+    data = callback.data or ""
+    parts = data.split(":")
+    if len(parts) != 3:
+        await callback.answer("Некорректные данные.", show_alert=True)
+        return
+    _, what, msg_id_str = parts
+    try:
+        msg_id = int(msg_id_str)
+    except ValueError:
+        await callback.answer("Ошибка данных.", show_alert=True)
+        return
+    urls, _ = PENDING_BATCHES.pop(msg_id, (None, None))
+    if not urls:
+        await callback.answer("Ссылки устарели или не найдены. Отправьте их снова.", show_alert=True)
         return
-    text = "📜 Ваша история загрузок:\n"
-    for i, (url, file_type, timestamp) in enumerate(history, 1):
-        # Форматируем дату
+    if what == "cancel":
         try:
-            dt = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f") if '.' in timestamp else datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-            date_str = dt.strftime("%d.%m.%Y %H:%M")
-        except:
-            date_str = timestamp
-        text += f"{i}. {date_str}\n"
+            await callback.message.edit_text("Отменено.")
+        except Exception:
+            pass
+        await callback.answer()
+        return
+    await callback.answer()
+    mode = "audio" if what == "audio" else "video"
+    await download_manager.add_batch(callback, urls, mode)
+
+# Поисковые запросы по истории для кнопок листания: id -> текст запроса
+HISTORY_SEARCHES: "OrderedDict[str, str]" = OrderedDict()
+HISTORY_SEARCHES_MAX = 1000
+HISTORY_PAGE_SIZE = 5
+
+def format_history_date(timestamp: str) -> str:
+    try:
+        dt = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f") if '.' in timestamp else datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+        return dt.strftime("%d.%m.%Y %H:%M")
+    except Exception:
+        return timestamp
+
+async def render_history_page(user_id: int, search_id: str = "", before_id: Optional[int] = None,
+                              after_id: Optional[int] = None) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Текст и клавиатура страницы истории (листание по id, кнопки повторной отправки)"""
+    query = HISTORY_SEARCHES.get(search_id) if search_id else None
+    rows, has_older, has_newer = await history_manager.get_page(
+        user_id, before_id=before_id, after_id=after_id, query=query, limit=HISTORY_PAGE_SIZE
+    )
+    if not rows:
+        if query:
+            return f"По запросу «{query}» ничего не найдено.", None
+        return "Ваша история загрузок пуста.", None
+    text = f"🔎 История по запросу «{query}»:\n" if query else "📜 Ваша история загрузок:\n"
+    send_buttons = []
+    for i, (entry_id, url, file_type, title, platform, timestamp) in enumerate(rows, 1):
+        text += f"\n{i}. {format_history_date(timestamp)} · {platform or detect_source(url)}\n"
+        if title:
+            text += f"📄 {title}\n"
         text += f"🔗 {url}\n"
         text += f"🎬 {'Видео' if file_type == 'video' else 'Аудио'}\n"
-    # Кнопка для очистки истории
-    clear_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🧹 Очистить историю", callback_data="history:clear")]
-    ])
-    await message.reply(text, reply_markup=clear_kb)
+        send_buttons.append(InlineKeyboardButton(text=f"🔁 {i}", callback_data=f"history:send:{entry_id}"))
+    keyboard = [send_buttons]
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(text="◀️ Новее", callback_data=f"history:newer:{search_id}:{rows[0][0]}"))
+    if has_older:
+        nav.append(InlineKeyboardButton(text="Старше ▶️", callback_data=f"history:older:{search_id}:{rows[-1][0]}"))
+    if nav:
+        keyboard.append(nav)
+    if not query:
+        # Кнопка для очистки истории
+        keyboard.append([InlineKeyboardButton(text="🧹 Очистить историю", callback_data="history:clear")])
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+async def cmd_history(message: types.Message):
+    """Показать историю загрузок пользователя; /history <слова> — поиск по ссылке, названию и платформе"""
+    user_id = message.from_user.id
+    parts = (message.text or "").split(None, 1)
+    search_id = ""
+    if len(parts) > 1 and parts[1].strip():
+        search_id = uuid.uuid4().hex[:8]
+        HISTORY_SEARCHES[search_id] = parts[1].strip()[:100]
+        while len(HISTORY_SEARCHES) > HISTORY_SEARCHES_MAX:
+            HISTORY_SEARCHES.popitem(last=False)
+    text, kb = await render_history_page(user_id, search_id)
+    await message.reply(text, reply_markup=kb, disable_web_page_preview=True)
 
 async def cb_history(callback: types.CallbackQuery):
     """Обработчик колбэков для истории"""
     data = callback.data
     user_id = callback.from_user.id
     if data == "history:clear":
-        if history_manager.clear_history(user_id):
+        if await history_manager.clear_history(user_id):
             await callback.message.edit_text("✅ История загрузок очищена.")
         else:
             await callback.answer("❌ Не удалось очистить историю.")
     elif data == "history:view":
-        history = history_manager.get_history(user_id)
-        if not history:
-            await callback.message.edit_text("Ваша история загрузок пуста.")
+        text, kb = await render_history_page(user_id)
+        await callback.message.edit_text(text, reply_markup=kb, disable_web_page_preview=True)
+    elif data.startswith(("history:older:", "history:newer:")):
+        _, direction, search_id, cursor = data.split(":", 3)
+        if search_id and search_id not in HISTORY_SEARCHES:
+            await callback.answer("Поиск устарел. Повторите /history с запросом.", show_alert=True)
             return
-        text = "📜 Ваша история загрузок:\n"
-        for i, (url, file_type, timestamp) in enumerate(history, 1):
-            # Форматируем дату
+        text, kb = await render_history_page(
+            user_id, search_id,
+            before_id=int(cursor) if direction == "older" else None,
+            after_id=int(cursor) if direction == "newer" else None
+        )
+        try:
+            await callback.message.edit_text(text, reply_markup=kb, disable_web_page_preview=True)
+        except TelegramBadRequest:
+            pass
+        await callback.answer()
+    elif data.startswith("history:send:"):
+        entry = await history_manager.get_entry(user_id, int(data.rsplit(":", 1)[1]))
+        if entry is None:
+            # Повторная загрузка даёт записи новый id и поднимает её наверх — старые кнопки устаревают
+            await callback.answer("Запись обновилась или удалена — показываю актуальную историю.", show_alert=True)
+            text, kb = await render_history_page(user_id)
             try:
-                dt = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f") if '.' in timestamp else datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-                date_str = dt.strftime("%d.%m.%Y %H:%M")
-            except:
-                date_str = timestamp
-            text += f"{i}. {date_str}\n"
-            text += f"🔗 {url}\n"
-            text += f"🎬 {'Видео' if file_type == 'video' else 'Аудио'}\n"
-        # Кнопка для очистки истории
-        clear_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🧹 Очистить историю", callback_data="history:clear")]
-        ])
-        await callback.message.edit_text(text, reply_markup=clear_kb)
+                await callback.message.edit_text(text, reply_markup=kb, disable_web_page_preview=True)
+            except TelegramBadRequest:
+                pass
+            return
+        await callback.answer("Отправляю...")
+        url, file_type, title, file_id = entry
+        await download_manager.resend(callback, url, file_type, file_id, title)
     elif data == "start_download":
         await callback.message.edit_text("Пришлите ссылку на видео, которое хотите скачать.")
 
@@ -2165,10 +5342,10 @@ async def cmd_addnews(message: types.Message):
     /addnews button=Label|https://example.com Текст новости
     /addnews button1=Label1|URL1,button2=Label2|URL2 Текст новости
     /addnews https://example.com Текст новости (will create a button from first URL)
+    /addnews lang=ru active=30 Текст новости (segment: language, active/inactive within N days)
     You can also reply to a message with /addnews to forward that message as news.
     Supports media files (photo, video, document) when replying to media messages.
     """
-    ADMIN_ID = 6143311340  # Замените на ваш ID администратора
     user_id = message.from_user.id
     if user_id != ADMIN_ID:
         await message.reply("❌ Только администратор может использовать эту команду.")
@@ -2180,6 +5357,8 @@ async def cmd_addnews(message: types.Message):
     # Remove command mention if present (e.g., /addnews@Bot)
     if parts:
         parts[0] = re.sub(r'@\w+$', '', parts[0])
+    # Фильтры получателей идут первыми аргументами (lang=ru active=30 inactive=90)
+    segment, args = parse_broadcast_segment(parts[1] if len(parts) >= 2 else "")
     news_text = ""
     buttons = []
     
@@ -2210,14 +5389,15 @@ async def cmd_addnews(message: types.Message):
             news_text = replied_message.text
     
     # If not replying or no text from reply, use command arguments
-    if not news_text and len(parts) >= 2 and parts[1].strip():
-        news_text = parts[1].strip()
+    if not news_text and args:
+        news_text = args
     
     if not news_text and not media_file:
         await message.reply(
             "Использование: /addnews Текст новости.\n"
             "Пример: /addnews Бота обновлен! Новые функции: ...\n"
             "Дополнительно можно добавить кнопки: /addnews button1=Label1|URL1,button2=Label2|URL2 Текст\n"
+            "Фильтры получателей: /addnews lang=ru active=30 Текст (или inactive=90)\n"
             "Или ответьте на сообщение с медиа-файлом, чтобы отправить его в рассылке."
         )
         return
@@ -2237,7 +5417,7 @@ async def cmd_addnews(message: types.Message):
             if not re.match(r'^https?://', button_url, flags=re.IGNORECASE):
                 button_url = 'https://' + button_url
             
-            buttons.append(InlineKeyboardButton(text=button_label, url=button_url))
+            buttons.append((button_label, button_url))
         
         # Remove button patterns from news text
         news_text = re.sub(button_pattern, '', news_text, flags=re.IGNORECASE)
@@ -2247,20 +5427,13 @@ async def cmd_addnews(message: types.Message):
         murl = re.search(r'https?://[^\s<>"()]+', news_text, flags=re.IGNORECASE)
         if murl:
             button_url = murl.group(0)
-            buttons.append(InlineKeyboardButton(text="🔗 Перейти", url=button_url))
+            buttons.append(("🔗 Перейти", button_url))
     
     # Clean up news text (remove extra commas and whitespace)
     news_text = re.sub(r'^\s*,\s*|\s*,\s*$', '', news_text)  # Remove leading/trailing commas
     news_text = re.sub(r'\s*,\s*', ', ', news_text)  # Normalize commas
     news_text = news_text.strip()
     
-    # Prepare reply markup if buttons present
-    reply_kb = None
-    if buttons:
-        # Split buttons into rows of 2 buttons each
-        button_rows = [buttons[i:i+2] for i in range(0, len(buttons), 2)]
-        reply_kb = InlineKeyboardMarkup(inline_keyboard=button_rows)
-    
     # Prepare final message (if empty after stripping, put a placeholder)
     if not news_text and not media_file:
         news_text = "📣 Новость"
@@ -2271,86 +5444,114 @@ async def cmd_addnews(message: types.Message):
     else:
         formatted_text = "📣 <b>Новость от бота</b>"
     
-    # Broadcast
-    recipients = user_settings.get_all_user_ids()
-    if not recipients:
-        await message.reply("Нет подписчиков для рассылки.")
+    # Рассылка идёт в фоне: лимит частоты, повтор после RetryAfter, продолжение после перезапуска
+    payload = {"text": formatted_text, "media_type": media_type, "media_file": media_file, "buttons": buttons,
+               "segment": segment}
+    progress_msg = await message.reply(f"📤 Начинаю рассылку новостей ({describe_segment(segment)})...")
+    await broadcast_manager.start(payload, message.chat.id, progress_msg.message_id)
+
+async def cb_broadcast(callback: types.CallbackQuery):
+    """Кнопка остановки рассылки"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("Только для администратора.", show_alert=True)
+        return
+    parts = callback.data.split(":")
+    if len(parts) != 3 or parts[1] != "cancel" or not parts[2].isdigit():
+        await callback.answer("Некорректные данные.", show_alert=True)
         return
+    if broadcast_manager.cancel(int(parts[2])):
+        await callback.answer("Рассылка будет остановлена после текущей пачки.")
+    else:
+        await callback.answer("Рассылка уже завершена.", show_alert=True)
 
-    sent = 0
-    failed = 0
-    total = len(recipients)
-    progress_msg = await message.reply(f"📤 Начинаю рассылку новостей (0/{total})...")
-    
-    # Send sequentially with small delay to avoid flood
-    for i, uid in enumerate(recipients):
-        try:
-            if media_file:
-                # Send media with caption
-                if media_type == "photo":
-                    await bot.send_photo(
-                        uid,
-                        photo=media_file,
-                        caption=formatted_text,
-                        parse_mode="HTML",
-                        reply_markup=reply_kb
-                    )
-                elif media_type == "video":
-                    await bot.send_video(
-                        uid,
-                        video=media_file,
-                        caption=formatted_text,
-                        parse_mode="HTML",
-                        reply_markup=reply_kb
-                    )
-                elif media_type == "document":
-                    await bot.send_document(
-                        uid,
-                        document=media_file,
-                        caption=formatted_text,
-                        parse_mode="HTML",
-                        reply_markup=reply_kb
-                    )
-                elif media_type == "audio":
-                    await bot.send_audio(
-                        uid,
-                        audio=media_file,
-                        caption=formatted_text,
-                        parse_mode="HTML",
-                        reply_markup=reply_kb
-                    )
-            else:
-                # Send text message
-                await bot.send_message(
-                    uid,
-                    formatted_text,
-                    parse_mode="HTML",
-                    reply_markup=reply_kb,
-                    disable_web_page_preview=True
-                )
-            
-            sent += 1
-            
-            # Update progress every 10 messages or every 5 seconds
-            if i % 10 == 0 or i == total - 1:
-                try:
-                    await progress_msg.edit_text(f"📤 Рассылка новостей: {i+1}/{total} отправлено")
-                except:
-                    pass
-            
-            await asyncio.sleep(0.1)  # Задержка между отправкой сообщений
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение пользователю {uid}: {e}")
-            failed += 1
-    
-    # Send final report
-    report_text = f"✅ Рассылка завершена\n\nОтправлено: {sent}\nНе удалось: {failed}"
-    
-    if failed > 0:
-        report_text += "\n\n❌ Некоторые сообщения не были доставлены. Это может быть связано с тем, что пользователи заблокировали бота или удалили свои аккаунты."
-    
-    await progress_msg.edit_text(report_text)
-    await message.reply(report_text)
+async def cmd_stats(message: types.Message):
+    """Admin-only command: /stats — метрики кэшей и очередей"""
+    if message.from_user.id != ADMIN_ID:
+        await message.reply("❌ Только администратор может использовать эту команду.")
+        return
+    norm = normalization_cache.stats()
+    text = (
+        "📊 <b>Статистика</b>\n\n"
+        "<b>Кэш нормализации ссылок</b>\n"
+        f"Записей: {norm['size']}\n"
+        f"Попадания: {norm['hits']} (негативные: {norm['negative_hits']})\n"
+        f"Промахи: {norm['misses']}\n"
+        f"Hit rate: {norm['hit_rate'] * 100:.1f}%"
+    )
+    cs = cache_manager.stats()
+    text += (
+        f"\n\n<b>Файловый кэш</b> ({cs['policy']})\nЗаписей: {cs['entries']}, файлов: {cs['blobs']} "
+        f"(повторов содержимого: {cs['dedup_hits']}), "
+        f"{cs['bytes'] / (1024 ** 3):.2f} из {cs['max_bytes'] / (1024 ** 3):.0f} GB\n"
+        f"Вытеснено: по объёму {cs['evicted_size']}, по TTL {cs['evicted_ttl']} "
+        f"({cs['evicted_bytes'] / (1024 ** 2):.0f} MB)\n"
+        f"Hit rate: локальный {cs['hot_hit_rate'] * 100:.1f}%, холодный {cs['cold_hit_rate'] * 100:.1f}%"
+    )
+    text += (
+        f"\nДопуск: принято {cs['admitted']}, отклонено {cs['rejected']}; закреплено {cs['pinned']}"
+    )
+    if cs["cold"]:
+        text += (
+            f"\nХолодный уровень ({cs['cold']}): записей {cs['cold_entries']}, "
+            f"{cs['cold_bytes'] / (1024 ** 3):.2f} GB, перенесено {cs['demoted']}, возвращено {cs['promoted']}"
+        )
+    hot = cache_manager.hot_report(10)
+    if hot:
+        text += "\n\n<b>Популярное</b>"
+        for key, estimate, cached, pinned in hot:
+            marks = ("📌" if pinned else "") + ("💾" if cached else "")
+            text += f"\n{estimate}× {html_escape(canonical_url(key, key))} {marks}"
+    us = user_settings.stats()
+    text += (
+        f"\n\n<b>Настройки пользователей</b>\nВ памяти: {us['size']}, "
+        f"попадания: {us['hits']}, промахи: {us['misses']} ({us['hit_rate'] * 100:.1f}%)"
+    )
+    text += f"\n\nАудио из кэшированного видео: {download_manager.audio_derived}"
+    text += f"\nПовторы ссылок в группах: {recent_links.duplicates}"
+    gw = telegram_gateway.stats()
+    text += (
+        f"\n\n<b>Исходящие запросы</b>\nВ очереди: {gw['queued']}, flood wait: {gw['flood_waits']}, "
+        f"повторено: {gw['rescheduled']}, устаревших действий: {gw['dropped_actions']}"
+    )
+    for name, granted, avg_wait, max_wait in gw["classes"]:
+        if granted:
+            text += f"\n{name}: {granted}, ожидание {avg_wait * 1000:.0f} мс (макс. {max_wait:.1f} с)"
+    se = status_editor.stats()
+    text += (
+        f"\n\n<b>Правки статусов</b>\nЗапрошено: {se['submitted']}, отправлено: {se['sent']}, "
+        f"в очереди: {se['pending']}\nОбъединено: {se['coalesced']}, без изменений: {se['unchanged']}, "
+        f"после финала: {se['dropped']}, ошибок: {se['failed']}\n"
+        f"Flood wait: {se['flood_waits']}, задержка: {se['avg_delay']:.2f} с"
+    )
+    bs = broadcast_manager.stats()
+    text += (
+        f"\n\n<b>Рассылки</b>\nАктивно: {bs['active']}, отправлено: {bs['sent']}, "
+        f"заблокировали бота: {bs['blocked']}, ошибок: {bs['failed']}\n"
+        f"Flood wait: {bs['flood_waits']}, ожидание лимита: {bs['limiter_wait']:.0f} с"
+    )
+    prefetch = prefetch_manager.stats()
+    text += (
+        "\n\n<b>Спекулятивная подготовка</b>"
+        + ("" if SPECULATIVE_PREFETCH else " (выключена)")
+        + f"\nАктивно: {prefetch['active']}, запущено: {prefetch['started']}, "
+        f"скачано заранее: {prefetch['prefetched']}, отменено: {prefetch['cancelled']}"
+    )
+    text += "\n\n<b>Базы данных</b>"
+    for db in Database.opened():
+        avg_ms = db.busy_time / db.ops * 1000 if db.ops else 0.0
+        text += f"\n{os.path.basename(db.path)}: {db.ops} запросов, {avg_ms:.2f} мс в среднем"
+    for name, queue in (("кэш", cache_manager.writes), ("история", history_manager.writes)):
+        wb = queue.stats()
+        text += (
+            f"\nОтложенная запись ({name}): в очереди {wb['queued']}, сбросов {wb['flushes']}, "
+            f"строк {wb['rows']} (ошибок {wb['failed']}), сброс {wb['avg_latency'] * 1000:.1f} мс"
+        )
+    strategies = extractor_registry.stats_report()
+    if strategies:
+        text += "\n\n<b>Стратегии загрузки</b>"
+        for platform_key, name, attempts, rate, latency in strategies:
+            text += f"\n{platform_key}/{name}: {attempts} попыток, успех {rate * 100:.0f}%, {latency:.1f} с"
+    await message.reply(text, parse_mode="HTML")
 
 # Обработчик для управления загрузкой (пауза/отмена)
 async def cb_progress_control(callback: types.CallbackQuery):
@@ -2383,10 +5584,10 @@ async def cb_progress_control(callback: types.CallbackQuery):
         # Отменяем текущую загрузку
         if "status_msg_id" in download_info:
             try:
-                await bot.edit_message_text(
-                    chat_id=callback.message.chat.id,
-                    message_id=download_info["status_msg_id"],
-                    text="Загрузка отменена по вашему запросу."
+                await status_editor.edit(
+                    callback.message.chat.id, download_info["status_msg_id"],
+                    "Загрузка отменена по вашему запросу.",
+                    final=True
                 )
             except Exception:
                 pass
@@ -2400,10 +5601,10 @@ async def cb_progress_control(callback: types.CallbackQuery):
         # Обновляем сообщение
         if "status_msg_id" in download_info:
             try:
-                await bot.edit_message_text(
-                    chat_id=callback.message.chat.id,
-                    message_id=download_info["status_msg_id"],
-                    text="Загрузка отменена по вашему запросу."
+                await status_editor.edit(
+                    callback.message.chat.id, download_info["status_msg_id"],
+                    "Загрузка отменена по вашему запросу.",
+                    final=True
                 )
             except Exception:
                 pass
@@ -2432,40 +5633,122 @@ async def cb_retry(callback: types.CallbackQuery):
     if retry_id in RETRY_LINKS:
         del RETRY_LINKS[retry_id]
 
-# ===== ВЕБ-СЕРВЕР ДЛЯ HEALTH CHECK =====
+# ===== ВЕБ-СЕРВЕР ДЛЯ HEALTH CHECK И ВЕБХУКА =====
 async def health_check(request):
     """Endpoint для проверки работоспособности сервиса"""
-    return web.json_response({"status": "ok", "bot": "running"})
-
-async def start_web_server():
-    """Запуск веб-сервера для health check"""
+    return web.json_response({"status": "ok", "bot": "running", "mode": BOT_MODE})
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Приём вебхука: Telegram получает ответ сразу, обновление обрабатывается в фоне,
+    но фоновых обработок не больше limit — следующий запрос ждёт свободного места,
+    и Telegram не присылает новые обновления сверх max_connections"""
+    def __init__(self, *args, limit: int, **kwargs):
+        super().__init__(*args, handle_in_background=True, **kwargs)
+        self._slots = asyncio.Semaphore(limit)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+def build_web_app() -> web.Application:
     app = web.Application()
     app.router.add_get('/health', health_check)
-    runner = web.AppRunner(app)
+    if BOT_MODE == "webhook":
+        # Запросы с неверным X-Telegram-Bot-Api-Secret-Token отклоняются с 401
+        BoundedRequestHandler(
+            dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, limit=WEBHOOK_MAX_CONCURRENT
+        ).register(app, path=WEBHOOK_PATH)
+        # Запуск и остановка приложения вызывают startup/shutdown диспетчера
+        setup_application(app, dp, bot=bot)
+    return app
+
+async def start_web_server(app: Optional[web.Application] = None) -> web.AppRunner:
+    """Запуск веб-сервера для health check (и вебхука)"""
+    runner = web.AppRunner(app or build_web_app())
     await runner.setup()
     # Render использует порт 10000 по умолчанию
-    site = web.TCPSite(runner, '0.0.0.0', 10000)
+    site = web.TCPSite(runner, '0.0.0.0', WEB_PORT)
     await site.start()
-    logger.info("✅ Веб-сервер для health check запущен на порту 10000")
+    logger.info(f"✅ Веб-сервер запущен на порту {WEB_PORT}")
+    return runner
+
+async def run_webhook():
+    """Приём обновлений через вебхук; экземпляров может быть несколько за одним балансировщиком"""
+    runner = await start_web_server()
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(WEBHOOK_MAX_CONCURRENT, 100)
+            )
+            logger.info(f"Вебхук установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        else:
+            logger.info(f"WEBHOOK_URL не задан — жду обновления на {WEBHOOK_PATH} без установки вебхука")
+        # Вебхук не снимаем при остановке: его обслуживают и другие экземпляры
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def replay_updates(path: str, url: str):
+    """Отправить записанные обновления (по одному JSON в строке) на вебхук — локальная проверка режима webhook"""
+    headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+    async with aiohttp.ClientSession() as session:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                async with session.post(url, data=line.encode("utf-8"), headers=headers) as resp:
+                    logger.info(f"{url}: {resp.status}")
 
 # ---- lifecycle ----
 async def on_startup():
-    logger.info("Start polling")
+    logger.info(f"Start {BOT_MODE}")
     # Запускаем задачу для очистки RETRY_LINKS
     asyncio.create_task(cleanup_retry_links())
-    # Запускаем веб-сервер для health check
-    asyncio.create_task(start_web_server())
+    # Устаревшие ссылки без выбранного формата (и их подготовка)
+    asyncio.create_task(cleanup_pending_links())
+    # В режиме polling веб-сервер нужен только для health check (в режиме webhook он уже запущен)
+    if BOT_MODE != "webhook":
+        asyncio.create_task(start_web_server())
+    # Рассылки, прерванные прошлой остановкой
+    await broadcast_manager.resume()
 
 async def on_shutdown():
     logger.info("Shutting down...")
+    # Рассылкам нужна сессия бота, чтобы дослать текущую пачку
+    await broadcast_manager.close()
+    # Финальные статусы загрузок и рассылок
+    await status_editor.close()
+    await telegram_gateway.close()
+    await close_http_session()
     await bot.session.close()
+    # Дописываем отложенные вставки до закрытия соединений
+    await cache_manager.close()
+    await history_manager.close()
+    await asyncio.to_thread(Database.close_all)
 
 async def main():
     # Создаем экземпляры менеджеров
-    global download_manager, cache_manager, history_manager
+    global download_manager, cache_manager, history_manager, prefetch_manager, broadcast_manager, status_editor
+    global telegram_gateway
+    # Все запросы к Bot API проходят через общий шлюз с приоритетами и лимитами
+    telegram_gateway = TelegramGateway(
+        OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_PER_MINUTE / 60, OUTBOUND_BURST
+    )
+    bot.session.middleware(telegram_gateway)
     download_manager = DownloadManager(max_concurrent=3)
-    cache_manager = CacheManager()
+    cache_manager = CacheManager(cold=make_cold_backend(COLD_TIER))
     history_manager = HistoryManager()
+    prefetch_manager = PrefetchManager()
+    broadcast_manager = BroadcastManager(rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY)
+    status_editor = StatusEditor(EDIT_GLOBAL_RATE, EDIT_CHAT_INTERVAL, EDIT_GROUP_INTERVAL)
 
     # Получаем имя бота
     bot_info = await bot.get_me()
@@ -2478,20 +5761,37 @@ async def main():
     dp.message.register(cmd_start, Command(commands=["start", "help"]), group_filter)
     dp.message.register(cmd_history, Command(commands=["history"]), group_filter)
     dp.message.register(cmd_addnews, Command(commands=["addnews"]), group_filter)
+    dp.message.register(cmd_stats, Command(commands=["stats"]), group_filter)
     dp.message.register(handle_text, F.text, group_filter)
 
     # Колбэки работают всегда (после того, как пользователь начал взаимодействие)
     dp.callback_query.register(cb_download, F.data.startswith("dl:"))
+    dp.callback_query.register(cb_batch, F.data.startswith("batch:"))
     dp.callback_query.register(cb_history, F.data.startswith("history:"))
+    dp.callback_query.register(cb_broadcast, F.data.startswith("broadcast:"))
     dp.callback_query.register(cb_retry, F.data.startswith("retry:"))
     dp.callback_query.register(cb_progress_control, F.data.startswith("progress:"))
 
-    # Запускаем polling
+    # Хуки жизненного цикла (именованные аргументы start_polling aiogram 3 передаёт в хендлеры, а не вызывает)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
     try:
-        await dp.start_polling(bot, on_startup=on_startup, on_shutdown=on_shutdown)
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Polling не работает при установленном вебхуке (например, после режима webhook)
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
+        await close_http_session()
         await bot.session.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if len(sys.argv) >= 3 and sys.argv[1] == "replay":
+        # python main.py replay updates.jsonl [http://127.0.0.1:10000/webhook]
+        replay_url = sys.argv[3] if len(sys.argv) > 3 else f"http://127.0.0.1:{WEB_PORT}{WEBHOOK_PATH}"
+        asyncio.run(replay_updates(sys.argv[2], replay_url))
+    else:
+        asyncio.run(main())
 
@@ -0,0 +1,40 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py читает токен при импорте и создаёт базы в текущей папке —
+# тесты работают во временной папке, чтобы не трогать базы репозитория
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="downloader-tests-"))
+
+
+@pytest.fixture
+def run():
+    """Выполнить корутину; один цикл событий на весь тест"""
+    with asyncio.Runner() as runner:
+        yield runner.run
+
+
+@pytest.fixture
+def cold():
+    """Холодный уровень кэша; тесты холодного уровня переопределяют фикстуру"""
+    return None
+
+
+@pytest.fixture
+def cache(run, tmp_path, cold):
+    """CacheManager на 1000 байт во временной папке теста"""
+    import main
+
+    async def create():
+        # Менеджер запускает фоновую очистку — создаётся внутри цикла событий
+        return main.CacheManager(cache_dir=str(tmp_path / "cache"), db_path=str(tmp_path / "cache.db"),
+                                 max_bytes=1000, cold=cold)
+
+    cache = run(create())
+    yield cache
+    run(cache.close())
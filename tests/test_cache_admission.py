@@ -0,0 +1,51 @@
+
+def _file(directory, name: str, size: int) -> str:
+    path = directory / name
+    path.write_bytes(name.encode().ljust(size, b"."))
+    return str(path)
+
+
+def test_full_cache_admits_new_key_on_equal_frequency(run, tmp_path, cache):
+    cache.record_request("old")
+    assert run(cache.add_to_cache("old", _file(tmp_path, "old.mp4", 600), "video"))
+    cache.record_request("new")
+    assert cache.sketch.estimate("new") == cache.sketch.estimate("old")
+    assert run(cache.add_to_cache("new", _file(tmp_path, "new.mp4", 600), "video"))
+    assert run(cache.get_cached_file("old", "video", touch=False)) is None
+
+
+def test_full_cache_rejects_key_rarer_than_victim(run, tmp_path, cache):
+    for _ in range(3):
+        cache.record_request("old")
+    assert run(cache.add_to_cache("old", _file(tmp_path, "old.mp4", 600), "video"))
+    cache.record_request("new")
+    assert not run(cache.add_to_cache("new", _file(tmp_path, "new.mp4", 600), "video"))
+    assert run(cache.get_cached_file("old", "video", touch=False)) is not None
+
+
+def _pinned(cache):
+    stats = cache.stats()
+    return stats["pinned"], stats["pinned_bytes"]
+
+
+def test_pinned_bytes_follow_index(run, tmp_path, cache):
+    run(cache.add_to_cache("hot", _file(tmp_path, "hot.mp4", 30), "video"))
+    run(cache.add_to_cache("hot", _file(tmp_path, "hot.mp3", 10), "audio"))
+    cache.pin_threshold = 1
+    cache.record_request("hot")
+    assert _pinned(cache) == (1, 40)
+    # Замена файла закреплённой записи меняет учтённый объём
+    run(cache.add_to_cache("hot", _file(tmp_path, "hot2.mp3", 20), "audio"))
+    assert _pinned(cache) == (1, 50)
+    # Удаление видео оставляет закреплённым аудио того же контента
+    run(cache.remove_from_cache(run(cache.get_cached_file("hot", "video", touch=False))))
+    assert _pinned(cache) == (1, 20)
+    run(cache.remove_from_cache(run(cache.get_cached_file("hot", "audio", touch=False))))
+    assert _pinned(cache) == (0, 0)
+
+
+def test_lookups_do_not_count_requests(run, tmp_path, cache):
+    run(cache.add_to_cache("key", _file(tmp_path, "key.mp4", 10), "video"))
+    run(cache.get_cached_file("key", "video"))
+    run(cache.get_cached_file("key", "audio"))
+    assert cache.sketch.estimate("key") == 0
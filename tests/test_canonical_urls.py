@@ -0,0 +1,36 @@
+import pytest
+from yt_dlp.extractor import (
+    dailymotion, facebook, instagram, pinterest, reddit, soundcloud, tiktok, twitter, vimeo, vk, youtube,
+)
+
+import main
+
+# платформа -> (экстрактор yt-dlp, пример пользовательской ссылки)
+SAMPLES = {
+    "youtube": (youtube.YoutubeIE, "https://youtu.be/dQw4w9WgXcQ?si=abc"),
+    "tiktok": (tiktok.TikTokIE, "https://www.tiktok.com/@someone/video/7106594312292453675?lang=ru"),
+    "instagram": (instagram.InstagramIE, "https://www.instagram.com/reel/Cabc_12-x/"),
+    "twitter": (twitter.TwitterIE, "https://twitter.com/someone/status/1234567890123"),
+    "facebook": (facebook.FacebookIE, "https://www.facebook.com/someone/videos/123456789/"),
+    "vk": (vk.VKIE, "https://vk.com/video-12345_456239017"),
+    "reddit": (reddit.RedditIE, "https://www.reddit.com/r/videos/comments/abc12/some_title/"),
+    "pinterest": (pinterest.PinterestIE, "https://ru.pinterest.com/pin/123456789/"),
+    "dailymotion": (dailymotion.DailymotionIE, "https://www.dailymotion.com/video/x7tgad0"),
+    "vimeo": (vimeo.VimeoIE, "https://vimeo.com/channels/staffpicks/76979871"),
+    "soundcloud": (soundcloud.SoundcloudIE, "https://soundcloud.com/Artist/Track-Name"),
+}
+
+
+def test_every_template_has_sample():
+    assert set(SAMPLES) == set(main.CANONICAL_URL_TEMPLATES)
+
+
+@pytest.mark.parametrize("platform", sorted(SAMPLES))
+def test_canonical_url_matches_extractor(platform):
+    ie, url = SAMPLES[platform]
+    key = main.content_key(url)
+    assert key.startswith(f"{platform}:")
+    canonical = main.canonical_url(key, url)
+    assert ie.suitable(canonical), canonical
+    # Каноническая ссылка сводится к тому же ключу
+    assert main.content_key(canonical) == key
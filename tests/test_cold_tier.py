@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+class GatedBackend(main.LocalDirBackend):
+    """Локальный холодный уровень, копирование в который ждёт разрешения теста"""
+
+    def __init__(self, root: str):
+        super().__init__(root)
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def put(self, key: str, src_path: str):
+        await self.gate.wait()
+        await super().put(key, src_path)
+
+
+@pytest.fixture
+def cold(tmp_path):
+    return GatedBackend(str(tmp_path / "cold"))
+
+
+def _file(directory, name: str, content: bytes) -> str:
+    path = directory / name
+    path.write_bytes(content)
+    return str(path)
+
+
+async def _demoted(cache, count: int):
+    while cache.stats()["demoted"] < count:
+        await asyncio.sleep(0.01)
+
+
+def test_backends_must_implement_storage():
+    with pytest.raises(TypeError):
+        main.BlobBackend()
+
+
+def test_evicted_file_is_promoted_back(run, tmp_path, cache):
+    async def scenario():
+        await cache.add_to_cache("a", _file(tmp_path, "a.mp4", b"a" * 50), "video")
+        hot_path = await cache.get_cached_file("a", "video", touch=False)
+        await cache.evict_to(0)
+        await asyncio.wait_for(_demoted(cache, 1), 5)
+        assert not (await cache.get_cached_file("a", "video", touch=False))
+        return hot_path, await cache.get_cached_file("a", "video")
+
+    hot_path, promoted = run(scenario())
+    assert promoted == hot_path
+    with open(promoted, "rb") as f:
+        assert f.read() == b"a" * 50
+    stats = cache.stats()
+    assert (stats["demoted"], stats["promoted"], stats["cold_entries"]) == (1, 1, 0)
+
+
+def test_second_eviction_waits_for_running_demotion(run, tmp_path, cache, cold):
+    async def scenario():
+        cold.gate.clear()
+        await cache.add_to_cache("a", _file(tmp_path, "a.mp4", b"x" * 50), "video")
+        await cache.evict_to(0)
+        # Тот же файл снова в кэше под другим ключом и вытесняется, пока первый перенос ждёт
+        await cache.add_to_cache("b", _file(tmp_path, "b.mp4", b"x" * 50), "video")
+        await cache.evict_to(0)
+        cold.gate.set()
+        await asyncio.wait_for(_demoted(cache, 1), 5)
+        return await cache.get_cached_file("a", "video"), await cache.get_cached_file("b", "video")
+
+    a, b = run(scenario())
+    assert a is not None and a == b
+    with open(a, "rb") as f:
+        assert f.read() == b"x" * 50
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+import main
+
+
+class FakeResponse:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    @property
+    def content(self):
+        return self
+
+    async def iter_chunked(self, size: int):
+        for start in range(0, len(self.body), size):
+            yield self.body[start:start + size]
+
+
+class FakeSession:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def get(self, url, **kwargs):
+        return FakeResponse(self.body)
+
+
+def test_extractor_requires_fetch():
+    with pytest.raises(TypeError):
+        main.Extractor()
+
+
+def test_direct_file_is_written_completely(run, tmp_path, monkeypatch):
+    # Больше буфера записи и не кратно ему — проверяются и полные куски, и хвост
+    body = os.urandom(main.DirectFileExtractor.WRITE_BUFFER * 2 + 12345)
+    monkeypatch.setattr(main, "get_http_session", lambda: FakeSession(body))
+    ctx = main.ExtractContext("https://example.com/files/clip.mp4", str(tmp_path), "video")
+    path = run(main.DirectFileExtractor().fetch(ctx, str(tmp_path)))
+    assert path == str(tmp_path / "clip.mp4")
+    with open(path, "rb") as f:
+        assert f.read() == body
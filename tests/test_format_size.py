@@ -0,0 +1,15 @@
+import main
+
+
+def test_format_size_below_gigabyte():
+    # Лимиты меньше 1 ГБ раньше печатались как «0 ГБ»
+    assert main.format_size(512 * 1024 * 1024) == "512 МБ"
+    assert main.format_size(50 * 1024 * 1024) == "50 МБ"
+
+
+def test_format_size_units():
+    assert main.format_size(500) == "500 Б"
+    assert main.format_size(2048) == "2 КБ"
+    assert main.format_size(int(48.34 * 1024 * 1024)) == "48.3 МБ"
+    assert main.format_size(1024 ** 3) == "1 ГБ"
+    assert main.format_size(int(1.5 * 1024 ** 3)) == "1.5 ГБ"
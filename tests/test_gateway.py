@@ -0,0 +1,210 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendChatAction, SendMediaGroup, SendMessage, SendVideo
+from aiogram.types import InputMediaPhoto
+
+import main
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Цикл событий с виртуальным временем: когда ждать больше нечего, время
+    сразу переводится на ближайший таймер, поэтому паузы шлюза не занимают реального времени.
+    Каждый шаг цикла немного продвигает время, как и настоящее: иначе таймер, который
+    из-за округления срабатывает «сейчас», перезапускался бы бесконечно"""
+    STEP = 1e-9
+
+    def __init__(self):
+        super().__init__()
+        self._now = 0.0
+
+    def time(self) -> float:
+        return self._now
+
+    def _run_once(self):
+        self._now += self.STEP
+        if not self._ready and self._scheduled:
+            self._now = max(self._now, self._scheduled[0].when())
+        super()._run_once()
+
+
+@pytest.fixture
+def vrun():
+    """Как run, но в виртуальном времени"""
+    with asyncio.Runner(loop_factory=VirtualTimeLoop) as runner:
+        yield runner.run
+
+
+class FakeApi:
+    """Поддельный Bot API: запоминает (время, чат, метод), может ответить flood wait"""
+
+    def __init__(self):
+        self.sent = []
+        self.flood = {}  # chat_id -> сколько секунд ждать при следующем запросе
+
+    async def __call__(self, bot, method):
+        retry_after = self.flood.pop(method.chat_id, None)
+        if retry_after is not None:
+            raise TelegramRetryAfter(method=method, message="Flood control exceeded", retry_after=retry_after)
+        self.sent.append((round(asyncio.get_running_loop().time(), 3), method.chat_id, type(method).__name__))
+        return True
+
+
+@pytest.fixture
+def api():
+    return FakeApi()
+
+
+def _gateway(global_rate: float = 1e6, **kwargs) -> main.TelegramGateway:
+    """Шлюз на времени цикла; общий лимит по умолчанию не мешает проверять лимиты чатов"""
+    return main.TelegramGateway(global_rate=global_rate, clock=asyncio.get_running_loop().time, **kwargs)
+
+
+def _message(chat_id) -> SendMessage:
+    return SendMessage(chat_id=chat_id, text="text")
+
+
+async def _send_all(gateway, api, *methods):
+    results = await asyncio.gather(*(gateway(api, None, method) for method in methods))
+    await gateway.close()
+    return results
+
+
+def test_chat_rate_spaces_messages(vrun, api):
+    async def scenario():
+        gateway = _gateway(chat_rate=2.0, burst=2.0)
+        await _send_all(gateway, api, *(_message(1) for _ in range(4)))
+
+    vrun(scenario())
+    assert [at for at, _, _ in api.sent] == [0.0, 0.0, 0.5, 1.0]
+
+
+def test_groups_use_group_rate(vrun, api):
+    async def scenario():
+        gateway = _gateway(chat_rate=1.0, group_rate=0.25, burst=1.0)
+        await _send_all(gateway, api, _message(-100), _message(-100), _message(5), _message(5))
+
+    vrun(scenario())
+    times = {}
+    for at, chat, _ in api.sent:
+        times.setdefault(chat, []).append(at)
+    assert times == {-100: [0.0, 4.0], 5: [0.0, 1.0]}
+
+
+def test_blocked_chat_does_not_hold_other_chats(vrun, api):
+    async def scenario():
+        gateway = _gateway(chat_rate=1.0, burst=1.0)
+        await _send_all(gateway, api, _message(1), _message(1), _message(2))
+
+    vrun(scenario())
+    assert api.sent == [(0.0, 1, "SendMessage"), (0.0, 2, "SendMessage"), (1.0, 1, "SendMessage")]
+
+
+def test_higher_priority_granted_first(vrun, api):
+    async def scenario():
+        gateway = _gateway(global_rate=1.0, burst=1.0)
+        # Единственный общий токен уже потрачен — дальше очередь по приоритету
+        await gateway(api, None, _message(9))
+        with main.outbound_class(main.PRIORITY_BULK):
+            bulk = asyncio.ensure_future(gateway(api, None, _message(1)))
+        with main.outbound_class(main.PRIORITY_PROGRESS):
+            progress = asyncio.ensure_future(gateway(api, None, _message(2)))
+        video = asyncio.ensure_future(gateway(api, None, SendVideo(chat_id=3, video="file")))
+        await asyncio.gather(bulk, progress, video)
+        await gateway.close()
+
+    vrun(scenario())
+    assert [(at, chat) for at, chat, _ in api.sent] == [(0.0, 9), (1.0, 3), (2.0, 2), (3.0, 1)]
+
+
+def test_media_group_weight_is_paid_back(vrun, api):
+    async def scenario():
+        gateway = _gateway(chat_rate=1.0, burst=3.0)
+        album = SendMediaGroup(chat_id=7, media=[InputMediaPhoto(media=f"file{i}") for i in range(5)])
+        await _send_all(gateway, api, album, _message(7))
+
+    vrun(scenario())
+    # Альбом из 5 файлов при запасе 3 оставляет долг 2: следующее сообщение — через 3 с
+    assert [(at, name) for at, _, name in api.sent] == [(0.0, "SendMediaGroup"), (3.0, "SendMessage")]
+
+
+def test_chat_limit_exempt_request_is_charged_but_not_delayed(vrun, api):
+    async def scenario():
+        gateway = _gateway(chat_rate=1.0, burst=1.0)
+        await gateway(api, None, _message(1))
+        with main.outbound_class(main.PRIORITY_PROGRESS, retry=False, chat_limit=False):
+            await gateway(api, None, _message(1))
+        await _send_all(gateway, api, _message(1))
+
+    vrun(scenario())
+    # Правка ушла сразу, но её стоимость задержала следующее сообщение до 2 с
+    assert [at for at, _, _ in api.sent] == [0.0, 0.0, 2.0]
+
+
+def test_flood_wait_pauses_chat_and_retries(vrun, api):
+    async def scenario():
+        gateway = _gateway(chat_rate=10.0, burst=3.0)
+        api.flood[1] = 30
+        await _send_all(gateway, api, _message(1), _message(2))
+        return gateway.stats()
+
+    stats = vrun(scenario())
+    assert api.sent == [(0.0, 2, "SendMessage"), (30.0, 1, "SendMessage")]
+    assert (stats["flood_waits"], stats["rescheduled"]) == (1, 1)
+
+
+def test_forgetting_idle_chats_keeps_busy_and_paused_ones(vrun, api):
+    async def scenario():
+        gateway = _gateway(chat_rate=1.0, burst=1.0, memory=1)
+        api.flood[1] = 30
+        await _send_all(gateway, api, _message(1), _message(2), _message(3), _message(2))
+
+    vrun(scenario())
+    # Чат 2 с потраченным запасом и чат 1 на паузе не забыты, хотя помнить велено один чат
+    assert sorted(api.sent) == [(0.0, 2, "SendMessage"), (0.0, 3, "SendMessage"),
+                                (1.0, 2, "SendMessage"), (30.0, 1, "SendMessage")]
+
+
+def test_chat_limit_exempt_request_waits_for_flood_pause(vrun, api):
+    async def scenario():
+        gateway = _gateway()
+        api.flood[1] = 30
+        with pytest.raises(TelegramRetryAfter):
+            with main.outbound_class(main.PRIORITY_PROGRESS, retry=False, chat_limit=False):
+                await gateway(api, None, _message(1))
+        with main.outbound_class(main.PRIORITY_PROGRESS, retry=False, chat_limit=False):
+            await _send_all(gateway, api, _message(1))
+
+    vrun(scenario())
+    assert api.sent == [(30.0, 1, "SendMessage")]
+
+
+def test_stale_chat_action_is_dropped(vrun, api):
+    async def scenario():
+        gateway = _gateway(chat_rate=1.0, burst=1.0)
+        await gateway(api, None, _message(1))
+        # Сообщения занимают чат на 6 с — действие устареет раньше, чем до него дойдёт очередь
+        results = await _send_all(gateway, api, *(_message(1) for _ in range(6)),
+                                  SendChatAction(chat_id=1, action="typing"))
+        return results[-1], gateway.stats()["dropped_actions"]
+
+    result, dropped = vrun(scenario())
+    assert result is True
+    assert dropped == 1
+    assert all(name == "SendMessage" for _, _, name in api.sent)
+
+
+def test_close_cancels_waiting_requests(vrun, api):
+    async def scenario():
+        gateway = _gateway(chat_rate=0.001, burst=1.0)
+        await gateway(api, None, _message(1))
+        waiting = asyncio.ensure_future(gateway(api, None, _message(1)))
+        await asyncio.sleep(1)
+        await gateway.close()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        return gateway.stats()["queued"]
+
+    assert vrun(scenario()) == 0
+    assert len(api.sent) == 1
@@ -0,0 +1,27 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def history(tmp_path):
+    return main.HistoryManager(str(tmp_path / "history.db"))
+
+
+def test_time_index_survives_migrations(history):
+    indexes = history.db.run_sync(
+        lambda conn: {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    )
+    assert "idx_history_user_time" in indexes
+
+
+def test_active_among_uses_time_index(run, history):
+    plan = history.db.run_sync(lambda conn: conn.execute(
+        "EXPLAIN QUERY PLAN SELECT DISTINCT user_id FROM history "
+        "WHERE user_id IN (?, ?) AND timestamp >= datetime('now', ?)", (1, 2, "-30 days")
+    ).fetchall())
+    assert any("idx_history_user_time" in row[-1] for row in plan)
+
+    run(history.add_to_history(1, "https://youtu.be/a", "video"))
+    run(history.writes.flush())
+    assert run(history.active_among([1, 2], 30)) == {1}
@@ -0,0 +1,36 @@
+import aiohttp
+import pytest
+
+import main
+
+
+@pytest.fixture
+def normalizer(monkeypatch):
+    """Подменяемый нормализатор: ответы берутся из списка по очереди"""
+    answers = []
+
+    async def fake(url, session):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(main, "pick_normalizer", lambda url: fake)
+    monkeypatch.setattr(main, "get_http_session", lambda: None)
+    monkeypatch.setattr(main, "normalization_cache", main.NormalizationCache())
+    return answers
+
+
+def test_network_failure_is_not_cached_as_negative(run, normalizer):
+    url = "https://pin.it/abc"
+    normalizer += [aiohttp.ClientConnectionError("down"), "https://www.pinterest.com/pin/1/"]
+    assert run(main.normalize_url(url)) == url
+    assert run(main.normalize_url(url)) == "https://www.pinterest.com/pin/1/"
+
+
+def test_resolved_non_video_is_cached(run, normalizer):
+    url = "https://pin.it/board"
+    normalizer += [None]
+    assert run(main.normalize_url(url)) == url
+    # Второй вызов нормализатора не доходит: список ответов пуст
+    assert run(main.normalize_url(url)) == url
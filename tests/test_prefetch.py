@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def manager():
+    return main.PrefetchManager()
+
+
+@pytest.fixture
+def prepared(run, manager):
+    """Подготовка видео для клавиатуры 1, которая ещё идёт"""
+    task = run(_start())
+    manager.tasks[1] = task
+    manager.modes[1] = "video"
+    yield task
+    task.cancel()
+
+
+async def _start():
+    return asyncio.create_task(asyncio.sleep(60))
+
+
+def test_detach_keeps_prefetch_of_chosen_mode(run, manager, prepared):
+    manager.detach(1, "video")
+    run(asyncio.sleep(0))
+    assert not prepared.cancelled()
+    assert 1 not in manager.tasks
+    assert manager.cancelled == 0
+
+
+def test_detach_cancels_prefetch_of_other_mode(run, manager, prepared):
+    manager.detach(1, "audio")
+    run(asyncio.sleep(0))
+    assert prepared.cancelled()
+    assert manager.cancelled == 1
@@ -0,0 +1,46 @@
+import json
+
+import main
+
+
+class FakeContent:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def iter_chunked(self, size: int):
+        for start in range(0, len(self.body), size):
+            yield self.body[start:start + size]
+
+
+# Источники разнесены по разным кускам чтения, чтобы порядок находок совпадал с документом
+FILLER = "<div>" + "x" * 100_000 + "</div>"
+
+
+class FakeResponse:
+    charset = "utf-8"
+    url = "https://www.tiktok.com/@someone"
+
+    def __init__(self, html: str):
+        self.content = FakeContent(html.encode())
+
+
+def scan(run, html: str):
+    return run(main.scan_tiktok_video_url(FakeResponse(html)))
+
+
+def test_later_jsonld_beats_earlier_og_url(run):
+    ld = {"@type": "VideoObject", "contentUrl": "https://www.tiktok.com/@someone/video/2222222222"}
+    html = ('<meta property="og:url" content="https://www.tiktok.com/@someone/video/1111111111">'
+            + FILLER + f'<script type="application/ld+json">{json.dumps(ld)}</script>')
+    assert scan(run, html) == "https://www.tiktok.com/@someone/video/2222222222"
+
+
+def test_sigi_beats_earlier_item_id(run):
+    sigi = {"ItemModule": {"3333333333": {"id": "3333333333", "author": "someone"}}}
+    html = ('<div data-x=\'{"itemId":"4444444444"}\'></div>'
+            + FILLER + f'<script id="SIGI_STATE" type="application/json">{json.dumps(sigi)}</script>')
+    assert scan(run, html) == "https://www.tiktok.com/@someone/video/3333333333"
+
+
+def test_lower_priority_match_is_used_when_alone(run):
+    assert scan(run, '<a href="/@someone/video/5555555555">') == "https://www.tiktok.com/@someone/video/5555555555"
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return main.UserSettings(str(tmp_path / "settings.db"))
+
+
+def test_concurrent_updates_keep_both_changes(run, settings):
+    async def two_taps():
+        await settings.get_settings(1)
+        await asyncio.gather(
+            settings.update_setting(1, "preferred_quality", "720p"),
+            settings.update_setting(1, "language", "en"),
+        )
+
+    run(two_taps())
+    assert run(settings.get_settings(1))["preferred_quality"] == "720p"
+    assert run(settings.get_settings(1))["language"] == "en"
+    settings.invalidate_all()
+    stored = run(settings.get_settings(1))
+    assert (stored["preferred_quality"], stored["language"]) == ("720p", "en")
+
+
+def test_update_unknown_setting_is_rejected(run, settings):
+    assert not run(settings.update_setting(1, "no_such_setting", 1))
@@ -0,0 +1,22 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def hints(monkeypatch):
+    hints = {}
+    monkeypatch.setattr(main, "VIDEO_PATH_HINTS", hints)
+    return hints
+
+
+def test_variant_list_path_is_learned(hints):
+    data = {"items": [{"video_versions": [{"url": "https://cdn/a.mp4", "width": 720, "height": 1280}]}]}
+    assert main.find_best_video_url(data, "instagram") == "https://cdn/a.mp4"
+    assert hints["instagram"] == [("items", 0, "video_versions")]
+
+
+def test_loose_link_path_is_not_learned(hints):
+    data = {"preview": {"video_url": "https://cdn/preview.mp4"}}
+    assert main.find_best_video_url(data, "instagram") == "https://cdn/preview.mp4"
+    assert hints.get("instagram", []) == []
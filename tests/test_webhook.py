@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+from aiogram import Dispatcher
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+
+SECRET = "test-secret"
+
+
+def _update(update_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "hi"},
+    }
+
+
+@pytest.fixture
+def received():
+    """id сообщений, дошедших до обработчика"""
+    return []
+
+
+@pytest.fixture
+def release():
+    """Отпускает обработчики, которые ждут этого события"""
+    return asyncio.Event()
+
+
+@pytest.fixture
+def limit():
+    return 4
+
+
+@pytest.fixture
+def client(run, received, release, limit):
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message):
+        received.append(message.message_id)
+        await release.wait()
+
+    app = web.Application()
+    main.BoundedRequestHandler(dispatcher=dp, bot=main.bot, secret_token=SECRET, limit=limit).register(
+        app, path="/webhook"
+    )
+
+    async def start():
+        # aiohttp требует создавать клиента внутри цикла событий
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        return client
+
+    client = run(start())
+    yield client
+    release.set()
+    run(client.close())
+
+
+def _post(client, update_id: int, secret: str = SECRET):
+    return client.post("/webhook", json=_update(update_id), headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+
+
+async def _until(condition, attempts: int = 50):
+    for _ in range(attempts):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+
+
+def test_webhook_rejects_wrong_secret(run, client, received):
+    assert run(_post(client, 1, secret="wrong")).status == 401
+    assert run(client.post("/webhook", json=_update(2))).status == 401
+    run(asyncio.sleep(0.05))
+    assert received == []
+
+
+def test_webhook_processes_update_with_valid_secret(run, client, received, release):
+    release.set()
+    assert run(_post(client, 7)).status == 200
+    run(_until(lambda: received))
+    assert received == [7]
+
+
+@pytest.mark.parametrize("limit", [1])
+def test_webhook_bounds_background_updates(run, client, received, release):
+    async def scenario():
+        assert (await _post(client, 1)).status == 200
+        # Единственное место занято — второй запрос ждёт завершения первой обработки
+        second = asyncio.ensure_future(_post(client, 2))
+        await asyncio.sleep(0.2)
+        waiting = not second.done()
+        release.set()
+        response = await asyncio.wait_for(second, timeout=2)
+        await _until(lambda: len(received) == 2)
+        return waiting, response.status
+
+    assert run(scenario()) == (True, 200)
+    assert received == [1, 2]
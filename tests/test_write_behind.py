@@ -0,0 +1,43 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = main.Database(str(tmp_path / "queue.db"))
+    db.run_sync(lambda conn: conn.execute("CREATE TABLE t (k TEXT PRIMARY KEY, v INTEGER NOT NULL)"))
+    yield db
+    db.close()
+
+
+def rows(db):
+    return db.run_sync(lambda conn: conn.execute("SELECT k, v FROM t ORDER BY k").fetchall())
+
+
+def test_failing_row_does_not_drop_batch(run, db):
+    async def write():
+        queue = main.WriteBehindQueue(db)
+        flushed = []
+        queue.enqueue("INSERT INTO t VALUES (?, ?)", ("a", 1), lambda: flushed.append("a"))
+        queue.enqueue("INSERT INTO t VALUES (?, ?)", ("b", None), lambda: flushed.append("b"))
+        queue.enqueue("INSERT INTO t VALUES (?, ?)", ("c", 3), lambda: flushed.append("c"))
+        await queue.flush()
+        return queue, flushed
+
+    queue, flushed = run(write())
+    assert rows(db) == [("a", 1), ("c", 3)]
+    assert (queue.rows_flushed, queue.rows_failed) == (2, 1)
+    assert flushed == ["a", "b", "c"]
+
+
+def test_enqueue_after_close_is_written(run, db):
+    async def write():
+        queue = main.WriteBehindQueue(db)
+        queue.enqueue("INSERT INTO t VALUES (?, ?)", ("a", 1))
+        await queue.close()
+        queue.enqueue("INSERT INTO t VALUES (?, ?)", ("b", 2))
+        await queue.close()
+
+    run(write())
+    assert rows(db) == [("a", 1), ("b", 2)]